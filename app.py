@@ -1,10 +1,93 @@
 from datetime import datetime
+from models.Analytics import Analytics
+from models.BlobStore import BlobStore
+from models.DuplicateIndex import DuplicateIndex
+from models.ImagePipeline import ImagePipeline, ImageTooLargeError, UnsupportedImageError
+from models.JobQueue import JobQueue
+from models.MerchantMemo import MerchantMemo
+from models.Metrics import Metrics
+from models.Model import Model
 from models.Receipt import Receipt
+from models.RecognitionCache import RecognitionCache
+from models.Summary import Summary
+import io
 import os
+import time
+from urllib.parse import urlencode
+
+from flask import (Flask, Request, Response, abort, g, jsonify, redirect, render_template, request, send_file,
+                   send_from_directory, stream_template, stream_with_context, url_for)
+
+
+# 上传截图的路由
+UPLOAD_ENDPOINTS = ('index',)
+
+
+class UploadRequest(Request):
+    # 上传的文件超过 UPLOAD_SPOOL_BYTES 时暂存到临时文件，多人同时上传大照片时内存占用有上限
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return Model.spoolUpload(total_content_length, content_type, filename, content_length)
+
+    # 上传截图的请求体超过 UPLOAD_MAX_REQUEST_BYTES 时，按 Content-Length 在读取之前返回 413；
+    # 其它路由（如 /import 流式导入大 CSV）不限制
+    @property
+    def max_content_length(self):
+        return Model.UPLOAD_MAX_REQUEST_BYTES if self.endpoint in UPLOAD_ENDPOINTS else None
 
-from flask import (Flask, render_template, request, send_from_directory)
 
 app = Flask(__name__)
+app.request_class = UploadRequest
+
+# 任务状态长轮询最多等待的秒数，等待期间占用一个工作线程，不宜太长
+JOB_WAIT_MAX = 10
+# /img 图片的缓存时间（秒）
+IMAGE_MAX_AGE = 365 * 24 * 3600
+
+# 连接池、缓存和任务队列的状态在 /metrics 被抓取时才读取
+Metrics.gauge_stats('aifun_db_pool', 'MySQL connection pool state of this process', Receipt.pool_stats)
+Metrics.gauge_stats('aifun_query_cache', 'Query result cache state of this process', Receipt.cache_stats)
+Metrics.gauge_stats('aifun_recognition_cache', 'Recognition result cache state of this process',
+                    lambda: RecognitionCache.instance().stats())
+Metrics.gauge_stats('aifun_duplicate_index', 'Screenshot perceptual hash index state of this process',
+                    lambda: DuplicateIndex.instance().stats())
+Metrics.gauge_stats('aifun_merchant_memo', 'Merchant to category memo state of this process',
+                    lambda: MerchantMemo.instance().stats())
+Metrics.gauge_stats('aifun_analytics', 'In-memory analytics columns state of this process',
+                    lambda: Analytics.instance().stats())
+Metrics.gauge_stats('aifun_job_queue', 'Background recognition queue state', lambda: JobQueue.instance().stats())
+
+@app.before_request
+def metrics_begin():
+    if Metrics.enabled:
+        g.metrics_begin = time.perf_counter()
+
+@app.after_request
+def metrics_end(response):
+    # 在响应体全部发送完后才记录耗时，流式输出的页面也按完整耗时统计
+    begin = g.get('metrics_begin')
+    if begin is not None:
+        endpoint = request.url_rule.endpoint if request.url_rule else 'unmatched'
+        method = request.method
+        status = str(response.status_code)
+        response.call_on_close(lambda: Metrics.observe('aifun_http_request_seconds', time.perf_counter() - begin,
+                                                       endpoint=endpoint, method=method, status=status))
+    return response
+
+@app.errorhandler(413)
+def request_too_large(e):
+    dictHint = {
+        'message': f'上传的文件总共不能超过 {Model.UPLOAD_MAX_REQUEST_BYTES / 1024 / 1024:g} MB',
+        'url' : '/',
+        'link': '返回首页'
+    }
+    return render_template('hint.html', hint=dictHint), 413
+
+@app.route('/metrics')
+def metrics():
+    # Prometheus 抓取地址，设置 METRICS_ENABLED=1 时启用，否则返回 404
+    if not Metrics.enabled:
+        abort(404)
+    return Response(Metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 @app.route('/favicon.ico')
 def favicon():
@@ -16,23 +99,73 @@ def favicon():
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
-        # 处理图片上传
-        file = request.files['receipt']
-        if file:
-            # 不保存上传的文件，而是直接获取文件内容 image_bytes，调用 ChatGPT 时传参数，再输出给信息确认页。
-            image_bytes = file.read()
+        # 处理图片上传，可以一次选择多张图片
+        files = [file for file in request.files.getlist('receipt') if file]
+        if len(files) > Model.UPLOAD_MAX_FILES:
+            dictHint = {
+                'message': f'一次最多上传 {Model.UPLOAD_MAX_FILES} 张图片',
+                'url' : '/',
+                'link': '返回首页'
+            }
+            return render_template('hint.html', hint=dictHint)
+        error = upload_error(files)
+        if error:
+            dictHint = {
+                'message': error[0],
+                'url' : '/',
+                'link': '返回首页'
+            }
+            return render_template('hint.html', hint=dictHint), error[1]
+        if files and request.form.get('async'):
+            # 后台识别：图片放入任务队列后立即返回，页面轮询任务状态
+            queue = job_queue()
+            ids = [queue.enqueue(file.read()) for file in files]
+            return redirect(url_for('jobs', ids=','.join(str(job_id) for job_id in ids)))
+        if len(files) == 1:
+            # 不保存上传的文件，直接从上传时暂存的文件解码、缩放，调用模型时传缩放后的图片，再输出给信息确认页。
+            receipt = Receipt()
+            try:
+                processed = receipt.processImage(files[0].stream)
+            except ImageTooLargeError as e:
+                dictHint = {
+                    'message': str(e),
+                    'url' : '/',
+                    'link': '返回首页'
+                }
+                return render_template('hint.html', hint=dictHint), 413
+            img = processed['bytes']
+            data = receipt.storeImage(img)
+            # 与已保存的截图重复时不调用模型，提示用户查看已有记录或继续识别
+            data.update(receipt.findDuplicate(processed['hash']))
+            if 'duplicate_of' in data:
+                return render_template('edit.html', data=data)
+            return recognize_stream(receipt, img, data)
+        if files:
+            # 多张图片在线程池中并发识别，再在同一个页面中确认
             receipt = Receipt()
-            img = receipt.resize(image_bytes)
-            parsed_data = receipt.recognize(img)
-            # print(parsed_data)
-            return render_template('edit.html', data=parsed_data)
+            records = receipt.recognizeBatch([file.stream for file in files])
+            return render_template('edit_batch.html', records=records)
+        dictHint = {
+            'message': '请选择要上传的图片',
+            'url' : '/',
+            'link': '返回首页'
+        }
+        return render_template('hint.html', hint=dictHint)
     else:
-        # 展示最近记录的条数，如果有请求参数 num，展示 num 条记录，默认为10条
+        # 展示最近的记录，每页条数由请求参数 size 指定，默认为 Model.PAGE_EACH 条
+        # 有 after 游标时从游标位置接着往后读，否则按 page 页码读取，兼容旧链接
         page = request.args.get('page')
-        page = int(page) if page and page.isdigit() else 1
+        page = int(page) if page and page.isdigit() and int(page) > 0 else 1
+        size = Model.pageSize(request.args.get('size'))
+        after = request.args.get('after') or None
         receipt = Receipt()
-        res = receipt.listReceipts(page)
-        data = {'records': res, 'page': page}
+        try:
+            res = receipt.listReceipts(page, size, after)
+        except ValueError:
+            # 游标无效（如被手工改过），回到第一页
+            after = None
+            res = receipt.listReceipts(1, size)
+        data = {'records': res, 'page': page, 'size': size, 'after': after, 'next': receipt.nextCursor(res, size)}
         # print(res)
         return render_template('index.html', data=data, page=page)
 
@@ -83,18 +216,44 @@ def edit():
         print(res)
         return render_template('edit.html', data=res)
 
+# 解码之前检查上传的文件，只读文件头和文件长度
+# return: 有不合格的文件时返回 (提示, HTTP 状态码)，格式不支持为 415，文件太大为 413；都合格时返回 None
+def upload_error(files):
+    for file in files:
+        try:
+            ImagePipeline.check_upload(file.stream, Model.UPLOAD_MAX_BYTES)
+        except UnsupportedImageError as e:
+            return f"{file.filename}：{e}", 415
+        except ImageTooLargeError as e:
+            return f"{file.filename}：{e}", 413
+    return None
+
+# 先输出带图片预览的空白编辑页，模型每识别出一个字段就输出一段脚本把它填进表单
+def recognize_stream(receipt, img, data):
+    response = Response(stream_template('edit.html', data=data, fields=receipt.recognizeStream(img)))
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/recognize/<blob_hash>')
+def recognize_again(blob_hash):
+    # 被判断为重复的截图，用户确认不是同一笔交易时继续识别，图片已经处理过并存在 BlobStore 中
+    path = BlobStore.instance().path(blob_hash)
+    if not path:
+        abort(404)
+    with open(path, 'rb') as f:
+        img = f.read()
+    data = {'preview_image': f'/img/{blob_hash}', 'source_image': blob_hash, 'image_hash': ImagePipeline.hash_bytes(img)}
+    return recognize_stream(Receipt(), img, data)
+
+# 从表单中读取一条记录，多条记录的批量确认页中字段名带有 _序号 后缀
+def form_record(form, suffix=''):
+    fields = ['transaction_time', 'income_amount', 'expense_amount', 'transaction_app',
+              'payment_platform', 'financial_terminal', 'memo', 'category', 'source_image', 'image_hash']
+    return {field: form.get(field + suffix) if form.get(field + suffix) else None for field in fields}
+
 @app.route('/save', methods=['POST'])
 def save():
-    record = {
-    'transaction_time': request.form.get('transaction_time') if request.form.get('transaction_time') else None,
-    'income_amount': request.form.get('income_amount') if request.form.get('income_amount') else None,
-    'expense_amount': request.form.get('expense_amount') if request.form.get('expense_amount') else None,
-    'transaction_app': request.form.get('transaction_app') if request.form.get('transaction_app') else None,
-    'payment_platform': request.form.get('payment_platform') if request.form.get('payment_platform') else None,
-    'financial_terminal': request.form.get('financial_terminal') if request.form.get('financial_terminal') else None,
-    'memo': request.form.get('memo') if request.form.get('memo') else None,
-    'category': request.form.get('category') if request.form.get('category') else None,
-    }
+    record = form_record(request.form)
 
     receipt = Receipt()
     res = receipt.save(record)
@@ -106,5 +265,210 @@ def save():
     }
     return render_template('hint.html', hint=dictHint)
 
+@app.route('/save_batch', methods=['POST'])
+def save_batch():
+    # 保存批量确认页中勾选的记录
+    count = request.form.get('count', '0')
+    count = int(count) if count.isdigit() else 0
+    receipt = Receipt()
+    saved = 0
+    for i in range(min(count, Model.UPLOAD_MAX_FILES)):
+        if not request.form.get(f'selected_{i}'):
+            continue
+        saved += receipt.save(form_record(request.form, f'_{i}'))
+    dictHint = {
+        'message': f'保存成功 {saved} 条',
+        'url' : '/',
+        'link': '返回首页'
+    }
+    return render_template('hint.html', hint=dictHint)
+
+@app.route('/export')
+def export():
+    # 流式导出全部记录，format 参数为 csv（默认）或 ndjson
+    # 不设置 Content-Length，由服务器按 chunked 分块传输，边读数据库边输出
+    fmt = request.args.get('format', Receipt.EXPORT_CSV)
+    if fmt not in (Receipt.EXPORT_CSV, Receipt.EXPORT_NDJSON):
+        dictHint = {
+            'message': '导出格式只支持 csv 和 ndjson',
+            'url' : '/',
+            'link': '返回首页'
+        }
+        return render_template('hint.html', hint=dictHint), 400
+    receipt = Receipt()
+    mimetype = 'text/csv' if fmt == Receipt.EXPORT_CSV else 'application/x-ndjson'
+    filename = f"accounting-{datetime.now().strftime('%Y%m%d%H%M%S')}.{fmt}"
+    headers = {
+        'Content-Disposition': f'attachment; filename={filename}',
+        # 告诉 nginx 不要缓冲响应，第一批数据直接发给客户端
+        'X-Accel-Buffering': 'no',
+    }
+    return Response(stream_with_context(receipt.exportReceipts(fmt)), mimetype=mimetype, headers=headers)
+
+@app.route('/import', methods=['GET', 'POST'])
+def import_csv():
+    # 批量导入 CSV，边读上传的文件边分批写入数据库，完成后显示导入报告
+    if request.method == 'POST':
+        file = request.files.get('file')
+        if not file:
+            dictHint = {
+                'message': '请选择要导入的 CSV 文件',
+                'url' : '/import',
+                'link': '返回导入页'
+            }
+            return render_template('hint.html', hint=dictHint)
+        # utf-8-sig 兼容 Excel 导出的带 BOM 的文件
+        lines = io.TextIOWrapper(file.stream, encoding='utf-8-sig', newline='')
+        receipt = Receipt()
+        report = receipt.importReceipts(lines)
+        print(report)
+        return render_template('import.html', report=report)
+    return render_template('import.html', report=None)
+
+@app.route('/summary')
+def summary():
+    # 按月份和类别的收支统计，直接读增量维护的 accounting_summary 表，耗时与记录总数无关
+    months = max(1, min(request.args.get('months', 12, type=int), 120))
+    data = []
+    for row in Summary().listSummary(months):
+        if not data or data[-1]['month'] != row['month']:
+            data.append({'month': row['month'], 'income_total': 0, 'expense_total': 0, 'record_count': 0, 'categories': []})
+        month = data[-1]
+        month['income_total'] += row['income_total']
+        month['expense_total'] += row['expense_total']
+        month['record_count'] += row['record_count']
+        month['categories'].append(row)
+    return render_template('summary.html', data=data, months=months)
+
+@app.route('/search')
+def search():
+    # 按关键词（消费应用、备注）、金额范围和日期范围搜索，结果按时间倒序，用 after 游标翻页
+    form = {key: request.args.get(key, '').strip() for key in ('q', 'min', 'max', 'from', 'to')}
+    size = Model.pageSize(request.args.get('size'))
+    data = {'records': [], 'size': size, 'next': '', 'error': '',
+            'query': urlencode({**{key: value for key, value in form.items() if value}, 'size': size})}
+    if any(form.values()):
+        receipt = Receipt()
+        try:
+            data['records'] = receipt.searchReceipts(form['q'], form['min'], form['max'], form['from'], form['to'],
+                                                     size, request.args.get('after') or None)
+        except ValueError as e:
+            data['error'] = f"搜索条件格式错误：{e}"
+            return render_template('search.html', data=data, form=form), 400
+        data['next'] = receipt.nextCursor(data['records'], size)
+    return render_template('search.html', data=data, form=form)
+
+@app.route('/analytics')
+def analytics():
+    # 收支趋势、类别和支付平台分布、最大支出和异常支出，都在内存中的列式副本上计算，不查数据库
+    # format=json 时返回 JSON，便于其它工具调用
+    form = {key: request.args.get(key, '').strip() for key in ('from', 'to')}
+    bucket = request.args.get('bucket', Analytics.BUCKET_MONTH)
+    window = max(1, min(request.args.get('window', 3, type=int), 52))
+    data = {'error': ''}
+    analytics = Analytics.instance()
+    try:
+        data.update({
+            'overview': analytics.overview(form['from'], form['to']),
+            'trend': analytics.trend(bucket, window, form['from'], form['to']),
+            'categories': analytics.breakdown('category', form['from'], form['to']),
+            'platforms': analytics.breakdown('payment_platform', form['from'], form['to']),
+            'top': analytics.top_expenses(10, form['from'], form['to']),
+            'anomalies': analytics.anomalies(form['from'], form['to']),
+        })
+    except ValueError as e:
+        data['error'] = f"查询条件格式错误：{e}"
+    status = 400 if data['error'] else 200
+    if request.args.get('format') == 'json':
+        return jsonify(data), status
+    return render_template('analytics.html', data=data, form=form, bucket=bucket, window=window), status
+
+# 后台识别任务队列，本进程的工作线程在第一次使用时启动
+def job_queue():
+    queue = JobQueue.instance()
+    queue.start(lambda image_bytes: Receipt().recognizeImage(image_bytes))
+    return queue
+
+@app.route('/jobs')
+def jobs():
+    # 后台识别任务的进度页，ids 为逗号分隔的任务 ID
+    ids = [int(job_id) for job_id in request.args.get('ids', '').split(',') if job_id.isdigit()]
+    return render_template('jobs.html', ids=ids[:Model.UPLOAD_MAX_FILES])
+
+@app.route('/jobs/status')
+def jobs_status():
+    # 一次查询一组任务的状态，进度页只用这一个请求轮询。带 wait 参数时等到其中任意一个任务结束，最多等 JOB_WAIT_MAX 秒
+    ids = [int(job_id) for job_id in request.args.get('ids', '').split(',') if job_id.isdigit()][:Model.UPLOAD_MAX_FILES]
+    wait = request.args.get('wait', '0')
+    wait = min(float(wait), JOB_WAIT_MAX) if wait.replace('.', '', 1).isdigit() else 0
+    queue = job_queue()
+    jobs = queue.wait_any(ids, wait) if wait > 0 and ids else [queue.get(job_id) for job_id in ids]
+    result = []
+    for job_id, job in zip(ids, jobs):
+        if not job:
+            job = {'id': job_id, 'error': 'job not found'}
+        # 识别结果通过编辑页查看，状态接口不返回大字段
+        job.pop('result', None)
+        result.append(job)
+    return jsonify({'jobs': result})
+
+@app.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    # 查询任务状态。带 wait 参数时长轮询，最多等 JOB_WAIT_MAX 秒，任务完成后立即返回
+    queue = job_queue()
+    wait = request.args.get('wait', '0')
+    wait = min(float(wait), JOB_WAIT_MAX) if wait.replace('.', '', 1).isdigit() else 0
+    job = queue.wait(job_id, wait) if wait > 0 else queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'job not found'}), 404
+    # 识别结果通过编辑页查看，状态接口不返回大字段
+    job.pop('result', None)
+    return jsonify(job)
+
+@app.route('/jobs/<int:job_id>/edit')
+def job_edit(job_id):
+    # 任务完成后进入信息确认页
+    job = job_queue().get(job_id)
+    if not job or job['status'] != JobQueue.STATUS_DONE:
+        dictHint = {
+            'message': '任务不存在或尚未完成' if not job or job['status'] != JobQueue.STATUS_FAILED else f"识别失败：{job['error']}",
+            'url' : '/',
+            'link': '返回首页'
+        }
+        return render_template('hint.html', hint=dictHint)
+    return render_template('edit.html', data=job['result'] or {})
+
+@app.route('/jobs/stats')
+def job_stats():
+    # 队列深度和任务耗时，用于评估需要多少工作线程
+    return jsonify(job_queue().stats())
+
+@app.route('/stats')
+def stats():
+    # 本进程的连接池和查询缓存状态，用于判断缓存命中率和连接池大小是否合适
+    return jsonify({'pool': Receipt.pool_stats(), 'query_cache': Receipt.cache_stats(),
+                    'duplicate_index': DuplicateIndex.instance().stats(),
+                    'merchant_memo': MerchantMemo.instance().stats()})
+
+@app.route('/img/<blob_hash>')
+def image(blob_hash):
+    # 按内容哈希读取图片，w 参数为缩略图宽度。内容永不改变，允许浏览器和 CDN 长期缓存
+    store = BlobStore.instance()
+    width = request.args.get('w', '')
+    if width:
+        path = store.thumbnail(blob_hash, int(width)) if width.isdigit() else None
+        mimetype = 'image/jpeg'
+    else:
+        path = store.path(blob_hash)
+        mimetype = None
+    if not path:
+        abort(404)
+    if mimetype is None:
+        with open(path, 'rb') as f:
+            mimetype = 'image/' + (ImagePipeline.sniff(f.read(8)) or Receipt.IMAGE_FORMAT)
+    response = send_file(path, mimetype=mimetype, etag=f'{blob_hash}-w{width}' if width else blob_hash, max_age=IMAGE_MAX_AGE, conditional=True)
+    response.headers['Cache-Control'] = f'public, max-age={IMAGE_MAX_AGE}, immutable'
+    return response
+
 if __name__ == '__main__':
    app.run(host='0.0.0.0', port=5000, debug=True)
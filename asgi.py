@@ -0,0 +1,152 @@
+"""
+异步部署入口：hypercorn asgi:application -b 0.0.0.0:5000
+
+上传识别（POST /）和保存（POST /save）由 Quart 的异步路由处理，调用模型和写数据库时不占用线程，
+一个进程可以同时处理几百个在等模型回答的请求；其它页面仍由 app.py 的 Flask 应用处理，
+经 asgiref 转换后在 ASGI_WSGI_THREADS 个线程的线程池中运行。不需要异步时照旧用 gunicorn app:app 部署。
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from quart import Quart, g, redirect, render_template, request
+from quart.formparser import FormDataParser
+from quart.wrappers import Request
+
+from app import app as flask_app, form_record, job_queue, upload_error
+from models.AsyncLlmQwen import AsyncLlmQwen
+from models.AsyncReceipt import AsyncReceipt
+from models.AsyncTable import AsyncTable
+from models.Metrics import Metrics
+from models.Model import Model
+
+
+
+class UploadFormDataParser(FormDataParser):
+    # 与 Flask 一样，上传的文件超过 UPLOAD_SPOOL_BYTES 时暂存到临时文件
+    def __init__(self, **kwargs):
+        super().__init__(stream_factory=Model.spoolUpload, **kwargs)
+
+
+class UploadRequest(Request):
+    form_data_parser_class = UploadFormDataParser
+
+
+quart_app = Quart(__name__)
+quart_app.request_class = UploadRequest
+quart_app.config['MAX_CONTENT_LENGTH'] = Model.UPLOAD_MAX_REQUEST_BYTES
+
+# 由 Quart 处理的 (方法, 路径)，其余请求交给 Flask
+ASYNC_ROUTES = {('POST', '/'), ('POST', '/save')}
+
+Metrics.gauge_stats('aifun_async_db_pool', 'Async MySQL connection pool state of this process', AsyncTable.async_pool_stats)
+
+@quart_app.before_request
+async def metrics_begin():
+    if Metrics.enabled:
+        g.metrics_begin = time.perf_counter()
+
+@quart_app.after_request
+async def metrics_end(response):
+    # 异步路由的响应都不是流式的，返回时即为完整耗时
+    begin = g.get('metrics_begin')
+    if begin is not None:
+        endpoint = request.url_rule.endpoint if request.url_rule else 'unmatched'
+        Metrics.observe('aifun_http_request_seconds', time.perf_counter() - begin,
+                        endpoint=endpoint, method=request.method, status=str(response.status_code))
+    return response
+
+@quart_app.after_serving
+async def close_clients():
+    await AsyncTable.close_pool()
+    await AsyncLlmQwen.close()
+
+@quart_app.errorhandler(413)
+async def request_too_large(e):
+    dictHint = {
+        'message': f'上传的文件总共不能超过 {Model.UPLOAD_MAX_REQUEST_BYTES / 1024 / 1024:g} MB',
+        'url' : '/',
+        'link': '返回首页'
+    }
+    return await render_template('hint.html', hint=dictHint), 413
+
+@quart_app.route('/', methods=['POST'])
+async def index():
+    # 与 app.py 的上传相同，但识别完成后一次返回确认页，不边识别边输出
+    files = [file for file in (await request.files).getlist('receipt') if file]
+    form = await request.form
+    if len(files) > Model.UPLOAD_MAX_FILES:
+        dictHint = {
+            'message': f'一次最多上传 {Model.UPLOAD_MAX_FILES} 张图片',
+            'url' : '/',
+            'link': '返回首页'
+        }
+        return await render_template('hint.html', hint=dictHint)
+    if not files:
+        dictHint = {
+            'message': '请选择要上传的图片',
+            'url' : '/',
+            'link': '返回首页'
+        }
+        return await render_template('hint.html', hint=dictHint)
+    error = upload_error(files)
+    if error:
+        dictHint = {
+            'message': error[0],
+            'url' : '/',
+            'link': '返回首页'
+        }
+        return await render_template('hint.html', hint=dictHint), error[1]
+    if form.get('async'):
+        queue = job_queue()
+        ids = [queue.enqueue(file.read()) for file in files]
+        # /jobs 页面由 Flask 处理
+        return redirect('/jobs?ids=' + ','.join(str(job_id) for job_id in ids))
+    records = await AsyncReceipt().recognizeImages([file.stream for file in files])
+    if len(files) > 1:
+        return await render_template('edit_batch.html', records=records)
+    if records[0].get('error'):
+        dictHint = {
+            'message': f"识别失败：{records[0]['error']}",
+            'url' : '/',
+            'link': '返回首页'
+        }
+        return await render_template('hint.html', hint=dictHint)
+    return await render_template('edit.html', data=records[0])
+
+@quart_app.route('/save', methods=['POST'])
+async def save():
+    record = form_record(await request.form)
+    res = await AsyncReceipt().saveAsync(record)
+    print(res)
+    dictHint = {
+        'message': '保存成功',
+        'url' : '/',
+        'link': '返回首页'
+    }
+    return await render_template('hint.html', hint=dictHint)
+
+class ThreadPoolWsgiInstance(WsgiToAsgiInstance):
+    # asgiref 默认按 thread_sensitive 在同一个线程上依次运行 WSGI 应用，一个长轮询或流式下载会挡住其它所有页面；
+    # 这里改为在独立的线程池中运行，各请求互不阻塞
+    executor = ThreadPoolExecutor(max_workers=int(os.environ.get("ASGI_WSGI_THREADS") or 32),
+                                  thread_name_prefix='wsgi')
+    run_wsgi_app = sync_to_async(WsgiToAsgiInstance.__dict__['run_wsgi_app'].func, thread_sensitive=False,
+                                 executor=executor)
+
+
+class ThreadPoolWsgiToAsgi(WsgiToAsgi):
+    async def __call__(self, scope, receive, send):
+        await ThreadPoolWsgiInstance(self.wsgi_application, self.duplicate_header_limit)(scope, receive, send)
+
+
+flask_asgi = ThreadPoolWsgiToAsgi(flask_app)
+
+async def application(scope, receive, send):
+    # lifespan 事件交给 Quart，服务停止时关闭异步连接池和 HTTP 客户端
+    if scope['type'] == 'lifespan' or (scope['type'] == 'http' and (scope['method'], scope['path']) in ASYNC_ROUTES):
+        await quart_app(scope, receive, send)
+    else:
+        await flask_asgi(scope, receive, send)
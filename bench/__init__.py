@@ -0,0 +1 @@
+# 离线压测：python -m bench.run，用模拟的 MySQL 和 DashScope 代替真实服务
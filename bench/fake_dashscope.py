@@ -0,0 +1,184 @@
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 客户端关闭长连接时不打印异常堆栈
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+class FakeDashScope:
+    """
+    模拟 DashScope 兼容模式的 /chat/completions 接口，用于离线压测，不消耗 API 配额。
+    可以配置响应延迟、一定比例的 429 限流和流式输出的分段间隔。
+    """
+    # 返回的识别结果，字段与 Receipt.PROMPT 要求的一致
+    ANSWER = {
+        "transaction_time": "2025-02-15 12:30:00",
+        "income_amount": None,
+        "expense_amount": 99.99,
+        "transaction_app": "拼多多",
+        "payment_platform": "微信",
+        "financial_terminal": "信用卡",
+        "memo": "订单号：987654321",
+        "category": "餐饮",
+    }
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.5, error_rate: float = 0,
+                 retry_after: float = 0, chunk_delay: float = 0.02, chunks: int = 16):
+        """
+        :param port: 监听端口，0 表示随机选一个空闲端口
+        :param latency: 收到请求到开始响应的秒数（流式时为第一段之前的等待）
+        :param error_rate: 返回 429 的比例，0-1
+        :param retry_after: 429 响应的 Retry-After 秒数
+        :param chunk_delay: 流式输出每段之间的秒数
+        :param chunks: 流式输出把回答分成几段
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.chunk_delay = chunk_delay
+        self.chunks = chunks
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.server = _QuietServer((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/compatible-mode/v1/chat/completions"
+
+    def start(self) -> 'FakeDashScope':
+        self._thread = threading.Thread(target=self.server.serve_forever, name='fake-dashscope', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'requests': self.requests, 'throttled': self.throttled}
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                payload = json.loads(self.rfile.read(length) or b'{}')
+                with fake._lock:
+                    fake.requests += 1
+                    throttle = random.random() < fake.error_rate
+                    if throttle:
+                        fake.throttled += 1
+                if throttle:
+                    self._send_json(429, {"error": {"code": "Throttling", "message": "Requests rate limit exceeded"}},
+                                    {'Retry-After': str(fake.retry_after)})
+                    return
+                time.sleep(fake.latency)
+                # 一次发送多张图片时，按合并识别的要求返回带 index 的数组
+                images = sum(1 for message in payload.get('messages', []) if isinstance(message.get('content'), list)
+                             for part in message['content'] if part.get('type') == 'image_url')
+                if images == 0:
+                    # 纯文本请求（判断类别）只返回类别名称
+                    answer = fake.ANSWER.get('category') or '餐饮'
+                elif images > 1:
+                    answer = json.dumps([{"index": i, **fake.ANSWER} for i in range(1, images + 1)], ensure_ascii=False, indent=2)
+                else:
+                    answer = json.dumps(fake.ANSWER, ensure_ascii=False, indent=2)
+                if payload.get('stream'):
+                    usage = fake._usage(payload, answer) if (payload.get('stream_options') or {}).get('include_usage') else None
+                    self._send_stream(payload.get('model', ''), answer, usage)
+                else:
+                    self._send_json(200, {
+                        "id": "chatcmpl-fake",
+                        "object": "chat.completion",
+                        "model": payload.get('model', ''),
+                        "choices": [{"index": 0, "finish_reason": "stop",
+                                     "message": {"role": "assistant", "content": answer}}],
+                        "usage": fake._usage(payload, answer),
+                    })
+
+            def _send_json(self, status, body, headers=None):
+                data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_stream(self, model, answer, usage=None):
+                self.send_response(200)
+                # 与 DashScope 一样不带 charset，验证客户端自己按 UTF-8 解码
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                size = max(1, -(-len(answer) // fake.chunks))
+                for i in range(0, len(answer), size):
+                    event = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "model": model,
+                             "choices": [{"index": 0, "delta": {"content": answer[i:i + size]}}]}
+                    self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode('utf-8'))
+                    time.sleep(fake.chunk_delay)
+                if usage:
+                    # 与 DashScope 一样，用量在最后一个 choices 为空的数据块中返回
+                    event = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "model": model,
+                             "choices": [], "usage": usage}
+                    self._write_chunk(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+                self._write_chunk(b"data: [DONE]\n\n")
+                self._write_chunk(b"")
+
+            def _write_chunk(self, data):
+                self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+    @staticmethod
+    def _usage(payload, answer):
+        # 粗略估算 token 数，只用于压测报告
+        prompt = json.dumps(payload.get('messages', []), ensure_ascii=False)
+        prompt_tokens = len(prompt) // 4
+        completion_tokens = len(answer) // 2
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens}
+
+
+if __name__ == '__main__':
+    # 单独运行：python -m bench.fake_dashscope --port 8765 --latency 1.5
+    # 然后设置 QWEN_BASE_URL=http://127.0.0.1:8765/compatible-mode/v1/chat/completions 和任意 QWEN_KEY 启动应用
+    parser = argparse.ArgumentParser(description='Fake DashScope chat completions server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.5)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--retry-after', type=float, default=0)
+    parser.add_argument('--chunk-delay', type=float, default=0.02)
+    parser.add_argument('--chunks', type=int, default=16)
+    args = parser.parse_args()
+    fake = FakeDashScope(args.host, args.port, args.latency, args.error_rate, args.retry_after,
+                         args.chunk_delay, args.chunks)
+    print(f"Fake DashScope listening on {fake.url}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        fake.server.server_close()
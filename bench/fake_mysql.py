@@ -0,0 +1,133 @@
+import datetime
+import re
+import threading
+import time
+from decimal import Decimal
+
+from models.ConnectionPool import ConnectionPool
+
+
+class FakeMySQL:
+    """
+    替代 MySQL 的内存数据源，用于离线压测 Table、连接池和页面，不需要真实数据库。
+    SELECT 按 LIMIT 返回预先生成的 accounting 记录，其它语句只记录次数；每条语句可以加固定延迟模拟网络往返。
+    """
+    FIELDS = ('id', 'transaction_time', 'income_amount', 'expense_amount', 'transaction_app', 'payment_platform',
+              'financial_terminal', 'memo', 'category', 'source_image', 'image_hash')
+    LIMIT_PATTERN = re.compile(r'LIMIT\s+(\d+)(?:\s*,\s*(\d+))?\s*$', re.IGNORECASE)
+
+    def __init__(self, rows: int = 1000, latency: float = 0.0):
+        """
+        :param rows: 生成的记录数
+        :param latency: 每条语句的延迟秒数
+        """
+        self.latency = latency
+        self.rows = [self._row(i) for i in range(rows, 0, -1)]
+        self._lock = threading.Lock()
+        self.statements = {}
+
+    @staticmethod
+    def _row(i):
+        time_value = datetime.datetime(2025, 1, 1) + datetime.timedelta(minutes=37 * i)
+        return (i, time_value, None if i % 5 else Decimal('1000.00'), Decimal(f'{i % 300}.{i % 100:02d}'),
+                '拼多多', '微信', '信用卡', f'订单号：{987654321 + i}', ('餐饮', '交通', '购物')[i % 3], None, None)
+
+    def connect(self) -> 'FakeConnection':
+        return FakeConnection(self)
+
+    def install(self, max_size: int = 5, timeout: float = 10) -> ConnectionPool:
+        """
+        把进程内共享的连接池换成连接本数据源的连接池，之后所有 Table 实例都使用它
+        """
+        pool = ConnectionPool(self.connect, max_size=max_size, timeout=timeout)
+        with ConnectionPool._instance_lock:
+            ConnectionPool._instance = pool
+        return pool
+
+    def execute(self, sql: str):
+        """
+        :return: (字段名列表, 行列表)，不是查询语句时字段名为 None
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        verb = sql.lstrip()[:6].upper()
+        with self._lock:
+            self.statements[verb] = self.statements.get(verb, 0) + 1
+        if verb != 'SELECT':
+            return None, []
+        if '@@max_allowed_packet' in sql:
+            return ['@@max_allowed_packet'], [(64 * 1024 * 1024,)]
+        rows = self.rows
+        match = self.LIMIT_PATTERN.search(sql)
+        if match:
+            if match.group(2) is None:
+                rows = rows[:int(match.group(1))]
+            else:
+                start = int(match.group(1))
+                rows = rows[start:start + int(match.group(2))]
+        return list(self.FIELDS), rows
+
+
+class FakeConnection:
+    def __init__(self, db: FakeMySQL):
+        self.db = db
+        self.open = True
+
+    def cursor(self, cursor_class=None):
+        return FakeCursor(self.db, cursor_class)
+
+    def ping(self, reconnect=True):
+        pass
+
+    def begin(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.open = False
+
+
+class FakeCursor:
+    def __init__(self, db: FakeMySQL, cursor_class=None):
+        self.db = db
+        # Table 使用 RowCursor 时，与真实游标一样由它的 row_maker 把元组转换成结果行
+        self.row_maker = getattr(cursor_class, 'row_maker', None)
+        self.row_type = getattr(cursor_class, 'row_type', None)
+        self.description = None
+        self.rowcount = 0
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def execute(self, sql, args=None):
+        fields, rows = self.db.execute(sql)
+        self.description = [(field,) for field in fields] if fields else None
+        if fields and self.row_maker:
+            make_row = self.row_maker(tuple(fields), self.row_type)
+            rows = [make_row(row) for row in rows]
+        self._rows = rows
+        self.rowcount = len(rows) if fields else 1
+        return self.rowcount
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchmany(self, size):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def fetchone(self):
+        return self.fetchmany(1)[0] if self._rows else None
+
+    def close(self):
+        self._rows = []
@@ -0,0 +1,420 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from PIL import Image, ImageDraw
+
+# 压测前先配置好环境变量，模块在第一次使用时读取
+os.environ.setdefault('QWEN_KEY', 'bench')
+os.environ.setdefault('QWEN_BACKOFF_BASE', '0.05')
+# 关闭识别结果缓存，否则同一张图片只有第一次会调用模型
+os.environ['RECOGNITION_CACHE_SIZE'] = '0'
+os.environ.pop('RECOGNITION_CACHE_DIR', None)
+os.environ.setdefault('BLOB_DIR', tempfile.mkdtemp(prefix='aifun-bench-blobs-'))
+os.environ.setdefault('JOB_QUEUE_PATH', os.path.join(tempfile.mkdtemp(prefix='aifun-bench-jobs-'), 'jobs.sqlite3'))
+
+from .fake_dashscope import FakeDashScope
+from .fake_mysql import FakeMySQL
+
+SUITES = ('table', 'resize', 'e2e', 'asgi')
+# asgi 需要 requirements-async.txt 中的依赖，默认不运行
+DEFAULT_SUITES = ('table', 'resize', 'e2e')
+# 比较两次结果时，名称以这些后缀结尾的指标越小越好，其余（如 per_second）越大越好
+LOWER_IS_BETTER = ('_ms', '_bytes', 'errors')
+
+
+def summarize(samples_ms: list) -> dict:
+    """
+    耗时样本（毫秒）的统计值
+    """
+    if not samples_ms:
+        return {'count': 0}
+    samples = sorted(samples_ms)
+
+    def percentile(p):
+        return round(samples[min(len(samples) - 1, int(len(samples) * p))], 3)
+
+    return {
+        'count': len(samples),
+        'mean_ms': round(sum(samples) / len(samples), 3),
+        'p50_ms': percentile(0.5),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'max_ms': round(samples[-1], 3),
+    }
+
+
+def repeat(func, times: int) -> list:
+    samples = []
+    for _ in range(times):
+        begin = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - begin) * 1000)
+    return samples
+
+
+def concurrent(func, requests: int, concurrency: int) -> dict:
+    """
+    用 concurrency 个线程一共执行 func requests 次，func 返回本次的附加耗时指标（如首字节时间），可以为 None
+    """
+    samples = []
+    extra = {}
+    errors = []
+    lock = threading.Lock()
+
+    def one(i):
+        begin = time.perf_counter()
+        try:
+            result = func(i)
+        except Exception as e:
+            with lock:
+                errors.append(repr(e))
+            return
+        elapsed = (time.perf_counter() - begin) * 1000
+        with lock:
+            samples.append(elapsed)
+            for key, value in (result or {}).items():
+                extra.setdefault(key, []).append(value)
+
+    wall_begin = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(one, range(requests)))
+    wall = time.perf_counter() - wall_begin
+    result = summarize(samples)
+    result['requests_per_second'] = round(len(samples) / wall, 2) if wall > 0 else 0.0
+    result['errors'] = len(errors)
+    if errors:
+        result['first_error'] = errors[0]
+    for key, values in extra.items():
+        result[key] = summarize(values)
+    return result
+
+
+def screenshot(seed: int, width: int = 1080, height: int = 2340) -> bytes:
+    """
+    生成一张类似手机支付截图的 PNG：白底、顶部色块和若干行文字
+    """
+    rng = random.Random(seed)
+    image = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((0, 0, width, 180), fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    y = 260
+    while y < height * 0.7:
+        draw.text((80, y), f"Order {rng.randrange(10 ** 9)}   {rng.randrange(1000)}.{rng.randrange(100):02d}",
+                  fill=(40, 40, 40))
+        y += rng.choice((60, 90, 140))
+    with io.BytesIO() as output:
+        image.save(output, format='PNG')
+        return output.getvalue()
+
+
+def photo(seed: int, width: int = 3024, height: int = 4032) -> bytes:
+    """
+    生成一张类似手机拍摄小票的 JPEG：有噪点的灰色背景上一块白色纸面
+    """
+    rng = random.Random(seed)
+    image = Image.effect_noise((width // 4, height // 4), 40).convert('RGB').resize((width, height))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((width // 5, height // 8, width * 4 // 5, height * 7 // 8), fill=(245, 245, 240))
+    for y in range(height // 8 + 100, height * 7 // 8 - 100, 120):
+        draw.text((width // 5 + 80, y), f"ITEM {rng.randrange(1000)}  {rng.randrange(100)}.00", fill=(20, 20, 20))
+    with io.BytesIO() as output:
+        image.save(output, format='JPEG', quality=92)
+        return output.getvalue()
+
+
+def load_corpus(directory: str, count: int) -> list:
+    """
+    读取样本目录中的截图，没有指定目录时生成截图和照片各一半
+    :return: [(名称, 图片字节), ...]
+    """
+    if directory:
+        names = sorted(name for name in os.listdir(directory)
+                       if name.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')))
+        images = []
+        for name in names:
+            with open(os.path.join(directory, name), 'rb') as f:
+                images.append((name, f.read()))
+        if not images:
+            raise SystemExit(f"No images found in {directory}")
+        return images
+    return [(f'screenshot-{i}.png', screenshot(i)) if i % 2 == 0 else (f'photo-{i}.jpg', photo(i))
+            for i in range(count)]
+
+
+def bench_table(args) -> dict:
+    from models.Table import Table
+
+    db = FakeMySQL(rows=max(args.rows, 500), latency=0)
+    db.install(max_size=args.concurrency)
+    results = {}
+
+    def get_one():
+        Table('accounting').select('*').where('category', '=', '餐饮') \
+            .seek(['transaction_time', 'id'], ['2025-02-15 12:30:00', 123]).order_by('transaction_time', 'DESC', 'id', 'DESC') \
+            .limit(1).get()
+
+    # 构建 SQL、借还连接和转换一行的开销
+    results['get_1row'] = summarize(repeat(get_one, args.iterations))
+
+    def get_page():
+        Table('accounting').select('*').order_by('transaction_time', 'DESC').limit(0, 500).get()
+
+    samples = repeat(get_page, max(1, args.iterations // 20))
+    results['get_500rows'] = summarize(samples)
+    results['get_500rows']['rows_per_second'] = round(500 * len(samples) / (sum(samples) / 1000), 1)
+
+    def get_page_tuple():
+        Table('accounting').select('*').order_by('transaction_time', 'DESC').limit(0, 500).get(Table.ROW_TUPLE)
+
+    # 同样 500 行，结果行为 namedtuple
+    samples = repeat(get_page_tuple, max(1, args.iterations // 20))
+    results['get_500rows_tuple'] = summarize(samples)
+    results['get_500rows_tuple']['rows_per_second'] = round(500 * len(samples) / (sum(samples) / 1000), 1)
+
+    def iterate():
+        for _ in Table('accounting').select('*').iter():
+            pass
+
+    samples = repeat(iterate, 5)
+    results['iter_all'] = summarize(samples)
+    results['iter_all']['rows_per_second'] = round(len(db.rows) * len(samples) / (sum(samples) / 1000), 1)
+
+    # 把 500 行转成一条批量 INSERT 语句的开销
+    table = Table('accounting')
+    records = [dict(zip(FakeMySQL.FIELDS[1:], row[1:])) for row in db.rows[:500]]
+    results['insert_500rows'] = summarize(repeat(lambda: table.insert(records), 50))
+    return results
+
+
+def bench_resize(args) -> dict:
+    from models.Receipt import Receipt
+
+    FakeMySQL(rows=10).install()
+    images = load_corpus(args.corpus, args.images)
+    receipt = Receipt()
+    samples = []
+    bytes_in = 0
+    bytes_out = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(args.resize_rounds):
+            for name, image_bytes in images:
+                begin = time.perf_counter()
+                output = receipt.resize(image_bytes)
+                samples.append((time.perf_counter() - begin) * 1000)
+                bytes_in += len(image_bytes)
+                bytes_out += len(output)
+    result = summarize(samples)
+    result['images_per_second'] = round(len(samples) / (sum(samples) / 1000), 2)
+    result['mean_input_bytes'] = bytes_in // len(samples)
+    result['mean_output_bytes'] = bytes_out // len(samples)
+    return {'resize': result}
+
+
+def bench_e2e(args) -> dict:
+    import app as application
+
+    db = FakeMySQL(rows=args.rows, latency=args.db_latency)
+    db.install(max_size=args.pool_size)
+    fake = FakeDashScope(latency=args.llm_latency, error_rate=args.error_rate, chunk_delay=args.chunk_delay).start()
+    os.environ['QWEN_BASE_URL'] = fake.url
+    images = load_corpus(args.corpus, min(args.images, 4))
+    flask_app = application.app
+    local = threading.local()
+
+    def client():
+        if not hasattr(local, 'client'):
+            local.client = flask_app.test_client()
+        return local.client
+
+    def upload(i):
+        name, image_bytes = images[i % len(images)]
+        begin = time.perf_counter()
+        response = client().post('/', data={'receipt': (io.BytesIO(image_bytes), name)},
+                                 content_type='multipart/form-data', buffered=False)
+        ttfb = None
+        for chunk in response.response:
+            if ttfb is None:
+                ttfb = (time.perf_counter() - begin) * 1000
+        response.close()
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}")
+        return {'first_byte': ttfb}
+
+    def save(i):
+        form = dict(FakeDashScope.ANSWER, expense_amount=f'{i}.00', transaction_time=f'2025-03-01 10:{i % 60:02d}:00')
+        response = client().post('/save', data={key: value or '' for key, value in form.items()})
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}")
+
+    def index(i):
+        response = client().get('/?size=20')
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}")
+
+    results = {}
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            results['upload'] = concurrent(upload, args.requests, args.concurrency)
+            results['save'] = concurrent(save, args.requests, args.concurrency)
+            results['index'] = concurrent(index, args.requests, args.concurrency)
+    finally:
+        fake.stop()
+    results['upload']['llm'] = fake.stats()
+    results['pool'] = application.Receipt.pool_stats()
+    return results
+
+
+def bench_asgi(args) -> dict:
+    """
+    经 asgi:application 并发请求 Flask 页面，检查它们是在线程池中同时运行，而不是在一个线程上排队
+    """
+    import asyncio
+
+    import asgi
+
+    db = FakeMySQL(rows=args.rows, latency=args.db_latency)
+    db.install(max_size=max(args.pool_size, args.concurrency))
+
+    async def get(path, query):
+        scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+                 'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': query.encode(),
+                 'root_path': '', 'headers': [(b'host', b'bench')], 'client': ('127.0.0.1', 0),
+                 'server': ('bench', 80)}
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        begin = time.perf_counter()
+        await asgi.application(scope, receive, send)
+        if messages[0]['status'] != 200:
+            raise RuntimeError(f"HTTP {messages[0]['status']}")
+        return (time.perf_counter() - begin) * 1000
+
+    async def run():
+        return await asyncio.gather(*(get('/', 'size=20') for _ in range(args.concurrency)))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        single = asyncio.run(get('/', 'size=20'))
+        wall_begin = time.perf_counter()
+        samples = asyncio.run(run())
+        wall = (time.perf_counter() - wall_begin) * 1000
+    result = summarize(samples)
+    # 逐个请求所需时间与实际总耗时之比，同时运行时接近并发数，在一个线程上排队时约为 1
+    result['parallelism'] = round(len(samples) * single / wall, 2)
+    if args.concurrency > 1 and result['parallelism'] < 1.5:
+        raise RuntimeError(f"Flask pages behind asgi:application ran one at a time (parallelism {result['parallelism']})")
+    return {'flask_pages': result}
+
+
+def flatten(results: dict, prefix: str = '') -> dict:
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(old: dict, new: dict, threshold: float) -> list:
+    """
+    比较两次的结果，打印变化，返回变差超过 threshold（比例）的指标
+    """
+    old_flat = flatten(old.get('results', {}))
+    new_flat = flatten(new.get('results', {}))
+    regressions = []
+    print(f"{'metric':<48} {'old':>12} {'new':>12} {'change':>8}")
+    for name in sorted(set(old_flat) & set(new_flat)):
+        # 最大值和 p99 在样本少时波动很大，不参与比较
+        if name.endswith(('.count', '.max_ms', '.p99_ms')) or '.pool.' in name or '.llm.' in name:
+            continue
+        before, after = old_flat[name], new_flat[name]
+        if before == 0:
+            continue
+        change = (after - before) / abs(before)
+        worse = change > threshold if name.endswith(LOWER_IS_BETTER) else change < -threshold
+        flag = '  REGRESSION' if worse else ''
+        print(f"{name:<48} {before:>12.3f} {after:>12.3f} {change:>+7.1%}{flag}")
+        if worse:
+            regressions.append(name)
+    return regressions
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmarks with fake MySQL and DashScope')
+    parser.add_argument('--suite', nargs='+', choices=SUITES, default=list(DEFAULT_SUITES))
+    parser.add_argument('--output', default='bench-results.json', help='machine-readable results file')
+    parser.add_argument('--compare', help='previous results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change reported as a regression')
+    parser.add_argument('--corpus', help='directory of sample screenshots; generated when omitted')
+    parser.add_argument('--images', type=int, default=8, help='number of generated images')
+    parser.add_argument('--resize-rounds', type=int, default=2)
+    parser.add_argument('--iterations', type=int, default=2000, help='iterations of the Table micro benchmarks')
+    parser.add_argument('--rows', type=int, default=10000, help='rows in the fake accounting table')
+    parser.add_argument('--requests', type=int, default=40, help='requests per end-to-end route')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--pool-size', type=int, default=5, help='MySQL connection pool size')
+    parser.add_argument('--db-latency', type=float, default=0.002, help='seconds per fake SQL statement')
+    parser.add_argument('--llm-latency', type=float, default=0.5, help='seconds before the fake model answers')
+    parser.add_argument('--chunk-delay', type=float, default=0.02, help='seconds between streamed chunks')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of model calls answered with 429')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for suite in SUITES:
+        if suite in args.suite:
+            print(f"Running {suite} ...", file=sys.stderr)
+            results[suite] = globals()[f'bench_{suite}'](args)
+
+    report = {
+        'meta': {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    print(f"Results written to {args.output}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            regressions = compare(json.load(f), report, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} metrics regressed by more than {args.threshold:.0%}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
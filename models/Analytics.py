@@ -0,0 +1,325 @@
+import datetime
+import threading
+import time
+
+import numpy as np
+
+from .Table import Table
+
+
+class Analytics:
+    """
+    accounting 表在内存中的列式副本，用于统计页面的即席查询。
+    每个字段是一个 NumPy 数组：时间为 datetime64，金额为 float64，类别、支付平台、金融终端、消费应用按字典编码成整数，
+    分组、按时间分桶、排行都用向量运算完成，几万条记录的查询在毫秒内返回。
+    第一次查询时加载全表，之后按 id 增量读取新记录；本进程编辑记录时直接改数组，其它进程的编辑在定期全量重新加载时生效。
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    # 距上次读取新记录超过该秒数时，查询前先增量刷新
+    REFRESH_SECONDS = 30
+    # 距上次全量加载超过该秒数时重新加载，带上其它进程编辑过的记录
+    RELOAD_SECONDS = 600
+    # 按字典编码的字段，编码 0 表示空值
+    DICT_FIELDS = ('category', 'payment_platform', 'financial_terminal', 'transaction_app')
+    # 按时间分桶的粒度
+    BUCKET_DAY = 'day'
+    BUCKET_WEEK = 'week'
+    BUCKET_MONTH = 'month'
+    # 异常支出：金额的对数比同一类别其它记录的均值高出 ANOMALY_Z 个标准差，且同类别的其它记录至少有 ANOMALY_MIN_COUNT 条
+    ANOMALY_Z = 3.0
+    ANOMALY_MIN_COUNT = 5
+    # 标准差的下限（对数尺度，约 10%），其它记录金额都相同时不会因为标准差为 0 而无法判断
+    ANOMALY_MIN_STD = 0.1
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # 保证同一时间只有一个线程从数据库刷新
+        self._refresh_lock = threading.Lock()
+        self._columns = self._empty()
+        # 字段 -> 取值列表，下标即编码；字段 -> {取值: 编码}
+        self._values = {field: [''] for field in self.DICT_FIELDS}
+        self._codes = {field: {'': 0} for field in self.DICT_FIELDS}
+        self._last_id = 0
+        self._refreshed = 0.0
+        self._reloaded = 0.0
+        self._queries = 0
+
+    @classmethod
+    def instance(cls) -> 'Analytics':
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def _empty(self) -> dict:
+        columns = {
+            'id': np.empty(0, dtype=np.int64),
+            'time': np.empty(0, dtype='datetime64[s]'),
+            'income': np.empty(0, dtype=np.float64),
+            'expense': np.empty(0, dtype=np.float64),
+        }
+        for field in self.DICT_FIELDS:
+            columns[field] = np.empty(0, dtype=np.int32)
+        return columns
+
+    @staticmethod
+    def _encode(values: list, codes: dict, value) -> int:
+        value = str(value or '').strip()
+        code = codes.get(value)
+        if code is None:
+            code = len(values)
+            codes[value] = code
+            values.append(value)
+        return code
+
+    @staticmethod
+    def _amount(value) -> float:
+        return float(value) if value not in (None, '') else 0.0
+
+    def refresh(self, wait: bool = True):
+        """
+        读取上次之后新增的记录追加到各列；距上次全量加载超过 RELOAD_SECONDS 时从头加载。
+        同一时间只有一个线程刷新，读数据库时不持有 _lock，查询、update() 和 stats() 不用等数据库
+        :param wait: 其它线程正在刷新时是否等它完成；为 False 时直接返回，继续使用已加载的数据
+        """
+        if not self._refresh_lock.acquire(blocking=wait):
+            return
+        try:
+            # 等待期间其它线程可能已经刷新过了
+            if time.monotonic() - self._refreshed <= self.REFRESH_SECONDS:
+                return
+            self._refresh()
+        finally:
+            # 刷新结束（包括失败）后才更新时间，等在锁上的线程看到它就不再重复刷新
+            self._refreshed = time.monotonic()
+            self._refresh_lock.release()
+
+    def _refresh(self):
+        now = time.monotonic()
+        full = now - self._reloaded > self.RELOAD_SECONDS
+        last_id = 0 if full else self._last_id
+        table = Table('accounting')
+        table.select('id', 'transaction_time', 'income_amount', 'expense_amount', *self.DICT_FIELDS)
+        if last_id:
+            table.where('id', '>', str(last_id))
+        ids, times, incomes, expenses = [], [], [], []
+        texts = {field: [] for field in self.DICT_FIELDS}
+        try:
+            for row in table.order_by('id', 'ASC').iter(row_type=Table.ROW_TUPLE):
+                ids.append(row.id)
+                times.append(row.transaction_time or None)
+                incomes.append(self._amount(row.income_amount))
+                expenses.append(self._amount(row.expense_amount))
+                for field in self.DICT_FIELDS:
+                    texts[field].append(getattr(row, field))
+        except Exception as e:
+            # 数据库暂时不可用时继续使用已加载的数据
+            print(f"Failed to load analytics columns: {e}")
+            return
+        chunk = {
+            'id': np.array(ids, dtype=np.int64),
+            'time': np.array(times, dtype='datetime64[s]'),
+            'income': np.array(incomes, dtype=np.float64),
+            'expense': np.array(expenses, dtype=np.float64),
+        }
+        if full:
+            # 全量加载时字典从头编码，与新的各列一起替换，查询不会拿到对不上的编码
+            values = {field: [''] for field in self.DICT_FIELDS}
+            dicts = {field: {'': 0} for field in self.DICT_FIELDS}
+            for field in self.DICT_FIELDS:
+                chunk[field] = np.array([self._encode(values[field], dicts[field], text) for text in texts[field]],
+                                        dtype=np.int32)
+            with self._lock:
+                self._columns = chunk
+                self._values, self._codes = values, dicts
+                self._reloaded = now
+                self._last_id = ids[-1] if ids else 0
+            return
+        if not ids:
+            return
+        # 增量的行数少，在锁内按当前字典编码，与 update() 新增的编码不会冲突
+        with self._lock:
+            for field in self.DICT_FIELDS:
+                chunk[field] = np.array([self._encode(self._values[field], self._codes[field], text)
+                                         for text in texts[field]], dtype=np.int32)
+            self._columns = {name: np.concatenate((self._columns[name], chunk[name])) for name in chunk}
+            self._last_id = ids[-1]
+
+    def update(self, record: dict):
+        """
+        本进程编辑记录后更新对应的一行，不用等下次全量加载
+        :param record: 编辑后的完整记录，需要有 id
+        """
+        with self._lock:
+            columns = self._columns
+            record_id = int(record.get('id') or 0)
+            # 各列按 id 升序排列，二分查找行号
+            index = int(np.searchsorted(columns['id'], record_id))
+            if index >= len(columns['id']) or columns['id'][index] != record_id:
+                return
+            try:
+                columns['time'][index] = np.datetime64(str(record.get('transaction_time') or 'NaT'), 's')
+            except ValueError:
+                columns['time'][index] = np.datetime64('NaT', 's')
+            columns['income'][index] = self._amount(record.get('income_amount'))
+            columns['expense'][index] = self._amount(record.get('expense_amount'))
+            for field in self.DICT_FIELDS:
+                columns[field][index] = self._encode(self._values[field], self._codes[field], record.get(field))
+
+    def _snapshot(self):
+        # 需要时先刷新，再取各列和字典的引用；刷新只替换整个字典，查询过程中不受影响
+        # 还没有加载过时等第一次加载完成，之后其它线程正在刷新时直接用已加载的数据
+        if time.monotonic() - self._refreshed > self.REFRESH_SECONDS:
+            self.refresh(wait=not self._reloaded)
+        with self._lock:
+            self._queries += 1
+            return self._columns, {field: list(values) for field, values in self._values.items()}
+
+    @staticmethod
+    def _mask(columns: dict, date_from: str = None, date_to: str = None):
+        """
+        :param date_from: 开始日期（含），如 2025-01-01
+        :param date_to: 结束日期（含）
+        :return: 时间在范围内的行的布尔数组
+        :raises ValueError: 日期格式不对
+        """
+        times = columns['time']
+        mask = ~np.isnat(times)
+        if date_from:
+            mask &= times >= np.datetime64(datetime.date.fromisoformat(date_from), 's')
+        if date_to:
+            mask &= times < np.datetime64(datetime.date.fromisoformat(date_to) + datetime.timedelta(days=1), 's')
+        return mask
+
+    def overview(self, date_from: str = None, date_to: str = None) -> dict:
+        columns, _ = self._snapshot()
+        mask = self._mask(columns, date_from, date_to)
+        return {
+            'records': int(mask.sum()),
+            'income_total': round(float(columns['income'][mask].sum()), 2),
+            'expense_total': round(float(columns['expense'][mask].sum()), 2),
+        }
+
+    def trend(self, bucket: str = BUCKET_MONTH, window: int = 3, date_from: str = None, date_to: str = None) -> list:
+        """
+        按天、周（周一开始）或月汇总收支，并计算支出的移动平均
+        :param window: 移动平均的桶数，前面不足 window 个桶时按已有的桶平均
+        :return: [{'bucket': 桶的开始日期, 'income', 'expense', 'records', 'expense_avg'}, ...]，按时间正序
+        """
+        if bucket not in (self.BUCKET_DAY, self.BUCKET_WEEK, self.BUCKET_MONTH):
+            raise ValueError(f"不支持的时间粒度: {bucket}")
+        columns, _ = self._snapshot()
+        mask = self._mask(columns, date_from, date_to)
+        times = columns['time'][mask]
+        if bucket == self.BUCKET_MONTH:
+            keys = times.astype('datetime64[M]').astype(np.int64)
+        else:
+            days = times.astype('datetime64[D]').astype(np.int64)
+            # 1970-01-01 是周四，加 3 天后整除 7 得到以周一开始的周序号
+            keys = (days + 3) // 7 if bucket == self.BUCKET_WEEK else days
+        buckets, inverse = np.unique(keys, return_inverse=True)
+        income = np.bincount(inverse, weights=columns['income'][mask], minlength=len(buckets))
+        expense = np.bincount(inverse, weights=columns['expense'][mask], minlength=len(buckets))
+        records = np.bincount(inverse, minlength=len(buckets))
+        window = max(1, int(window))
+        cumulative = np.concatenate(([0.0], np.cumsum(expense)))
+        counts = np.minimum(np.arange(1, len(buckets) + 1), window)
+        average = (cumulative[1:] - cumulative[np.arange(len(buckets)) + 1 - counts]) / counts
+        if bucket == self.BUCKET_MONTH:
+            starts = buckets.astype('datetime64[M]').astype('datetime64[D]')
+        elif bucket == self.BUCKET_WEEK:
+            starts = (buckets * 7 - 3).astype('datetime64[D]')
+        else:
+            starts = buckets.astype('datetime64[D]')
+        return [
+            {'bucket': str(start), 'income': round(float(i), 2), 'expense': round(float(e), 2),
+             'records': int(n), 'expense_avg': round(float(a), 2)}
+            for start, i, e, n, a in zip(starts, income, expense, records, average)
+        ]
+
+    def breakdown(self, field: str, date_from: str = None, date_to: str = None, limit: int = 20) -> list:
+        """
+        按类别、支付平台等字典编码的字段分组汇总，按支出从高到低取前 limit 组
+        :return: [{'value': 取值, 'income', 'expense', 'records', 'share': 占总支出的比例}, ...]
+        """
+        if field not in self.DICT_FIELDS:
+            raise ValueError(f"不支持分组的字段: {field}")
+        columns, values = self._snapshot()
+        mask = self._mask(columns, date_from, date_to)
+        codes = columns[field][mask]
+        size = len(values[field])
+        income = np.bincount(codes, weights=columns['income'][mask], minlength=size)
+        expense = np.bincount(codes, weights=columns['expense'][mask], minlength=size)
+        records = np.bincount(codes, minlength=size)
+        total = expense.sum()
+        present = np.flatnonzero(records)
+        order = present[np.argsort(-expense[present], kind='stable')][:limit]
+        return [
+            {'value': values[field][code], 'income': round(float(income[code]), 2),
+             'expense': round(float(expense[code]), 2), 'records': int(records[code]),
+             'share': round(float(expense[code] / total), 4) if total else 0.0}
+            for code in order
+        ]
+
+    def top_expenses(self, n: int = 10, date_from: str = None, date_to: str = None) -> list:
+        """
+        金额最大的 n 笔支出
+        :return: [{'id', 'transaction_time', 'expense', 'category', 'transaction_app'}, ...]
+        """
+        columns, values = self._snapshot()
+        rows = np.flatnonzero(self._mask(columns, date_from, date_to) & (columns['expense'] > 0))
+        if len(rows) > n:
+            # argpartition 只找出前 n 个，不必对全部记录排序
+            rows = rows[np.argpartition(-columns['expense'][rows], n - 1)[:n]]
+        rows = rows[np.argsort(-columns['expense'][rows], kind='stable')]
+        return [self._record(columns, values, row) for row in rows]
+
+    def anomalies(self, date_from: str = None, date_to: str = None, limit: int = 20) -> list:
+        """
+        与同类别的其它支出相比金额异常高的记录。金额分布偏斜，按 log(1 + 金额) 计算均值和标准差；
+        每条记录都和去掉它自己之后的同类别记录比较，否则一条很大的金额会拉高均值和标准差，在记录少的类别中永远达不到阈值
+        :return: 与 top_expenses() 相同的字段，另有 z（高出的标准差数），按 z 从高到低
+        """
+        columns, values = self._snapshot()
+        rows = np.flatnonzero(self._mask(columns, date_from, date_to) & (columns['expense'] > 0))
+        codes = columns['category'][rows]
+        amounts = np.log1p(columns['expense'][rows])
+        size = len(values['category'])
+        counts = np.bincount(codes, minlength=size)
+        sums = np.bincount(codes, weights=amounts, minlength=size)
+        squares = np.bincount(codes, weights=amounts * amounts, minlength=size)
+        # 留一法：从所在类别的合计中减去这条记录本身
+        others = counts[codes] - 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = (sums[codes] - amounts) / others
+            stds = np.sqrt(np.maximum((squares[codes] - amounts * amounts) / others - means * means, 0))
+            z = (amounts - means) / np.maximum(stds, self.ANOMALY_MIN_STD)
+        flagged = (others >= self.ANOMALY_MIN_COUNT) & (z > self.ANOMALY_Z)
+        order = np.argsort(-z[flagged], kind='stable')[:limit]
+        result = []
+        for row, score in zip(rows[flagged][order], z[flagged][order]):
+            record = self._record(columns, values, row)
+            record['z'] = round(float(score), 2)
+            result.append(record)
+        return result
+
+    @staticmethod
+    def _record(columns: dict, values: dict, row) -> dict:
+        return {
+            'id': int(columns['id'][row]),
+            'transaction_time': str(columns['time'][row]).replace('T', ' '),
+            'expense': round(float(columns['expense'][row]), 2),
+            'category': values['category'][columns['category'][row]],
+            'transaction_app': values['transaction_app'][columns['transaction_app'][row]],
+        }
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'records': len(self._columns['id']),
+                'last_id': self._last_id,
+                'bytes': sum(column.nbytes for column in self._columns.values()),
+                'queries': self._queries,
+            }
@@ -0,0 +1,166 @@
+import asyncio
+import json
+import os
+import time
+from typing import Optional
+
+import httpx
+
+from .LlmQwen import LlmQwen
+from .Metrics import Metrics
+
+
+class AsyncLlmQwen(LlmQwen):
+    """
+    LlmQwen 的异步版本，供 asgi.py 的异步路由使用。
+    请求体、退避时间、用量统计和回答提取与 LlmQwen 相同，只是发送请求的方法改为协程：
+    等待模型回答时不占用线程，一个进程可以同时有几百个识别请求在等网络。
+    """
+    # 进程内共享的 httpx.AsyncClient，连接池中的长连接在各个请求之间复用
+    _client = None
+    _client_pid = None
+
+    @classmethod
+    def client(cls) -> httpx.AsyncClient:
+        """
+        获取进程内共享的异步 HTTP 客户端，按 pid 重建。
+        QWEN_ASYNC_POOL_SIZE 是同时发出的请求数上限，超过时在连接池中排队；
+        同步版本的并发受线程数限制，异步版本只受这个上限和 QWEN_RATE 限制
+        """
+        if cls._client is None or cls._client_pid != os.getpid():
+            pool_size = int(os.getenv('QWEN_ASYNC_POOL_SIZE') or 100)
+            cls._client = httpx.AsyncClient(limits=httpx.Limits(max_connections=pool_size,
+                                                                max_keepalive_connections=min(pool_size, 20)))
+            cls._client_pid = os.getpid()
+        return cls._client
+
+    @classmethod
+    async def close(cls):
+        """
+        关闭共享的客户端，在服务停止时调用
+        """
+        if cls._client is not None and cls._client_pid == os.getpid():
+            await cls._client.aclose()
+        cls._client = None
+
+    async def chat(self, question: str, image_base64: str = '', image_type: str = "png", stream: bool = False,
+                   temperature: float = 0,
+                   max_tokens: int = 1024) -> str:
+        """
+        发送带图片或仅文本的问答请求，参数与 LlmQwen.chat() 相同
+        """
+        if stream:
+            return ''.join([delta async for delta in self.chat_stream(question, image_base64, image_type,
+                                                                      temperature, max_tokens)])
+
+        payload = self.build_payload(question, image_base64, image_type, temperature, max_tokens, False)
+        return await self.complete(payload)
+
+    async def chat_images(self, question: str, images: list, temperature: float = 0, max_tokens: int = 1024) -> str:
+        """
+        一次请求发送多张图片，参数与 LlmQwen.chat_images() 相同
+        """
+        payload = self.build_payload(question, '', 'png', temperature, max_tokens, False, images)
+        return await self.complete(payload)
+
+    async def complete(self, payload: dict) -> str:
+        """
+        发送非流式请求，返回完整的回答文本
+        """
+        time_begin = time.perf_counter()
+        response = await self.post(payload)
+        result = response.json()
+        Metrics.observe('aifun_llm_completion_seconds', time.perf_counter() - time_begin, model=self.model, stream='0')
+        self.record_usage(result)
+        return self.extract_answer(result)
+
+    async def chat_stream(self, question: str, image_base64: str = '', image_type: str = "png",
+                          temperature: float = 0,
+                          max_tokens: int = 1024):
+        """
+        以流式（SSE）发送问答请求
+        :return: 逐段产生回答文本增量的异步生成器
+        """
+        payload = self.build_payload(question, image_base64, image_type, temperature, max_tokens, True)
+        time_begin = time.perf_counter()
+        first_token = True
+        response = await self.post(payload, stream=True)
+        try:
+            async for line in response.aiter_lines():
+                if not line.startswith('data:'):
+                    continue
+                data = line[5:].strip()
+                if data == '[DONE]':
+                    break
+                chunk = json.loads(data)
+                self.record_usage(chunk)
+                delta = self.extract_delta(chunk)
+                if delta:
+                    if first_token:
+                        first_token = False
+                        Metrics.observe('aifun_llm_first_token_seconds', time.perf_counter() - time_begin, model=self.model)
+                    yield delta
+            Metrics.observe('aifun_llm_completion_seconds', time.perf_counter() - time_begin, model=self.model, stream='1')
+        finally:
+            await response.aclose()
+
+    async def acquire(self) -> bool:
+        """
+        从与同步版本共享的令牌桶取令牌，没有令牌时让出事件循环而不是阻塞线程
+        :return: 是否在 read_timeout 秒内取到令牌
+        """
+        deadline = time.monotonic() + self.read_timeout
+        while not self.limiter.acquire(0):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            await asyncio.sleep(min(1 / self.limiter.rate, remaining))
+        return True
+
+    async def post(self, payload: dict, stream: bool = False) -> httpx.Response:
+        """
+        发送请求，重试规则与 LlmQwen.post() 相同：429、服务端临时错误和连接失败时按指数退避重试，读取超时不重试
+        :param payload: 请求体
+        :param stream: 是否以流式读取响应，为 True 时调用方读完后要 aclose()
+        :return: 状态码正常的响应
+        """
+        client = self.client()
+        timeout = httpx.Timeout(self.read_timeout, connect=self.connect_timeout)
+        attempt = 0
+        while True:
+            if not await self.acquire():
+                Metrics.inc('aifun_llm_errors_total', model=self.model, reason='rate_limit')
+                raise TimeoutError(f"本地限流等待超过 {self.read_timeout} 秒")
+            time_begin = time.perf_counter()
+            try:
+                request = client.build_request('POST', self.base_url, headers=self.headers, json=payload, timeout=timeout)
+                response = await client.send(request, stream=stream)
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                reason = 'connection'
+                Metrics.observe('aifun_llm_request_seconds', time.perf_counter() - time_begin, model=self.model, status=reason)
+                if attempt >= self.max_retries:
+                    Metrics.inc('aifun_llm_errors_total', model=self.model, reason=reason)
+                    raise
+                wait = self.backoff(attempt)
+                print(f"Qwen request failed: {e}")
+            except httpx.HTTPError:
+                Metrics.inc('aifun_llm_errors_total', model=self.model, reason='timeout')
+                raise
+            else:
+                reason = str(response.status_code)
+                Metrics.observe('aifun_llm_request_seconds', time.perf_counter() - time_begin, model=self.model, status=reason)
+                wait: Optional[float] = None
+                if response.status_code in self.RETRY_STATUS and attempt < self.max_retries:
+                    wait = self.backoff(attempt, response.headers.get('Retry-After'))
+                if wait is None:
+                    if response.status_code >= 400:
+                        Metrics.inc('aifun_llm_errors_total', model=self.model, reason=reason)
+                        await response.aclose()
+                    response.raise_for_status()
+                    return response
+                print(f"Qwen request got HTTP {response.status_code}")
+                await response.aclose()
+            Metrics.inc('aifun_llm_retries_total', model=self.model, reason=reason)
+            attempt += 1
+            print(f"Retrying Qwen request ({attempt}/{self.max_retries}) in {wait:.2f} seconds")
+            await asyncio.sleep(wait)
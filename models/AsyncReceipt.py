@@ -0,0 +1,161 @@
+import asyncio
+import base64
+import time
+
+from .AsyncLlmQwen import AsyncLlmQwen
+from .AsyncTable import AsyncTable
+from .DuplicateIndex import DuplicateIndex
+from .MerchantMemo import MerchantMemo
+from .Metrics import Metrics
+from .Receipt import Receipt
+from .Summary import Summary
+
+
+class AsyncReceipt(Receipt):
+    """
+    Receipt 的异步版本，供 asgi.py 的异步路由使用。
+    调用模型和写数据库改为协程，等待网络时不占用线程；
+    缩放图片、查重、读写缓存和 BlobStore 是 CPU 或本地磁盘操作，放到线程中执行，不阻塞事件循环。
+    """
+
+    # 识别上传的一张或多张原始图片，步骤与 recognizeBatch() 相同
+    # 各组请求在事件循环中并发等待模型，同时识别的张数不受 RECOGNIZE_WORKERS 线程数限制
+    # param images: 每张图片的字节或上传时暂存的文件对象
+    # return: 与 images 顺序一致的识别结果，某张图片出错时对应结果中有 error 字段
+    async def recognizeImages(self, images: list) -> list:
+        results = [None] * len(images)
+        pending = {}
+        prepared = await asyncio.gather(*(asyncio.to_thread(self.prepareImage, image) for image in images),
+                                        return_exceptions=True)
+        for i, item in enumerate(prepared):
+            if isinstance(item, Exception):
+                print(f"Recognize failed: {item}")
+                results[i] = {'error': str(item)}
+            elif 'result' in item:
+                results[i] = item['result']
+            else:
+                pending[i] = item
+
+        size = max(1, self.RECOGNIZE_BATCH_SIZE)
+        indexes = list(pending)
+        groups = [indexes[start:start + size] for start in range(0, len(indexes), size)]
+        answers = await asyncio.gather(*(self._recognizeGroupAsync([pending[i] for i in group]) for group in groups),
+                                       return_exceptions=True)
+        contents = {}
+        retry = []
+        for group, answer in zip(groups, answers):
+            if isinstance(answer, Exception):
+                print(f"Recognize failed: {answer}")
+                answer = [answer] * len(group)
+            for i, content in zip(group, answer):
+                if isinstance(content, dict):
+                    contents[i] = content
+                elif len(group) > 1:
+                    retry.append(i)
+                else:
+                    results[i] = {'error': str(content)}
+
+        if retry:
+            print(f"Recognize {len(retry)} images one by one after batch request")
+        answers = await asyncio.gather(*(self._recognizeGroupAsync([pending[i]]) for i in retry), return_exceptions=True)
+        for i, answer in zip(retry, answers):
+            content = answer if isinstance(answer, Exception) else answer[0]
+            if isinstance(content, dict):
+                contents[i] = content
+            else:
+                print(f"Recognize failed: {content}")
+                results[i] = {'error': str(content)}
+
+        finished = await asyncio.gather(*(asyncio.to_thread(self.finishRecognition, pending[i], content)
+                                          for i, content in contents.items()))
+        for i, result in zip(contents, finished):
+            results[i] = result
+        return results
+
+    # 识别一组 prepareImage() 准备好的图片，与 _recognizeGroup() 相同
+    async def _recognizeGroupAsync(self, items: list) -> list:
+        images = [(base64.b64encode(item['bytes']).decode("utf-8"), self.imageFormat(item['bytes'])) for item in items]
+        if len(images) == 1:
+            return [await self._recognizeAsync(*images[0])]
+        prompt = self.BATCH_PROMPT.replace('{count}', str(len(images)))
+        strContent = await AsyncLlmQwen().chat_images(prompt, images, max_tokens=self.MAX_TOKENS_EACH * len(images))
+        return self.parseContents(strContent, len(images))
+
+    # 调用模型识别一张图片，分级、升级和对冲规则与 _recognize() 相同
+    async def _recognizeAsync(self, b64_image: str, image_format: str) -> dict:
+        if not self.RECOGNIZE_TIERED:
+            return await self._recognizeFullAsync(b64_image, image_format)
+        time_begin = time.perf_counter()
+        light = asyncio.ensure_future(self._recognizeLightAsync(b64_image, image_format))
+        route = 'light'
+        # 不对冲时一直等到精简识别结束（受 LIGHT_TIMEOUT 限制）
+        done, _ = await asyncio.wait({light}, timeout=self.RECOGNIZE_HEDGE_SECONDS or None)
+        if done:
+            jsonContent = light.result()
+            if jsonContent is None:
+                route = 'escalated'
+                jsonContent = await self._recognizeFullAsync(b64_image, image_format)
+        else:
+            Metrics.inc('aifun_recognition_hedged_total', model=self.LIGHT_MODEL)
+            full = asyncio.ensure_future(self._recognizeFullAsync(b64_image, image_format))
+            done, _ = await asyncio.wait({light, full}, return_when=asyncio.FIRST_COMPLETED)
+            if light in done and light.result() is not None:
+                # 协程可以取消，不像同步版本那样让落后的请求在后台跑完
+                full.cancel()
+                jsonContent = light.result()
+            else:
+                light.cancel()
+                route = 'hedged'
+                jsonContent = await full
+        if route == 'light':
+            jsonContent.update(await self.completeFieldsAsync(jsonContent))
+        Metrics.observe('aifun_recognition_route_seconds', time.perf_counter() - time_begin, route=route)
+        return jsonContent
+
+    # 用快速模型做精简识别，与 _recognizeLight() 相同
+    async def _recognizeLightAsync(self, b64_image: str, image_format: str):
+        llm = AsyncLlmQwen(self.LIGHT_MODEL, read_timeout=self.LIGHT_TIMEOUT, max_retries=0)
+        try:
+            jsonContent = self.parseContent(await llm.chat(self.LIGHT_PROMPT, b64_image, image_format,
+                                                           max_tokens=self.LIGHT_MAX_TOKENS))
+        except Exception as e:
+            print(f"Light recognition failed: {e}")
+            return self.lightResult(None)
+        return self.lightResult(jsonContent)
+
+    async def _recognizeFullAsync(self, b64_image: str, image_format: str) -> dict:
+        strContent = await AsyncLlmQwen().chat(self.PROMPT, b64_image, image_format)
+        return self.parseContent(strContent)
+
+    # 与 completeFields() 相同；MerchantMemo 过期时要从数据库重新统计，放到线程中执行
+    async def completeFieldsAsync(self, jsonContent: dict) -> dict:
+        fields, categories = await asyncio.to_thread(self.learnedFields, jsonContent)
+        tier = 'memo'
+        if categories:
+            tier = 'classify'
+            fields['category'] = await self.classifyAsync({**jsonContent, **fields}, categories)
+        Metrics.inc('aifun_recognition_tier_total', tier=tier)
+        return fields
+
+    # 用文本模型判断类别，出错时返回空字符串，由用户填写
+    async def classifyAsync(self, jsonContent: dict, categories: list) -> str:
+        try:
+            category = await AsyncLlmQwen(self.TEXT_MODEL).chat(self.categoryPrompt(jsonContent, categories),
+                                                                max_tokens=self.CATEGORY_MAX_TOKENS)
+        except Exception as e:
+            print(f"Classify failed: {e}")
+            return ''
+        return self.cleanCategory(category)
+
+    # 保存识别结果，与 save() 相同，插入记录和更新月度统计使用异步连接
+    async def saveAsync(self, receipt: dict) -> int:
+        res = await AsyncTable(self.m_table, debug=self.debug).add(receipt)
+        if res == 1:
+            summary = Summary()
+            sql = summary.deltaSql(None, receipt)
+            if sql:
+                await AsyncTable(summary.m_table, debug=self.debug).query(sql)
+            MerchantMemo.instance().learn(None, receipt)
+            if receipt.get('image_hash'):
+                await asyncio.to_thread(DuplicateIndex.instance().refresh)
+        return res
@@ -0,0 +1,146 @@
+import asyncio
+import os
+import ssl
+
+import aiomysql
+import pymysql
+
+from .Metrics import Metrics
+from .Table import RowCursor, Table
+
+
+class AsyncTable(Table):
+    """
+    Table 的异步版本，供 asgi.py 的异步路由使用。
+    select()、where()、order_by() 等构建查询的方法和查询缓存与 Table 相同；
+    get()、query()、add() 改为协程，连接来自 aiomysql 的连接池，等待数据库时让出事件循环，不占用线程。
+    连接参数与 ConnectionPool 使用相同的 MYSQL_* 环境变量。
+    """
+    # 进程内共享的 aiomysql 连接池，在第一次查询时创建
+    _async_pool = None
+    _async_pool_pid = None
+    _async_pool_lock = None
+
+    @classmethod
+    async def async_pool(cls) -> aiomysql.Pool:
+        """
+        获取进程内共享的异步连接池，按 pid 重建。
+        池大小 MYSQL_ASYNC_POOL_SIZE 默认 20，连接全部借出时协程排队等待，不阻塞其它请求
+        """
+        if cls._async_pool_pid != os.getpid():
+            cls._async_pool = None
+            cls._async_pool_lock = asyncio.Lock()
+            cls._async_pool_pid = os.getpid()
+        if cls._async_pool is None:
+            # 多个协程同时第一次查询时只创建一个连接池
+            async with cls._async_pool_lock:
+                if cls._async_pool is None:
+                    env = os.environ.get("FLASK_ENV")
+                    mysqlHost = os.environ.get("MYSQL_HOST") or 'localhost'
+                    mysqlUser = os.environ.get("MYSQL_USER") or 'root'
+                    print(f"Connecting to MySQL database at {mysqlHost} as user {mysqlUser} in {env} environment (async).")
+                    cls._async_pool = await aiomysql.create_pool(
+                        host=mysqlHost,
+                        user=mysqlUser,
+                        password=os.environ.get("MYSQL_PASSWORD") or '',
+                        db=os.environ.get("MYSQL_DATABASE") or 'test',
+                        autocommit=True,
+                        ssl=ssl.create_default_context(cafile='models/DigiCertGlobalRootCA.crt.pem') if env != 'development' else None,
+                        minsize=0,
+                        maxsize=int(os.environ.get("MYSQL_ASYNC_POOL_SIZE") or 20),
+                        # 与同步连接池的 max_idle 相同，在 MySQL wait_timeout 断开之前主动重连
+                        pool_recycle=int(float(os.environ.get("MYSQL_POOL_MAX_IDLE") or 600)),
+                    )
+        return cls._async_pool
+
+    @classmethod
+    async def close_pool(cls):
+        """
+        关闭异步连接池，在服务停止时调用
+        """
+        if cls._async_pool is not None and cls._async_pool_pid == os.getpid():
+            cls._async_pool.close()
+            await cls._async_pool.wait_closed()
+        cls._async_pool = None
+
+    # 异步连接池状态，与 Table.pool_stats() 对应
+    @staticmethod
+    def async_pool_stats():
+        pool = AsyncTable._async_pool
+        if pool is None or AsyncTable._async_pool_pid != os.getpid():
+            return {'size': 0, 'free': 0, 'max_size': 0}
+        return {'size': pool.size, 'free': pool.freesize, 'max_size': pool.maxsize}
+
+    async def query(self, sql):
+        self.m_sql = sql
+        self.m_rowcount = 0
+        self.clear_error()
+
+        try:
+            if self.debug:
+                print(f"SQL: {sql if len(sql) <= self.DEBUG_SQL_LENGTH else sql[:self.DEBUG_SQL_LENGTH] + '...'}")
+            pool = await self.async_pool()
+            with self.timer(sql):
+                async with pool.acquire() as connection:
+                    async with connection.cursor() as cursor:
+                        try:
+                            await cursor.execute(sql)
+                            self.m_rowcount = cursor.rowcount
+                        finally:
+                            # 除 SELECT 外的语句都可能改了这张表，不论成功与否都让缓存作废
+                            if sql.lstrip()[:6].upper() != 'SELECT':
+                                self.invalidate_cache()
+        except pymysql.err.InterfaceError as e:
+            print(f"SQL execution error: {e}")
+            self.set_error(f"SQL execution error: {e}")
+        except pymysql.err.ProgrammingError as e:
+            print(f"SQL syntax error: {e}")
+            self.set_error(f"SQL syntax error: {e}")
+        except Exception as e:
+            print(f"Unexpected error: {e}")
+            self.set_error(f"Unexpected error: {e}")
+
+        self.m_sqlwhere = ""
+        self.m_sql = ""
+        self.m_sqlfields = ""
+        return self
+
+    # 与 Table.get() 相同，返回字典或 namedtuple 的列表，字段值为 None 时转换成空字符串
+    async def get(self, row_type=Table.ROW_DICT):
+        self.clear_error()
+        if self.m_sqlfields:
+            sql = self.select_sql()
+            tables = [self.m_table, self.m_jointable] if self.m_jointable else [self.m_table]
+            use_cache = self.query_cache.enabled and not self.m_nocache
+            cache_key = (row_type, sql)
+            if use_cache:
+                result = self.query_cache.get(cache_key)
+                if result is not None:
+                    self.reset_query()
+                    return result
+                versions = self.query_cache.versions(tables)
+            pool = await self.async_pool()
+            with self.timer(sql):
+                async with pool.acquire() as connection:
+                    async with connection.cursor() as cursor:
+                        await cursor.execute(sql)
+                        rows = await cursor.fetchall()
+                        fields = tuple(desc[0] for desc in cursor.description or ())
+            make_row = RowCursor.row_maker(fields, row_type)
+            result = [make_row(row) for row in rows]
+            Metrics.inc('aifun_sql_rows_total', len(result), table=self.m_table)
+            if use_cache:
+                self.query_cache.set(cache_key, tables, result, versions)
+        else:
+            result = []
+
+        self.reset_query()
+        return result
+
+    # 插入一行，与 Table.add() 相同
+    async def add(self, data, on_duplicate=Table.INSERT_IGNORE):
+        self.clear_error()
+        fields = list(data.keys())
+        value = f"({', '.join(self.sql_value(data.get(key)) for key in fields)})"
+        await self.query(self.insert_sql(fields, [value], on_duplicate))
+        return self.m_rowcount
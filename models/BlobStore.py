@@ -0,0 +1,91 @@
+import hashlib
+import os
+import re
+import threading
+from PIL import Image
+
+
+class BlobStore:
+    """
+    按内容哈希保存图片的本地存储，同样的图片只存一份。
+    文件名就是 SHA-256，内容永不改变，因此可以让浏览器长期缓存。
+    """
+    HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+    # 允许生成的缩略图宽度，限制取值以免缓存目录被任意宽度撑大
+    THUMBNAIL_WIDTHS = (120, 240, 480)
+    THUMBNAIL_QUALITY = 80
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def instance(cls) -> 'BlobStore':
+        """
+        获取进程内共享的存储，目录来自环境变量 BLOB_DIR，默认为项目下的 blobs 目录
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                default = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'blobs')
+                cls._instance = cls(os.environ.get('BLOB_DIR') or default)
+            return cls._instance
+
+    def _path(self, blob_hash: str, suffix: str = '') -> str:
+        # 按哈希前两位分子目录，避免单个目录下文件过多
+        return os.path.join(self.directory, blob_hash[:2], blob_hash + suffix)
+
+    def put(self, data: bytes) -> str:
+        """
+        保存内容，已存在时不重复写入
+        :return: 内容的 SHA-256
+        """
+        blob_hash = hashlib.sha256(data).hexdigest()
+        path = self._path(blob_hash)
+        if not os.path.exists(path):
+            self._write(path, data)
+        return blob_hash
+
+    def path(self, blob_hash: str):
+        """
+        :return: 文件路径，哈希格式不对或文件不存在时返回 None
+        """
+        if not self.HASH_PATTERN.match(blob_hash or ''):
+            return None
+        path = self._path(blob_hash)
+        return path if os.path.exists(path) else None
+
+    def thumbnail(self, blob_hash: str, width: int):
+        """
+        获取缩略图路径，第一次请求时生成并缓存为 JPEG
+        :return: 文件路径，原图不存在或宽度不在 THUMBNAIL_WIDTHS 中时返回 None
+        """
+        if width not in self.THUMBNAIL_WIDTHS:
+            return None
+        source = self.path(blob_hash)
+        if source is None:
+            return None
+        path = self._path(blob_hash, f'.w{width}.jpg')
+        if not os.path.exists(path):
+            with Image.open(source) as image:
+                image.draft('RGB', (width, width))
+                image = image.convert('RGB')
+                if image.width > width:
+                    image = image.resize((width, max(1, int(width * image.height / image.width))), Image.LANCZOS)
+                tmp_path = self._tmp_path(path)
+                image.save(tmp_path, format='JPEG', quality=self.THUMBNAIL_QUALITY, optimize=True)
+                os.replace(tmp_path, path)
+        return path
+
+    def _tmp_path(self, path):
+        return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写临时文件再改名，并发写同一个文件时读者不会读到写了一半的内容
+        tmp_path = self._tmp_path(path)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
@@ -0,0 +1,218 @@
+import os
+import threading
+import time
+import pymysql
+
+
+class PoolTimeoutError(Exception):
+    """
+    等待空闲连接超时
+    """
+
+
+class ConnectionPool:
+    """
+    进程内共享的 MySQL 连接池，线程安全。
+    每次 Table 查询从池里借一个连接，用完归还，避免每个请求都重新做 TLS 握手。
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, connect, max_size: int = 5, timeout: float = 10, ping_interval: float = 30, max_idle: float = 600):
+        """
+        :param connect: 创建新连接的函数
+        :param max_size: 连接数上限（含借出和空闲）
+        :param timeout: 连接全部借出时，等待归还的最长秒数
+        :param ping_interval: 空闲超过该秒数的连接，借出前先 ping 检查，断开则重连
+        :param max_idle: 空闲超过该秒数的连接直接关闭，避免被 MySQL wait_timeout 断开后再用
+        """
+        self.connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.max_idle = max_idle
+        self.pid = os.getpid()
+
+        self._cond = threading.Condition()
+        # 空闲连接列表，元素为 (连接, 归还时间)，末尾是最近归还的
+        self._idle = []
+        self._in_use = 0
+
+        self._created = 0
+        self._acquired = 0
+        self._waits = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._timeouts = 0
+        self._reconnects = 0
+        self._discarded = 0
+
+    @classmethod
+    def instance(cls) -> 'ConnectionPool':
+        """
+        获取进程内共享的连接池。
+        gunicorn 是先 fork 再处理请求，子进程不能共用父进程的连接，所以按 pid 重建。
+        """
+        with cls._instance_lock:
+            if cls._instance is None or cls._instance.pid != os.getpid():
+                cls._instance = cls.from_env()
+            return cls._instance
+
+    @classmethod
+    def from_env(cls) -> 'ConnectionPool':
+        mysqlHost = os.environ.get("MYSQL_HOST") or 'localhost'
+        mysqlUser = os.environ.get("MYSQL_USER") or 'root'
+        mysqlPassword = os.environ.get("MYSQL_PASSWORD") or ''
+        mysqlDatabase = os.environ.get("MYSQL_DATABASE") or 'test'
+        env = os.environ.get("FLASK_ENV")
+
+        jsonSsl = {'ca': 'models/DigiCertGlobalRootCA.crt.pem'} if env != 'development' else None
+
+        def connect():
+            print(f"Connecting to MySQL database at {mysqlHost} as user {mysqlUser} in {env} environment.")
+            return pymysql.connect(
+                    host=mysqlHost,
+                    user=mysqlUser,
+                    password=mysqlPassword,
+                    database=mysqlDatabase,
+                    autocommit=True,
+                    ssl=jsonSsl
+                )
+
+        return cls(
+            connect,
+            max_size=int(os.environ.get("MYSQL_POOL_SIZE") or 5),
+            timeout=float(os.environ.get("MYSQL_POOL_TIMEOUT") or 10),
+            ping_interval=float(os.environ.get("MYSQL_POOL_PING_INTERVAL") or 30),
+            max_idle=float(os.environ.get("MYSQL_POOL_MAX_IDLE") or 600),
+        )
+
+    def acquire(self):
+        """
+        借出一个连接，池满时阻塞等待，超过 timeout 抛出 PoolTimeoutError
+        """
+        time_begin = time.monotonic()
+        deadline = time_begin + self.timeout
+        stale = []
+        blocked = False
+        with self._cond:
+            while True:
+                # 先清掉空闲太久的连接，它们很可能已经被服务端断开
+                now = time.monotonic()
+                while self._idle and now - self._idle[0][1] > self.max_idle:
+                    stale.append(self._idle.pop(0)[0])
+                if self._idle:
+                    # 后进先出，优先复用最近用过的热连接
+                    connection, last_used = self._idle.pop()
+                    break
+                if self._in_use < self.max_size:
+                    connection, last_used = None, now
+                    break
+                remaining = deadline - now
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeoutError(f"No free MySQL connection after {self.timeout} seconds (pool size {self.max_size}).")
+                blocked = True
+                self._cond.wait(remaining)
+            self._in_use += 1
+            self._acquired += 1
+            waited = time.monotonic() - time_begin
+            if blocked:
+                self._waits += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+
+        for conn in stale:
+            self._close(conn)
+
+        try:
+            if connection is None:
+                connection = self.connect()
+                with self._cond:
+                    self._created += 1
+            elif time.monotonic() - last_used > self.ping_interval:
+                # 长时间未用的连接先 ping，连接已断开时 ping 会自动重连
+                thread_id = connection.thread_id()
+                connection.ping(reconnect=True)
+                if connection.thread_id() != thread_id:
+                    with self._cond:
+                        self._reconnects += 1
+        except Exception:
+            self.release(connection, discard=True)
+            raise
+        return connection
+
+    def release(self, connection, discard: bool = False):
+        """
+        归还连接。discard=True 表示连接已不可用（执行中出现连接级错误），直接关闭不再放回池中
+        """
+        with self._cond:
+            self._in_use -= 1
+            if connection is not None and not discard and connection.open:
+                self._idle.append((connection, time.monotonic()))
+                connection = None
+            elif connection is not None:
+                self._discarded += 1
+            self._cond.notify()
+        if connection is not None:
+            self._close(connection)
+
+    def connection(self):
+        """
+        with 语句中使用：with pool.connection() as conn: ...
+        """
+        return _PooledConnection(self)
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """
+        关闭所有空闲连接，借出中的连接在归还后照常回到池里
+        """
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._close(connection)
+
+    def stats(self) -> dict:
+        """
+        连接池状态，等待时间单位为毫秒
+        """
+        with self._cond:
+            return {
+                'max_size': self.max_size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'created': self._created,
+                'acquired': self._acquired,
+                'waits': self._waits,
+                'wait_time_total_ms': round(self._wait_total * 1000, 3),
+                'wait_time_avg_ms': round(self._wait_total * 1000 / self._acquired, 3) if self._acquired else 0.0,
+                'wait_time_max_ms': round(self._wait_max * 1000, 3),
+                'timeouts': self._timeouts,
+                'reconnects': self._reconnects,
+                'discarded': self._discarded,
+            }
+
+
+class _PooledConnection:
+    """
+    连接池的上下文管理器。出现连接级错误时丢弃连接，其它异常照常归还。
+    """
+    def __init__(self, pool: ConnectionPool):
+        self.pool = pool
+        self.conn = None
+
+    def __enter__(self):
+        self.conn = self.pool.acquire()
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        broken = exc_type is not None and issubclass(exc_type, (pymysql.err.OperationalError, pymysql.err.InterfaceError))
+        self.pool.release(self.conn, discard=broken)
+        self.conn = None
+        return False
@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+
+from .Table import Table
+
+
+class DuplicateIndex:
+    """
+    已保存截图的感知哈希索引（BK 树，按汉明距离查找），用于在调用模型前发现重复上传的截图。
+    同一张截图重新截取、裁剪或压缩后哈希只有少量位不同；查找只比较少数节点，几千条记录也在毫秒内完成。
+    索引在第一次查找时从 accounting 表的 image_hash 字段加载，之后按 id 增量读取新保存的记录，
+    其它进程保存的记录最多 REFRESH_SECONDS 秒后可见。
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    # 距上次从数据库读取新记录超过该秒数时，查找前先增量刷新
+    REFRESH_SECONDS = 30
+
+    def __init__(self, max_distance: int = 8):
+        """
+        :param max_distance: 汉明距离不超过该值视为重复，小于 0 时不检查
+        """
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        # 节点：[哈希值, [记录 id...], {与子节点的距离: 子节点}]
+        self._root = None
+        self._size = 0
+        self._last_id = 0
+        self._refreshed = 0.0
+        self._lookups = 0
+        self._found = 0
+
+    @classmethod
+    def instance(cls) -> 'DuplicateIndex':
+        """
+        获取进程内共享的索引，阈值来自环境变量 IMAGE_DUPLICATE_DISTANCE（默认 8，-1 表示不检查）
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                distance = os.environ.get("IMAGE_DUPLICATE_DISTANCE") or ''
+                cls._instance = cls(max_distance=int(distance) if distance else 8)
+            return cls._instance
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_distance >= 0
+
+    @staticmethod
+    def distance(a: int, b: int) -> int:
+        return (a ^ b).bit_count()
+
+    def _add(self, value, record_id):
+        self._size += 1
+        if self._root is None:
+            self._root = [value, [record_id], {}]
+            return
+        node = self._root
+        while True:
+            d = self.distance(value, node[0])
+            if d == 0:
+                node[1].append(record_id)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value, [record_id], {}]
+                return
+            node = child
+
+    def nearest(self, image_hash: str):
+        """
+        查找距离最近的已保存截图
+        :return: (记录 id, 距离)，没有距离不超过 max_distance 的记录时返回 None；距离相同时取最新的记录
+        """
+        if not self.enabled or not image_hash:
+            return None
+        if time.monotonic() - self._refreshed > self.REFRESH_SECONDS:
+            self.refresh()
+        value = int(image_hash, 16)
+        best = None
+        with self._lock:
+            self._lookups += 1
+            stack = [self._root] if self._root else []
+            while stack:
+                node = stack.pop()
+                d = self.distance(value, node[0])
+                if d <= self.max_distance:
+                    candidate = (d, -max(node[1]))
+                    if best is None or candidate < best:
+                        best = candidate
+                # 三角不等式：只有与当前节点距离在 [d - max, d + max] 内的子树可能有匹配
+                for child_distance, child in node[2].items():
+                    if d - self.max_distance <= child_distance <= d + self.max_distance:
+                        stack.append(child)
+            if best is None:
+                return None
+            self._found += 1
+        return -best[1], best[0]
+
+    def refresh(self):
+        """
+        从数据库读取上次之后新保存的、带哈希的记录。保存记录后调用，本进程马上就能查到
+        """
+        self._refreshed = time.monotonic()
+        table = Table('accounting')
+        table.select('id', 'image_hash').where('image_hash', 'IS NOT', None)
+        if self._last_id:
+            table.where('id', '>', str(self._last_id), 'AND')
+        try:
+            for row in table.order_by('id', 'ASC').iter(row_type=Table.ROW_TUPLE):
+                with self._lock:
+                    if row.id > self._last_id:
+                        if row.image_hash:
+                            self._add(int(row.image_hash, 16), row.id)
+                        self._last_id = row.id
+        except Exception as e:
+            # 还没有 image_hash 字段等情况，只记录日志，识别照常进行
+            print(f"Failed to load image hashes (run python -m models.Receipt migrate if image_hash is missing): {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'records': self._size,
+                'last_id': self._last_id,
+                'max_distance': self.max_distance,
+                'lookups': self._lookups,
+                'found': self._found,
+            }
@@ -0,0 +1,308 @@
+import os
+import time
+from io import BytesIO
+from PIL import Image, ImageChops, ImageOps
+
+from .Metrics import Metrics
+
+
+class UnsupportedImageError(ValueError):
+    """
+    上传的文件不是支持的图片格式
+    """
+
+
+class ImageTooLargeError(ValueError):
+    """
+    上传的图片文件体积或像素数超过限制
+    """
+
+
+class ImagePipeline:
+    """
+    上传图片的预处理流程：解码、按 EXIF 旋转、可选灰度化、裁掉空白边、缩放、按目标体积编码。
+    目的是在不影响识别准确率的前提下尽量减小发给模型的图片体积。
+    """
+    FORMAT_JPEG = 'jpeg'
+    FORMAT_PNG = 'png'
+
+    # 裁白边时，与背景色的差值小于该值的像素视为背景
+    CROP_THRESHOLD = 24
+    # 裁白边后四周保留的像素
+    CROP_PADDING = 8
+    # JPEG 质量的搜索范围
+    QUALITY_MIN = 40
+    QUALITY_MAX = 90
+    # 最低质量仍超过目标体积时，每次把尺寸缩小到这个比例，最多缩小几次
+    SHRINK_RATIO = 0.8
+    SHRINK_TIMES = 3
+    # 感知哈希（dHash）的边长，哈希共 HASH_SIZE * HASH_SIZE 位
+    HASH_SIZE = 16
+    # 接受上传的图片格式，解码后统一输出 PNG 或 JPEG
+    UPLOAD_FORMATS = ('JPEG', 'PNG', 'WebP', 'GIF', 'BMP')
+
+    def __init__(self, max_width: int = 720, target_bytes: int = 150 * 1024, grayscale: bool = False,
+                 autocrop: bool = True, max_pixels: int = 50_000_000, debug: bool = False):
+        """
+        :param max_width: 输出图片的最大宽度
+        :param target_bytes: 输出图片的目标体积（字节）
+        :param grayscale: 是否转成灰度图，交易截图大多不依赖颜色，灰度图体积更小
+        :param autocrop: 是否裁掉四周的空白边
+        :param max_pixels: 允许解码的最大像素数，只读文件头就能判断，超过时不解码直接拒绝
+        :param debug: 是否打印每个阶段的耗时
+        """
+        self.max_width = max_width
+        self.target_bytes = target_bytes
+        self.grayscale = grayscale
+        self.autocrop = autocrop
+        self.max_pixels = max_pixels
+        self.debug = debug
+
+    @classmethod
+    def from_env(cls, debug: bool = False) -> 'ImagePipeline':
+        return cls(
+            max_width=int(os.environ.get('IMAGE_MAX_WIDTH') or 720),
+            target_bytes=int(os.environ.get('IMAGE_TARGET_BYTES') or 150 * 1024),
+            grayscale=(os.environ.get('IMAGE_GRAYSCALE') or '0') == '1',
+            autocrop=(os.environ.get('IMAGE_AUTOCROP') or '1') == '1',
+            max_pixels=int(os.environ.get('IMAGE_MAX_PIXELS') or 50_000_000),
+            debug=debug,
+        )
+
+    @staticmethod
+    def sniff(image_bytes: bytes) -> str:
+        """
+        根据文件头判断图片格式，无法识别时返回空字符串
+        """
+        if image_bytes[:3] == b'\xff\xd8\xff':
+            return ImagePipeline.FORMAT_JPEG
+        if image_bytes[:8] == b'\x89PNG\r\n\x1a\n':
+            return ImagePipeline.FORMAT_PNG
+        return ''
+
+    @staticmethod
+    def sniff_upload(head: bytes) -> str:
+        """
+        根据文件头判断上传的文件是否是支持的图片格式
+        :param head: 文件开头至少 12 个字节
+        :return: UPLOAD_FORMATS 中的一个，不支持时返回空字符串
+        """
+        if head[:3] == b'\xff\xd8\xff':
+            return 'JPEG'
+        if head[:8] == b'\x89PNG\r\n\x1a\n':
+            return 'PNG'
+        if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+            return 'WebP'
+        if head[:6] in (b'GIF87a', b'GIF89a'):
+            return 'GIF'
+        if head[:2] == b'BM':
+            return 'BMP'
+        return ''
+
+    @classmethod
+    def check_upload(cls, stream, max_bytes: int) -> str:
+        """
+        解码之前检查上传的文件：只读文件头判断格式、定位到末尾得到长度，不把文件读入内存
+        :param stream: 可读取、可定位的二进制文件对象
+        :param max_bytes: 最大字节数
+        :return: 图片格式
+        :raises UnsupportedImageError: 不是支持的图片格式
+        :raises ImageTooLargeError: 文件超过 max_bytes
+        """
+        stream.seek(0)
+        head = stream.read(16)
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        stream.seek(0)
+        fmt = cls.sniff_upload(head)
+        if not fmt:
+            raise UnsupportedImageError(f"只支持 {'、'.join(cls.UPLOAD_FORMATS)} 格式的图片")
+        if size > max_bytes:
+            raise ImageTooLargeError(f"图片不能超过 {max_bytes / 1024 / 1024:g} MB")
+        return fmt
+
+    def process(self, source, max_width: int = None) -> dict:
+        """
+        处理一张图片
+        :param source: 原始图片字节，或可读取、可定位的二进制文件对象（如上传时暂存的临时文件），
+                       文件对象直接解码，不先读成字节
+        :param max_width: 输出的最大宽度，默认使用构造时的 max_width
+        :return: {'bytes': 图片字节, 'format': 'jpeg' 或 'png', 'width', 'height', 'hash': 感知哈希,
+                  'timings': 各阶段耗时（毫秒）}
+        :raises ImageTooLargeError: 像素数超过 max_pixels
+        """
+        max_width = max_width or self.max_width
+        timings = {}
+        time_begin = time.perf_counter()
+        stage_begin = time_begin
+
+        def mark(stage):
+            nonlocal stage_begin
+            now = time.perf_counter()
+            timings[stage] = round((now - stage_begin) * 1000, 3)
+            stage_begin = now
+
+        if isinstance(source, (bytes, bytearray)):
+            stream = BytesIO(source)
+            size = len(source)
+        else:
+            stream = source
+            stream.seek(0, os.SEEK_END)
+            size = stream.tell()
+            stream.seek(0)
+        # Image.open() 只读文件头，在解码像素之前按尺寸拒绝超大图片
+        image = Image.open(stream)
+        if image.width * image.height > self.max_pixels:
+            raise ImageTooLargeError(f"图片尺寸 {image.width}x{image.height} 超过 {self.max_pixels} 像素的限制")
+        source_format = (image.format or '').lower()
+        # 已经足够小、不需要旋转的图片原样返回
+        if (source_format in (self.FORMAT_JPEG, self.FORMAT_PNG) and image.width <= max_width
+                and size <= self.target_bytes and not self.grayscale
+                and image.getexif().get(0x0112, 1) == 1):
+            mark('decode')
+            image_hash = self.dhash(image)
+            mark('hash')
+            if stream is not source:
+                data = source
+            else:
+                stream.seek(0)
+                data = stream.read()
+            return self._result(data, source_format, image.width, image.height, image_hash, timings, time_begin)
+
+        # JPEG 可以在解码时直接按 1/2、1/4、1/8 缩小，比完整解码后再缩放快得多
+        # 请求的尺寸两边都不小于 max_width，这样无论是否需要按 EXIF 旋转，宽度都够用
+        if source_format == self.FORMAT_JPEG:
+            image.draft('L' if self.grayscale else 'RGB', (max_width, max_width))
+        image.load()
+        mark('decode')
+
+        image = ImageOps.exif_transpose(image)
+        image = self._convert_mode(image)
+        mark('orient')
+
+        if self.autocrop:
+            image = self._crop_margins(image)
+            mark('crop')
+
+        if image.width > max_width:
+            new_height = max(1, int(max_width * image.height / image.width))
+            image = image.resize((max_width, new_height), Image.LANCZOS, reducing_gap=3.0)
+        mark('resize')
+
+        # 在缩放后、编码前计算哈希，与输出的图片内容一致
+        image_hash = self.dhash(image)
+        mark('hash')
+
+        data, fmt = self._encode(image, source_format)
+        shrink = 0
+        while len(data) > self.target_bytes and shrink < self.SHRINK_TIMES:
+            # 最低质量也超过目标体积，再缩小尺寸
+            shrink += 1
+            size = (max(1, int(image.width * self.SHRINK_RATIO)), max(1, int(image.height * self.SHRINK_RATIO)))
+            image = image.resize(size, Image.LANCZOS)
+            data, fmt = self._encode(image, source_format)
+        mark('encode')
+
+        return self._result(data, fmt, image.width, image.height, image_hash, timings, time_begin)
+
+    def _result(self, data, fmt, width, height, image_hash, timings, time_begin):
+        timings['total'] = round((time.perf_counter() - time_begin) * 1000, 3)
+        for stage, ms in timings.items():
+            Metrics.observe('aifun_image_stage_seconds', ms / 1000, stage=stage)
+        Metrics.inc('aifun_image_output_bytes_total', len(data), format=fmt)
+        if self.debug:
+            stages = ', '.join(f"{stage} {ms:.1f} ms" for stage, ms in timings.items())
+            print(f"Image pipeline: {width}x{height} {fmt} {len(data)} bytes, {stages}")
+        return {'bytes': data, 'format': fmt, 'width': width, 'height': height, 'hash': image_hash, 'timings': timings}
+
+    @classmethod
+    def dhash(cls, image: Image.Image) -> str:
+        """
+        差值哈希：缩小成 (HASH_SIZE + 1) x HASH_SIZE 的灰度图，每个像素与右边相邻像素比较得到一位。
+        重新截图、裁剪少量边缘、重新压缩后只有少量位不同，用汉明距离判断两张图是否相同
+        :return: 十六进制字符串，长度为 HASH_SIZE * HASH_SIZE / 4
+        """
+        if image.mode not in ('L', 'RGB'):
+            image = image.convert('RGB')
+        # BOX 按区域取平均，缩小到很小的尺寸时比其它滤镜快而且不丢细节
+        small = image.resize((cls.HASH_SIZE + 1, cls.HASH_SIZE), Image.BOX)
+        if small.mode != 'L':
+            small = small.convert('L')
+        pixels = small.tobytes()
+        value = 0
+        width = cls.HASH_SIZE + 1
+        for row in range(cls.HASH_SIZE):
+            offset = row * width
+            for col in range(cls.HASH_SIZE):
+                value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+        return f'{value:0{cls.HASH_SIZE * cls.HASH_SIZE // 4}x}'
+
+    @classmethod
+    def hash_bytes(cls, image_bytes: bytes) -> str:
+        """
+        计算已处理过的图片的感知哈希
+        """
+        image = Image.open(BytesIO(image_bytes))
+        image.load()
+        return cls.dhash(ImageOps.exif_transpose(image))
+
+    def _convert_mode(self, image: Image.Image) -> Image.Image:
+        # 透明背景铺成白色，否则转 RGB 后透明部分会变黑
+        if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+            image = image.convert('RGBA')
+            background = Image.new('RGBA', image.size, (255, 255, 255, 255))
+            image = Image.alpha_composite(background, image)
+        target = 'L' if self.grayscale else 'RGB'
+        if image.mode != target:
+            image = image.convert(target)
+        return image
+
+    def _crop_margins(self, image: Image.Image) -> Image.Image:
+        # 以左上角像素为背景色，找出与背景色差异明显的区域
+        background = Image.new(image.mode, image.size, image.getpixel((0, 0)))
+        diff = ImageChops.difference(image, background)
+        if diff.mode != 'L':
+            diff = diff.convert('L')
+        bbox = diff.point(lambda value: 255 if value > self.CROP_THRESHOLD else 0).getbbox()
+        if not bbox:
+            return image
+        left = max(0, bbox[0] - self.CROP_PADDING)
+        top = max(0, bbox[1] - self.CROP_PADDING)
+        right = min(image.width, bbox[2] + self.CROP_PADDING)
+        bottom = min(image.height, bbox[3] + self.CROP_PADDING)
+        # 空白边太窄时不裁，省去一次复制
+        if (right - left) * (bottom - top) > image.width * image.height * 0.95:
+            return image
+        return image.crop((left, top, right, bottom))
+
+    def _encode(self, image: Image.Image, source_format: str):
+        """
+        选择编码格式和质量：截图（非 JPEG 来源）先试 PNG，文字边缘无损且体积通常不大；
+        超过目标体积或来源是照片时用 JPEG，二分查找不超过目标体积的最高质量
+        """
+        if source_format != self.FORMAT_JPEG:
+            data = self._save(image, self.FORMAT_PNG)
+            if len(data) <= self.target_bytes:
+                return data, self.FORMAT_PNG
+
+        best = None
+        low, high = self.QUALITY_MIN, self.QUALITY_MAX
+        while low <= high:
+            quality = (low + high) // 2
+            data = self._save(image, self.FORMAT_JPEG, quality)
+            if len(data) <= self.target_bytes:
+                best = data
+                low = quality + 1
+            else:
+                high = quality - 1
+        if best is None:
+            best = self._save(image, self.FORMAT_JPEG, self.QUALITY_MIN)
+        return best, self.FORMAT_JPEG
+
+    def _save(self, image: Image.Image, fmt: str, quality: int = None) -> bytes:
+        with BytesIO() as output:
+            if fmt == self.FORMAT_JPEG:
+                image.save(output, format='JPEG', quality=quality, optimize=True)
+            else:
+                image.save(output, format='PNG', compress_level=6)
+            return output.getvalue()
@@ -0,0 +1,300 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+class JobQueue:
+    """
+    基于本地 SQLite 的后台任务队列，用于异步识别图片，不依赖外部消息中间件。
+    同一台机器上的多个 gunicorn 进程共用一个数据库文件，任何进程的工作线程都可以领取任务。
+    """
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+
+    # 统计最近多少秒内完成的任务的耗时
+    STATS_WINDOW = 3600
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, path: str, workers: int = 2, stale_after: float = 300, retention: float = 86400):
+        """
+        :param path: SQLite 数据库文件路径
+        :param workers: 每个进程的工作线程数，0 表示本进程只提交任务，由单独的 python -m models.JobQueue 进程处理
+        :param stale_after: 运行超过该秒数的任务视为工作进程已退出，重新放回队列
+        :param retention: 已完成的任务保留的秒数
+        """
+        self.path = path
+        self.workers = workers
+        self.stale_after = stale_after
+        self.retention = retention
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+        self._init_schema()
+
+    @classmethod
+    def instance(cls) -> 'JobQueue':
+        """
+        获取进程内共享的任务队列，参数来自环境变量 JOB_QUEUE_PATH、JOB_WORKERS 和 JOB_STALE_AFTER
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls(
+                    os.environ.get('JOB_QUEUE_PATH') or os.path.join(tempfile.gettempdir(), 'aifun-jobs.sqlite3'),
+                    workers=int(os.environ.get('JOB_WORKERS') or 2),
+                    stale_after=float(os.environ.get('JOB_STALE_AFTER') or 300),
+                )
+            return cls._instance
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 连接不能跨线程使用，每个线程一个
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            # WAL 模式下读写互不阻塞，适合多进程轮询
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _init_schema(self):
+        connection = self._connection()
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                status TEXT NOT NULL,
+                image BLOB,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                worker TEXT
+            )''')
+        connection.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)')
+        connection.execute('CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished_at)')
+
+    def enqueue(self, image_bytes: bytes) -> int:
+        """
+        提交一个识别任务
+        :return: 任务 ID
+        """
+        cursor = self._connection().execute(
+            'INSERT INTO jobs (status, image, created_at) VALUES (?, ?, ?)',
+            (self.STATUS_QUEUED, image_bytes, time.time()))
+        self._wakeup.set()
+        return cursor.lastrowid
+
+    def claim(self, worker: str):
+        """
+        领取最早提交的一个排队中的任务
+        :return: (任务 ID, 图片字节)，没有任务时返回 None
+        """
+        connection = self._connection()
+        # IMMEDIATE 事务先拿到写锁，保证多个进程不会领到同一个任务
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT id, image FROM jobs WHERE status = ? ORDER BY id LIMIT 1', (self.STATUS_QUEUED,)).fetchone()
+            if row is not None:
+                connection.execute(
+                    'UPDATE jobs SET status = ?, started_at = ?, worker = ? WHERE id = ?',
+                    (self.STATUS_RUNNING, time.time(), worker, row['id']))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return (row['id'], row['image']) if row is not None else None
+
+    def finish(self, job_id: int, result: dict = None, error: str = None):
+        """
+        记录任务结果，图片不再需要，同时清掉以节省空间
+        """
+        status = self.STATUS_FAILED if error else self.STATUS_DONE
+        self._connection().execute(
+            'UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, image = NULL WHERE id = ?',
+            (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error, time.time(), job_id))
+
+    def get(self, job_id: int) -> dict:
+        """
+        查询任务状态，排队中的任务同时返回前面还有几个任务
+        :return: 任务信息，任务不存在时返回空字典
+        """
+        connection = self._connection()
+        row = connection.execute(
+            'SELECT id, status, result, error, created_at, started_at, finished_at FROM jobs WHERE id = ?',
+            (job_id,)).fetchone()
+        if row is None:
+            return {}
+        job = {
+            'id': row['id'],
+            'status': row['status'],
+            'result': json.loads(row['result']) if row['result'] else None,
+            'error': row['error'],
+            'created_at': row['created_at'],
+            'started_at': row['started_at'],
+            'finished_at': row['finished_at'],
+        }
+        if row['status'] == self.STATUS_QUEUED:
+            job['position'] = connection.execute(
+                'SELECT COUNT(*) FROM jobs WHERE status = ? AND id < ?', (self.STATUS_QUEUED, job_id)).fetchone()[0]
+        return job
+
+    def wait(self, job_id: int, timeout: float) -> dict:
+        """
+        长轮询：等到任务完成或失败，最多等 timeout 秒
+        """
+        deadline = time.monotonic() + timeout
+        interval = 0.1
+        while True:
+            job = self.get(job_id)
+            if not job or job['status'] in (self.STATUS_DONE, self.STATUS_FAILED):
+                return job
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return job
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, 1)
+
+    def wait_any(self, job_ids: list, timeout: float) -> list:
+        """
+        长轮询一组任务：等到其中任意一个完成、失败或不存在，最多等 timeout 秒。
+        一个页面的所有任务只占用一个请求，不会每个任务各占一个工作线程
+        :return: 与 job_ids 顺序一致的任务信息，任务不存在时为空字典
+        """
+        deadline = time.monotonic() + timeout
+        interval = 0.1
+        while True:
+            jobs = [self.get(job_id) for job_id in job_ids]
+            if any(not job or job['status'] in (self.STATUS_DONE, self.STATUS_FAILED) for job in jobs):
+                return jobs
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return jobs
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, 1)
+
+    def recover(self) -> int:
+        """
+        运行时间超过 stale_after 的任务（处理它的进程可能已退出）放回队列
+        :return: 放回的任务数
+        """
+        cursor = self._connection().execute(
+            'UPDATE jobs SET status = ?, started_at = NULL, worker = NULL WHERE status = ? AND started_at < ?',
+            (self.STATUS_QUEUED, self.STATUS_RUNNING, time.time() - self.stale_after))
+        return cursor.rowcount
+
+    def purge(self) -> int:
+        """
+        删除超过保留时间的已完成任务
+        """
+        cursor = self._connection().execute(
+            'DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?', (time.time() - self.retention,))
+        return cursor.rowcount
+
+    def stats(self) -> dict:
+        """
+        队列深度和最近 STATS_WINDOW 秒内完成的任务耗时（秒）：排队等待时间和处理时间的平均值、p50、p95
+        """
+        connection = self._connection()
+        counts = {status: 0 for status in (self.STATUS_QUEUED, self.STATUS_RUNNING, self.STATUS_DONE, self.STATUS_FAILED)}
+        for row in connection.execute('SELECT status, COUNT(*) AS n FROM jobs GROUP BY status'):
+            counts[row['status']] = row['n']
+        rows = connection.execute(
+            'SELECT started_at - created_at AS queued, finished_at - started_at AS run FROM jobs '
+            'WHERE finished_at >= ? AND started_at IS NOT NULL', (time.time() - self.STATS_WINDOW,)).fetchall()
+        oldest = connection.execute(
+            'SELECT MIN(created_at) FROM jobs WHERE status = ?', (self.STATUS_QUEUED,)).fetchone()[0]
+        return {
+            'depth': counts[self.STATUS_QUEUED],
+            'running': counts[self.STATUS_RUNNING],
+            'done': counts[self.STATUS_DONE],
+            'failed': counts[self.STATUS_FAILED],
+            'oldest_queued_seconds': round(time.time() - oldest, 3) if oldest else 0.0,
+            'window_seconds': self.STATS_WINDOW,
+            'finished_in_window': len(rows),
+            'queue_wait': self._summary([row['queued'] for row in rows]),
+            'run_time': self._summary([row['run'] for row in rows]),
+        }
+
+    @staticmethod
+    def _summary(values: list) -> dict:
+        if not values:
+            return {'avg': 0.0, 'p50': 0.0, 'p95': 0.0, 'max': 0.0}
+        values = sorted(values)
+        return {
+            'avg': round(sum(values) / len(values), 3),
+            'p50': round(values[len(values) // 2], 3),
+            'p95': round(values[min(len(values) - 1, int(len(values) * 0.95))], 3),
+            'max': round(values[-1], 3),
+        }
+
+    def start(self, handler, workers: int = None):
+        """
+        在本进程中启动工作线程，重复调用不会重复启动；fork 出的子进程中会重新启动
+        :param handler: 处理任务的函数，参数为图片字节，返回识别结果字典
+        :param workers: 线程数，默认为构造时的 workers
+        """
+        workers = self.workers if workers is None else workers
+        with self._start_lock:
+            if self._started_pid == os.getpid() or workers <= 0:
+                return
+            self._started_pid = os.getpid()
+            for i in range(workers):
+                thread = threading.Thread(target=self._work, args=(handler, f"{os.getpid()}-{i}"),
+                                          name=f'job-worker-{i}', daemon=True)
+                thread.start()
+
+    def _work(self, handler, worker: str):
+        last_maintenance = 0
+        while True:
+            # 每分钟做一次维护：找回卡住的任务，清理过期任务
+            if time.time() - last_maintenance > 60:
+                last_maintenance = time.time()
+                try:
+                    recovered = self.recover()
+                    if recovered:
+                        print(f"Requeued {recovered} stale jobs")
+                    self.purge()
+                except sqlite3.Error as e:
+                    print(f"Job queue maintenance failed: {e}")
+            try:
+                job = self.claim(worker)
+            except sqlite3.Error as e:
+                print(f"Failed to claim job: {e}")
+                job = None
+            if job is None:
+                # 本进程提交任务时会立即唤醒，其它进程提交的任务靠定时轮询发现
+                self._wakeup.wait(1)
+                self._wakeup.clear()
+                continue
+            job_id, image_bytes = job
+            try:
+                result = handler(image_bytes)
+            except Exception as e:
+                print(f"Job {job_id} failed: {e}")
+                self.finish(job_id, error=str(e))
+            else:
+                self.finish(job_id, result=result)
+
+
+if __name__ == '__main__':
+    # 单独运行工作进程：python -m models.JobQueue
+    # 这时 Web 进程可以设置 JOB_WORKERS=0，只负责提交任务
+    from .Receipt import Receipt
+
+    queue = JobQueue.instance()
+    workers = queue.workers if queue.workers > 0 else 2
+    print(f"Job workers: {workers}, queue: {queue.path}")
+    queue.start(lambda image_bytes: Receipt().recognizeImage(image_bytes), workers)
+    while True:
+        time.sleep(60)
+        print(queue.stats())
@@ -0,0 +1,73 @@
+import json
+
+
+class JsonFieldParser:
+    """
+    增量解析模型流式输出的 JSON 对象，某个字段的值一输出完整就返回，不必等整个对象结束。
+    只处理第一层字段，值可以是字符串、数字、true/false/null，或者完整的嵌套对象/数组。
+    开头的 ```json 之类的 markdown 标记会被跳过。
+    """
+    WHITESPACE = ' \t\r\n'
+
+    def __init__(self):
+        self.buffer = ''
+        # 下一个待解析字段的起始位置
+        self.pos = 0
+        self.started = False
+        self.result = {}
+        self._decoder = json.JSONDecoder()
+
+    def feed(self, text: str) -> list:
+        """
+        追加一段文本
+        :param text: 模型新输出的文本
+        :return: 这段文本中新解析完整的字段，[(字段名, 值), ...]
+        """
+        self.buffer += text
+        fields = []
+        if not self.started:
+            start = self.buffer.find('{', self.pos)
+            if start < 0:
+                return fields
+            self.pos = start + 1
+            self.started = True
+        while True:
+            field = self._next_field()
+            if field is None:
+                break
+            self.result[field[0]] = field[1]
+            fields.append(field)
+        return fields
+
+    def _skip(self, i: int, chars: str) -> int:
+        while i < len(self.buffer) and self.buffer[i] in chars:
+            i += 1
+        return i
+
+    def _next_field(self):
+        buffer = self.buffer
+        i = self._skip(self.pos, self.WHITESPACE + ',')
+        if i >= len(buffer) or buffer[i] != '"':
+            # 还没输出下一个字段，或者对象已经结束
+            return None
+        try:
+            key, i = self._decoder.raw_decode(buffer, i)
+        except ValueError:
+            return None
+        i = self._skip(i, self.WHITESPACE)
+        if i >= len(buffer) or buffer[i] != ':':
+            return None
+        i = self._skip(i + 1, self.WHITESPACE)
+        if i >= len(buffer):
+            return None
+        try:
+            value, end = self._decoder.raw_decode(buffer, i)
+        except ValueError:
+            return None
+        if buffer[i] not in '"{[':
+            # 数字和 true/false/null 可能还没输出完（如 99 后面还有 .99），看到后面的逗号或右括号才算完整
+            after = self._skip(end, self.WHITESPACE)
+            if after >= len(buffer) or buffer[after] not in ',}':
+                return None
+        self.pos = end
+        return key, value
@@ -1,29 +1,81 @@
 import base64
 import json
 import os 
+import random
 import requests
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
 from typing import List, Optional, Dict, Any
 
+from .Metrics import Metrics
+from .TokenBucket import TokenBucket
+
 
 class LlmQwen:
     """
     阿里云通义千问大语言模型调用类
     """
-    def __init__(self):
+    MODEL = "qwen3-vl-plus"
+    BASE_URL = "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions"
+    # 需要重试的 HTTP 状态码：限流和服务端临时错误
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    # 进程内共享的 HTTP 会话和限流器，保持与 dashscope 的长连接，不必每次识别都重新 TLS 握手
+    _session = None
+    _session_pid = None
+    _limiter = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, model: str = None, read_timeout: float = None, max_retries: int = None):
         """
         初始化客户端
         :param api_key: 阿里云DashScope API密钥（从控制台获取）
+        :param model: 模型名称，默认为 MODEL
+        :param read_timeout: 读取超时（秒），默认为 QWEN_READ_TIMEOUT；快速模型用更短的超时，超时后改用大模型
+        :param max_retries: 最多重试次数，默认为 QWEN_MAX_RETRIES
         """
         self.api_key = os.getenv('QWEN_KEY')
         if not self.api_key:
             raise ValueError("环境变量 QWEN_KEY 未设置，请在环境中配置API密钥")
         
-        self.base_url = "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions"
+        # QWEN_BASE_URL 可以指向兼容的代理或 bench/fake_dashscope.py 模拟服务
+        self.base_url = os.getenv('QWEN_BASE_URL') or self.BASE_URL
         self.headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
-        self.model = "qwen3-vl-plus"
+        self.model = model or self.MODEL
+        # 连接超时和读取超时（秒）
+        self.connect_timeout = float(os.getenv('QWEN_CONNECT_TIMEOUT') or 5)
+        self.read_timeout = read_timeout or float(os.getenv('QWEN_READ_TIMEOUT') or 30)
+        # 最多重试次数，退避时间的基数和上限（秒）。Retry-After 超过上限时不再重试，直接报错
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv('QWEN_MAX_RETRIES') or 3)
+        self.backoff_base = float(os.getenv('QWEN_BACKOFF_BASE') or 0.5)
+        self.backoff_max = float(os.getenv('QWEN_BACKOFF_MAX') or 30)
+        self.session, self.limiter = self.shared()
+
+    @classmethod
+    def shared(cls):
+        """
+        获取进程内共享的 requests.Session 和令牌桶限流器。
+        gunicorn fork 出的子进程不能共用父进程的连接，按 pid 重建。
+        限流参数 QWEN_RATE（每秒请求数，0 表示不限流）和 QWEN_BURST 是每个进程各自的，
+        多个工作进程时应设为总配额除以进程数。
+        """
+        with cls._shared_lock:
+            if cls._session is None or cls._session_pid != os.getpid():
+                session = requests.Session()
+                pool_size = int(os.getenv('QWEN_POOL_SIZE') or 10)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                cls._session = session
+                cls._session_pid = os.getpid()
+                cls._limiter = TokenBucket(float(os.getenv('QWEN_RATE') or 0), float(os.getenv('QWEN_BURST') or 0))
+            return cls._session, cls._limiter
 
     def image_to_base64(self, image_path: str) -> str:
         """
@@ -45,7 +97,7 @@ class LlmQwen:
         :return: base64编码字符串
         """
         try:
-            response = requests.get(image_url, timeout=10)
+            response = self.session.get(image_url, timeout=(self.connect_timeout, 10))
             response.raise_for_status()
             base64_data = base64.b64encode(response.content).decode("utf-8")
             return base64_data
@@ -60,10 +112,85 @@ class LlmQwen:
         :param question: 问题文本
         :param image_base64: 图片的base64编码（可选，如果为空则只进行文本问答）
         :param image_type: 图片类型，默认为"png"
+        :param stream: 是否使用流式响应，为 True 时内部按 chat_stream() 读取后拼接成完整回答
         :param temperature: 生成温度（0-1，越高越随机）
         :param max_tokens: 最大生成token数
         :return: 回答的文本
         """
+        if stream:
+            return ''.join(self.chat_stream(question, image_base64, image_type, temperature, max_tokens))
+
+        payload = self.build_payload(question, image_base64, image_type, temperature, max_tokens, False)
+        return self.complete(payload)
+
+    def chat_images(self, question: str, images: list, temperature: float = 0, max_tokens: int = 1024) -> str:
+        """
+        一次请求发送多张图片，提示语只发送一次。每张图片前加上"图片 序号"的标注，便于模型按序号回答
+        :param question: 问题文本
+        :param images: [(图片的base64编码, 图片类型), ...]
+        :param temperature: 生成温度（0-1，越高越随机）
+        :param max_tokens: 最大生成token数，应按图片张数放大
+        :return: 回答的文本
+        """
+        payload = self.build_payload(question, '', 'png', temperature, max_tokens, False, images)
+        return self.complete(payload)
+
+    def complete(self, payload: dict) -> str:
+        """
+        发送非流式请求，返回完整的回答文本
+        """
+        time_begin = time.perf_counter()
+        # 发送请求
+        response = self.post(payload)
+        result = response.json()
+        Metrics.observe('aifun_llm_completion_seconds', time.perf_counter() - time_begin, model=self.model, stream='0')
+        self.record_usage(result)
+        answer = self.extract_answer(result)
+        return answer
+
+    def chat_stream(self, question: str, image_base64: str = '', image_type: str = "png",
+                       temperature: float = 0,
+                       max_tokens: int = 1024):
+        """
+        以流式（SSE）发送问答请求，模型每输出一段就返回一段
+        :param question: 问题文本
+        :param image_base64: 图片的base64编码（可选）
+        :param image_type: 图片类型，默认为"png"
+        :param temperature: 生成温度（0-1，越高越随机）
+        :param max_tokens: 最大生成token数
+        :return: 逐段产生回答文本增量的生成器
+        """
+        payload = self.build_payload(question, image_base64, image_type, temperature, max_tokens, True)
+        time_begin = time.perf_counter()
+        first_token = True
+        response = self.post(payload, stream=True)
+        try:
+            # SSE 的响应头通常不带 charset，requests 会按 ISO-8859-1 解码，所以按字节读取后自己用 UTF-8 解码
+            for line in response.iter_lines():
+                if not line.startswith(b'data:'):
+                    continue
+                data = line[5:].strip().decode('utf-8')
+                if data == '[DONE]':
+                    break
+                chunk = json.loads(data)
+                # 请求时设置了 include_usage，最后一个数据块带有 token 用量
+                self.record_usage(chunk)
+                delta = self.extract_delta(chunk)
+                if delta:
+                    if first_token:
+                        first_token = False
+                        Metrics.observe('aifun_llm_first_token_seconds', time.perf_counter() - time_begin, model=self.model)
+                    yield delta
+            Metrics.observe('aifun_llm_completion_seconds', time.perf_counter() - time_begin, model=self.model, stream='1')
+        finally:
+            response.close()
+
+    def build_payload(self, question: str, image_base64: str, image_type: str, temperature: float,
+                      max_tokens: int, stream: bool, images: list = None) -> dict:
+        """
+        构建请求体
+        :param images: 多张图片 [(base64编码, 图片类型), ...]，与 image_base64 二选一
+        """
         # 构建消息内容
         # 定义元素类型：值可以是字符串 或 嵌套字典（str->str）
         content: List[Dict[str, Any]]  = [
@@ -79,6 +206,14 @@ class LlmQwen:
                     "url": f"data:image/{image_type};base64,{image_base64}"
                 }
             })
+        for index, (b64, b64_type) in enumerate(images or [], 1):
+            content.append({"type": "text", "text": f"图片 {index}:"})
+            content.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:image/{b64_type};base64,{b64}"
+                }
+            })
         
         # 构建请求体
         payload = {
@@ -91,20 +226,108 @@ class LlmQwen:
             ],
             "temperature": temperature,
             "max_tokens": max_tokens,
-            "stream": False  # 非流式响应
+            "stream": stream
         }
+        if stream:
+            # 流式响应默认不返回 token 用量，要求在最后一个数据块中返回
+            payload["stream_options"] = {"include_usage": True}
+        return payload
 
-        # 发送请求
-        response = requests.post(
-                url=self.base_url,
-                headers=self.headers,
-                json=payload,
-                timeout=30
-        )
-        response.raise_for_status()  # 抛出HTTP错误
-        result = response.json()
-        answer = self.extract_answer(result)
-        return answer
+    def post(self, payload: dict, stream: bool = False) -> requests.Response:
+        """
+        发送请求，遇到限流（429）、服务端临时错误和连接失败时按指数退避重试
+        :param payload: 请求体
+        :param stream: 是否以流式读取响应
+        :return: 状态码正常的响应
+        """
+        attempt = 0
+        while True:
+            # 先从令牌桶取令牌，并发请求多时在本地排队，而不是一起发出去再一起被限流
+            if not self.limiter.acquire(self.read_timeout):
+                Metrics.inc('aifun_llm_errors_total', model=self.model, reason='rate_limit')
+                raise TimeoutError(f"本地限流等待超过 {self.read_timeout} 秒")
+            time_begin = time.perf_counter()
+            try:
+                response = self.session.post(
+                        url=self.base_url,
+                        headers=self.headers,
+                        json=payload,
+                        timeout=(self.connect_timeout, self.read_timeout),
+                        stream=stream
+                )
+            except requests.exceptions.ConnectionError as e:
+                # 读取超时不重试，服务端可能已经在生成回答，重试会重复计费
+                reason = 'connection'
+                Metrics.observe('aifun_llm_request_seconds', time.perf_counter() - time_begin, model=self.model, status=reason)
+                if attempt >= self.max_retries:
+                    Metrics.inc('aifun_llm_errors_total', model=self.model, reason=reason)
+                    raise
+                wait = self.backoff(attempt)
+                print(f"Qwen request failed: {e}")
+            except requests.exceptions.RequestException:
+                Metrics.inc('aifun_llm_errors_total', model=self.model, reason='timeout')
+                raise
+            else:
+                reason = str(response.status_code)
+                Metrics.observe('aifun_llm_request_seconds', time.perf_counter() - time_begin, model=self.model, status=reason)
+                if response.status_code not in self.RETRY_STATUS or attempt >= self.max_retries:
+                    if response.status_code >= 400:
+                        Metrics.inc('aifun_llm_errors_total', model=self.model, reason=reason)
+                    response.raise_for_status()  # 抛出HTTP错误
+                    return response
+                wait = self.backoff(attempt, response.headers.get('Retry-After'))
+                if wait is None:
+                    # Retry-After 太长（如限流到第二天），等待没有意义
+                    Metrics.inc('aifun_llm_errors_total', model=self.model, reason=reason)
+                    response.raise_for_status()
+                print(f"Qwen request got HTTP {response.status_code}")
+                response.close()
+            Metrics.inc('aifun_llm_retries_total', model=self.model, reason=reason)
+            attempt += 1
+            print(f"Retrying Qwen request ({attempt}/{self.max_retries}) in {wait:.2f} seconds")
+            time.sleep(wait)
+
+    def backoff(self, attempt: int, retry_after: Optional[str] = None) -> Optional[float]:
+        """
+        计算重试前等待的秒数：带随机抖动的指数退避，服务端给了 Retry-After 时至少等这么久
+        :return: 等待秒数，Retry-After 超过 backoff_max 时返回 None 表示不再重试
+        """
+        # 全抖动：在 0 到指数上限之间随机取值，避免多个进程同时重试
+        wait = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if retry_after:
+            try:
+                seconds = float(retry_after)
+            except ValueError:
+                try:
+                    seconds = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+                except (TypeError, ValueError):
+                    seconds = 0
+            if seconds > self.backoff_max:
+                return None
+            wait = max(wait, seconds)
+        return wait
+
+    def extract_delta(self, chunk) -> str:
+        """
+        从流式响应的一个数据块中提取新增的回答文本
+        :param chunk: 一行 data: 后面的 JSON 对象
+        :return: 新增文本，没有时为空字符串
+        """
+        try:
+            return chunk["choices"][0]["delta"].get("content") or ""
+        except (KeyError, IndexError, TypeError):
+            # 最后一个数据块可能只有 usage，没有 choices
+            return ""
+
+    def record_usage(self, result):
+        """
+        记录响应中的 token 用量
+        """
+        usage = result.get("usage") if isinstance(result, dict) else None
+        if not usage:
+            return
+        Metrics.inc('aifun_llm_tokens_total', usage.get("prompt_tokens") or 0, model=self.model, kind='prompt')
+        Metrics.inc('aifun_llm_tokens_total', usage.get("completion_tokens") or 0, model=self.model, kind='completion')
 
     def extract_answer(self, result) -> str:
         """
@@ -0,0 +1,136 @@
+import os
+import threading
+import time
+
+from .Table import Table
+
+
+class MerchantMemo:
+    """
+    消费应用（商户）到类别、支付平台的对应表，从已保存的 accounting 记录中统计得到。
+    同一个商户几乎总是同一个类别，识别时模型只需要读出商户名，类别和支付平台直接查表，不必再让模型推断。
+    保存和编辑记录时本进程立即更新，其它进程的修改最多 REFRESH_SECONDS 秒后重新统计时生效。
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    # 距上次从数据库统计超过该秒数时，查找前先重新统计
+    REFRESH_SECONDS = 300
+    # 学习的字段
+    FIELDS = ('category', 'payment_platform')
+
+    def __init__(self, min_share: float = 0.6):
+        """
+        :param min_share: 某个取值在该商户的记录中所占比例不低于此值时才采用，避免同一商户类别不固定时猜错
+        """
+        self.min_share = min_share
+        self._lock = threading.Lock()
+        # 商户 -> 字段 -> {取值: 记录数}
+        self._counts = {}
+        self._loaded = 0.0
+        self._hits = 0
+        self._misses = 0
+
+    @classmethod
+    def instance(cls) -> 'MerchantMemo':
+        """
+        获取进程内共享的对应表，参数来自环境变量 MERCHANT_MEMO_SHARE（默认 0.6）
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls(min_share=float(os.environ.get("MERCHANT_MEMO_SHARE") or 0.6))
+            return cls._instance
+
+    @staticmethod
+    def _key(merchant) -> str:
+        return str(merchant or '').strip()
+
+    def lookup(self, merchant: str) -> dict:
+        """
+        :return: 能确定的字段 {'category': ..., 'payment_platform': ...}，商户没有记录时为空字典
+        """
+        key = self._key(merchant)
+        if not key:
+            return {}
+        if time.monotonic() - self._loaded > self.REFRESH_SECONDS:
+            self.load()
+        result = {}
+        with self._lock:
+            for field, values in self._counts.get(key, {}).items():
+                total = sum(values.values())
+                if total <= 0:
+                    continue
+                value, count = max(values.items(), key=lambda item: item[1])
+                if count / total >= self.min_share:
+                    result[field] = value
+            if result:
+                self._hits += 1
+            else:
+                self._misses += 1
+        return result
+
+    def categories(self, limit: int = 20) -> list:
+        """
+        :return: 已有记录中最常用的类别，用于提示模型从中选择，保持类别名称一致
+        """
+        totals = {}
+        with self._lock:
+            for fields in self._counts.values():
+                for value, count in fields.get('category', {}).items():
+                    totals[value] = totals.get(value, 0) + count
+        return [value for value, count in sorted(totals.items(), key=lambda item: -item[1])[:limit] if count > 0]
+
+    def learn(self, old: dict = None, new: dict = None):
+        """
+        保存或编辑记录后更新对应表：减去旧记录的取值，加上新记录的取值
+        """
+        with self._lock:
+            for record, delta in ((old, -1), (new, 1)):
+                if record:
+                    self._count(record, delta)
+
+    def _count(self, record, delta):
+        key = self._key(record.get('transaction_app'))
+        if not key:
+            return
+        fields = self._counts.setdefault(key, {})
+        for field in self.FIELDS:
+            value = self._key(record.get(field))
+            if value:
+                values = fields.setdefault(field, {})
+                values[value] = values.get(value, 0) + delta
+
+    def load(self):
+        """
+        按商户、类别、支付平台分组统计全部记录，替换内存中的对应表
+        """
+        self._loaded = time.monotonic()
+        counts = {}
+        try:
+            table = Table('accounting')
+            rows = table.select('transaction_app', 'category', 'payment_platform', 'COUNT(*) AS records') \
+                .where('transaction_app', 'IS NOT', None) \
+                .group_by('transaction_app, category, payment_platform').iter(row_type=Table.ROW_TUPLE)
+            for row in rows:
+                key = self._key(row.transaction_app)
+                if not key:
+                    continue
+                fields = counts.setdefault(key, {})
+                for field in self.FIELDS:
+                    value = self._key(getattr(row, field))
+                    if value:
+                        values = fields.setdefault(field, {})
+                        values[value] = values.get(value, 0) + int(row.records)
+        except Exception as e:
+            print(f"Failed to load merchant memo: {e}")
+            return
+        with self._lock:
+            self._counts = counts
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'merchants': len(self._counts),
+                'hits': self._hits,
+                'misses': self._misses,
+            }
@@ -0,0 +1,209 @@
+import contextlib
+import os
+import re
+import threading
+import time
+
+
+class Metrics:
+    """
+    进程内的计数器和耗时直方图，通过 /metrics 以 Prometheus 文本格式输出。
+    环境变量 METRICS_ENABLED=1 时启用；未启用时各记录方法第一行就返回，几乎没有开销。
+    每个 gunicorn 工作进程各自统计，Prometheus 需要分别抓取，或在前面加一层汇总。
+    """
+    enabled = (os.environ.get('METRICS_ENABLED') or '0') == '1'
+
+    # 耗时直方图的桶上限（秒），覆盖从单条 SQL 的毫秒级到模型调用的几十秒
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    # SQL 语句形状的最大长度，超过部分截断，避免标签过长
+    SHAPE_LENGTH = 160
+
+    _lock = threading.Lock()
+    # 名称 -> (类型, 说明)
+    _meta = {}
+    # (名称, 标签元组) -> 数值
+    _counters = {}
+    # (名称, 标签元组) -> [各桶计数..., 总和, 次数]
+    _histograms = {}
+    # 名称 -> 返回 [(标签字典, 数值), ...] 的函数，输出时才调用
+    _gauges = {}
+
+    _STRING = re.compile(r"'(?:[^'\\]|\\.)*'")
+    _NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+    _LIST = re.compile(r'\((?:\s*\?\s*,)+\s*\?\s*\)')
+    _ROWS = re.compile(r'(\(\?\)(?:\s*,\s*\(\?\))+)')
+    _SPACE = re.compile(r'\s+')
+
+    @classmethod
+    def describe(cls, name: str, kind: str, help_text: str):
+        cls._meta[name] = (kind, help_text)
+
+    @classmethod
+    def inc(cls, name: str, value: float = 1, **labels):
+        """
+        计数器加 value
+        """
+        if not cls.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with cls._lock:
+            cls._counters[key] = cls._counters.get(key, 0) + value
+
+    @classmethod
+    def observe(cls, name: str, seconds: float, **labels):
+        """
+        记录一次耗时（秒）
+        """
+        if not cls.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with cls._lock:
+            histogram = cls._histograms.get(key)
+            if histogram is None:
+                histogram = cls._histograms[key] = [0] * (len(cls.BUCKETS) + 2)
+            for i, bound in enumerate(cls.BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+                    break
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    @classmethod
+    def timer(cls, name: str, **labels):
+        """
+        计时的上下文管理器：with Metrics.timer('aifun_xxx_seconds', stage='decode'): ...
+        """
+        return _Timer(name, labels) if cls.enabled else contextlib.nullcontext()
+
+    @classmethod
+    def gauge(cls, name: str, help_text: str, func):
+        """
+        注册一个在输出时才取值的指标，func 返回 [(标签字典, 数值), ...]
+        """
+        cls.describe(name, 'gauge', help_text)
+        with cls._lock:
+            cls._gauges[name] = func
+
+    @classmethod
+    def gauge_stats(cls, name: str, help_text: str, func):
+        """
+        把 stats() 这类返回字典的函数注册为指标，每个数值字段输出一行，字段名作为 stat 标签
+        """
+        def samples():
+            return [({'stat': key}, value) for key, value in func().items()
+                    if isinstance(value, (int, float)) and not isinstance(value, bool)]
+        cls.gauge(name, help_text, samples)
+
+    @classmethod
+    def sql_shape(cls, sql: str) -> str:
+        """
+        把 SQL 中的字面量替换成 ?，同样结构的语句归为一类，如
+        SELECT * FROM accounting WHERE (id = ?)；批量 INSERT 的多行 VALUES 合并成一个 (?)
+        """
+        shape = cls._STRING.sub('?', sql)
+        shape = cls._NUMBER.sub('?', shape)
+        shape = cls._LIST.sub('(?)', shape)
+        shape = cls._ROWS.sub('(?)', shape)
+        shape = cls._SPACE.sub(' ', shape).strip()
+        return shape[:cls.SHAPE_LENGTH]
+
+    @staticmethod
+    def _escape(value) -> str:
+        return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+    @classmethod
+    def _labels(cls, labels, extra=None) -> str:
+        items = list(labels) + ([extra] if extra else [])
+        if not items:
+            return ''
+        return '{' + ','.join(f'{key}="{cls._escape(value)}"' for key, value in items) + '}'
+
+    @staticmethod
+    def _number(value) -> str:
+        if isinstance(value, float):
+            return repr(round(value, 6))
+        return str(value)
+
+    @classmethod
+    def render(cls) -> str:
+        """
+        以 Prometheus 文本格式输出全部指标
+        """
+        with cls._lock:
+            counters = dict(cls._counters)
+            histograms = {key: list(value) for key, value in cls._histograms.items()}
+            gauges = dict(cls._gauges)
+        lines = []
+        written = set()
+
+        def header(name, kind):
+            if name in written:
+                return
+            written.add(name)
+            help_text = cls._meta.get(name, (kind, ''))[1]
+            if help_text:
+                lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, 'counter')
+            lines.append(f"{name}{cls._labels(labels)} {cls._number(value)}")
+        for (name, labels), histogram in sorted(histograms.items()):
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(cls.BUCKETS, histogram):
+                cumulative += count
+                lines.append(f"{name}_bucket{cls._labels(labels, ('le', bound))} {cumulative}")
+            lines.append(f"{name}_bucket{cls._labels(labels, ('le', '+Inf'))} {histogram[-1]}")
+            lines.append(f"{name}_sum{cls._labels(labels)} {cls._number(histogram[-2])}")
+            lines.append(f"{name}_count{cls._labels(labels)} {histogram[-1]}")
+        for name, func in sorted(gauges.items()):
+            try:
+                samples = func()
+            except Exception as e:
+                print(f"Failed to collect metric {name}: {e}")
+                continue
+            header(name, 'gauge')
+            for labels, value in samples:
+                lines.append(f"{name}{cls._labels(sorted(labels.items()))} {cls._number(value)}")
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._counters.clear()
+            cls._histograms.clear()
+
+
+class _Timer:
+    __slots__ = ('name', 'labels', 'begin')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        Metrics.observe(self.name, time.perf_counter() - self.begin, **self.labels)
+
+
+Metrics.describe('aifun_http_request_seconds', 'histogram', 'HTTP request latency by route, including streamed body')
+Metrics.describe('aifun_sql_seconds', 'histogram', 'SQL statement latency by statement shape')
+Metrics.describe('aifun_sql_errors_total', 'counter', 'Failed SQL statements by statement shape')
+Metrics.describe('aifun_sql_rows_total', 'counter', 'Rows returned by Table.get by table')
+Metrics.describe('aifun_llm_request_seconds', 'histogram', 'Model HTTP request latency until response headers')
+Metrics.describe('aifun_llm_completion_seconds', 'histogram', 'Model latency until the full answer is read')
+Metrics.describe('aifun_llm_first_token_seconds', 'histogram', 'Streaming model latency until the first token')
+Metrics.describe('aifun_llm_tokens_total', 'counter', 'Model token usage by model and kind')
+Metrics.describe('aifun_llm_errors_total', 'counter', 'Model request failures by model and reason')
+Metrics.describe('aifun_llm_retries_total', 'counter', 'Model request retries by model and reason')
+Metrics.describe('aifun_image_stage_seconds', 'histogram', 'Image pipeline latency by stage')
+Metrics.describe('aifun_image_output_bytes_total', 'counter', 'Bytes produced by the image pipeline by format')
+Metrics.describe('aifun_recognition_cache_total', 'counter', 'Recognition cache lookups by result')
+Metrics.describe('aifun_recognition_tier_total', 'counter', 'Tiered recognitions by the tier that completed them')
+Metrics.describe('aifun_recognition_light_total', 'counter', 'Fast model recognitions by outcome, non-accepted ones escalate')
+Metrics.describe('aifun_recognition_hedged_total', 'counter', 'Fast model recognitions that started a hedged full request')
+Metrics.describe('aifun_recognition_route_seconds', 'histogram', 'Single image recognition latency by the route that answered')
@@ -1,2 +1,50 @@
+import base64
+import json
+import os
+import tempfile
+
+
 class Model:
-    PAGE_EACH = 10
\ No newline at end of file
+    # 列表每页条数，可用环境变量 PAGE_EACH 配置
+    PAGE_EACH = int(os.environ.get('PAGE_EACH') or 10)
+    # 请求参数 size 允许的最大每页条数
+    PAGE_MAX = 100
+    # 一次最多上传的图片张数
+    UPLOAD_MAX_FILES = int(os.environ.get('UPLOAD_MAX_FILES') or 20)
+    # 每张上传图片的最大字节数，超过时不解码直接拒绝
+    UPLOAD_MAX_BYTES = int(os.environ.get('UPLOAD_MAX_BYTES') or 20 * 1024 * 1024)
+    # 一次上传请求的最大字节数，按请求头的 Content-Length 在读取请求体之前拒绝
+    UPLOAD_MAX_REQUEST_BYTES = int(os.environ.get('UPLOAD_MAX_REQUEST_BYTES') or 100 * 1024 * 1024)
+    # 上传的文件超过该字节数时暂存到临时文件，不占用内存
+    UPLOAD_SPOOL_BYTES = int(os.environ.get('UPLOAD_SPOOL_BYTES') or 512 * 1024)
+
+    # 接收上传文件的容器，参数与 werkzeug 的 stream_factory 相同
+    # 小文件留在内存中，超过 UPLOAD_SPOOL_BYTES 后自动转存到临时文件，关闭时删除
+    @staticmethod
+    def spoolUpload(total_content_length=None, content_type=None, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=Model.UPLOAD_SPOOL_BYTES)
+
+    # 把页码参数 size 规整到 1 ~ PAGE_MAX 之间，无效时用默认的 PAGE_EACH
+    @staticmethod
+    def pageSize(size=None) -> int:
+        if size is None or not str(size).isdigit() or int(size) <= 0:
+            return Model.PAGE_EACH
+        return min(int(size), Model.PAGE_MAX)
+
+    # 游标分页的游标：把上一页最后一行的排序字段值编码成不透明的字符串，放在 URL 参数 after 中
+    @staticmethod
+    def encodeCursor(values: list) -> str:
+        raw = json.dumps([str(v) for v in values], ensure_ascii=False, separators=(',', ':'))
+        return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+    # 解码游标，格式不对时抛出 ValueError
+    @staticmethod
+    def decodeCursor(cursor: str, length: int) -> list:
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            values = json.loads(raw.decode('utf-8'))
+        except (ValueError, UnicodeDecodeError) as e:
+            raise ValueError(f"无效的分页游标: {cursor}") from e
+        if not isinstance(values, list) or len(values) != length or not all(isinstance(v, str) for v in values):
+            raise ValueError(f"无效的分页游标: {cursor}")
+        return values
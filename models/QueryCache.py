@@ -0,0 +1,120 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class QueryCache:
+    """
+    Table.get() 查询结果缓存，以生成的 SQL 和行类型为键，有过期时间和容量上限（LRU）。
+    每张表有一个版本号，通过 Table 写入时版本号加一，之前缓存的这张表的查询结果全部作废。
+    版本号只在进程内有效，多个 gunicorn 进程之间靠过期时间限制读到旧数据的时长。
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, ttl: float = 0, max_entries: int = 512):
+        """
+        :param ttl: 缓存有效秒数，0 表示不缓存
+        :param max_entries: 最多缓存的查询数
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # 查询键（行类型和 SQL）-> (过期时间, 涉及的表, 查询时各表的版本号, 结果行)
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    @classmethod
+    def instance(cls) -> 'QueryCache':
+        """
+        获取进程内共享的缓存，参数来自环境变量 QUERY_CACHE_TTL（默认 0，不缓存）和 QUERY_CACHE_SIZE
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls(
+                    ttl=float(os.environ.get("QUERY_CACHE_TTL") or 0),
+                    max_entries=int(os.environ.get("QUERY_CACHE_SIZE") or 512),
+                )
+            return cls._instance
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def versions(self, tables) -> tuple:
+        """
+        查询前记下涉及的各表的版本号，保存结果时用来判断查询期间是否有写入
+        """
+        with self._lock:
+            return tuple(self._versions.get(table, 0) for table in tables)
+
+    @staticmethod
+    def _copy(rows: list) -> list:
+        # 字典行复制一份；namedtuple 行不可修改，直接共用
+        return [dict(row) if isinstance(row, dict) else row for row in rows]
+
+    def get(self, key):
+        """
+        查找缓存，未命中、已过期或表已被写入时返回 None。返回的是副本，调用方修改不会影响缓存
+        :param key: 查询键，Table.get() 使用 (行类型, SQL)
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, tables, versions, rows = entry
+                if expires > time.monotonic() and versions == tuple(self._versions.get(table, 0) for table in tables):
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return self._copy(rows)
+                del self._entries[key]
+            self._misses += 1
+            return None
+
+    def set(self, key, tables, rows: list, versions: tuple):
+        """
+        保存查询结果
+        :param tables: 查询涉及的表，其中任何一张表被写入都会使结果作废
+        :param versions: 查询前 versions() 的返回值，查询期间表被写入过时不保存，以免缓存旧数据
+        """
+        if not self.enabled:
+            return
+        tables = tuple(tables)
+        with self._lock:
+            if versions != tuple(self._versions.get(table, 0) for table in tables):
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, tables, versions, self._copy(rows))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, table: str):
+        """
+        表被写入后调用，这张表的缓存结果全部作废（在下次查找或被 LRU 淘汰时清除）
+        """
+        with self._lock:
+            self._versions[table] = self._versions.get(table, 0) + 1
+            self._invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                'enabled': self.enabled,
+                'ttl': self.ttl,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self._hits,
+                'misses': self._misses,
+                'invalidations': self._invalidations,
+                'hit_rate': round(self._hits / total, 4) if total else 0.0,
+            }
@@ -1,59 +1,36 @@
-from io import BytesIO
-from PIL import Image
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from .Analytics import Analytics
+from .BlobStore import BlobStore
+from .DuplicateIndex import DuplicateIndex
+from .ImagePipeline import ImagePipeline
+from .JsonFieldParser import JsonFieldParser
 from .LlmQwen import LlmQwen
+from .MerchantMemo import MerchantMemo
+from .Metrics import Metrics
 from .Table import Table
 from .Model import Model
+from .RecognitionCache import RecognitionCache
+from .Summary import Summary
 
 import base64
+import csv
+import hashlib
+import io
+import datetime
 import json
+import os
+import re
+import sys
+import threading
 import time
+from decimal import Decimal, InvalidOperation
 
 class Receipt(Table):
+    # 无法从文件头判断格式时使用的默认图片格式
     IMAGE_FORMAT = 'png'
-    
-    def __init__(self):
-        super().__init__('accounting', debug=True)
-
-    # 按ID编辑1条记录
-    def editReceipt(self, id: str, receipt: dict) -> int:
-        # 更新数据表
-        return self.where('id', '=', id).update(receipt)
-
-    # 按记录ID读取1条记录
-    def getReceipt(self, id) -> dict:
-        res = self.select('*').where('id', '=', id).get()
-        return res[0] if res else {}
-
-    # 按时间倒序读取多条记录
-    def listReceipts(self, page: int = 1) -> list:
-        # 每页条数为 Model.PAGE_EACH，转换为limit() 参数为 page * Model.PAGE_EACH
-        pe = Model.PAGE_EACH
-        res = self.select('*').order_by('transaction_time', 'DESC').limit((page - 1) * pe, pe).get()
-        return res
-
-    # 重置图片大小
-    # 手机截图尺寸比较大，缩小成宽最大600像素
-    # param image_bytes: 图片的字节流
-    # param max_width: 图片的最大宽度，默认值为200
-    # return: 处理后的图片的字节流
-    def resize(self, image_bytes: bytes, max_width: int = 300) -> bytes:
-        image = Image.open(BytesIO(image_bytes))
-        if image.width <= max_width:
-            return image_bytes
-
-        new_height = int(max_width * image.height / image.width)
-        resized_image = image.resize((max_width, new_height))
-        with BytesIO() as output:
-            resized_image.save(output, format=self.IMAGE_FORMAT)
-            return output.getvalue()
 
-    # 注意传图片体积太大时API会报错 {'error': {'code': '429', 'message': 'Rate limit is exceeded. Try again in 86400 seconds.'}}
-    # 虽说文档说文体体积最大512MB，实际200多KB的图片都会报错。换成小点的图片。
-    # 识别图片内容
-    def recognize(self, image_bytes: bytes) -> dict:
-        b64_image = base64.b64encode(image_bytes).decode("utf-8")
-
-        prompt = """
+    # 识别交易截图的提示语
+    PROMPT = """
 这是交易截图，请识别消费/收入信息，识别出的文字内容应严格遵循图片上原有内容，不要转换来翻译成其它语言。请返回仅 JSON 格式的数据，不要输出任何其他内容。
 提取字段:
 交易时间：如2025-02-15 12:30:00，使用时间格式表示
@@ -79,15 +56,608 @@ class Receipt(Table):
 如果无法识别，返回空。
 """
 
+    # 多张截图合并成一次请求时的提示语，单张的识别要求只发送一次；{count} 替换为图片张数
+    BATCH_PROMPT = """
+下面依次是 {count} 张交易截图，每张图片前标注了"图片 序号"。每一张都按以下要求识别：
+""" + PROMPT + """
+返回一个 JSON 数组，依次对应每张图片，数组共 {count} 个元素，每个元素是上面格式的 JSON 对象，并加上 "index" 字段表示图片序号（从 1 开始）。
+某张图片无法识别时，对应元素为 {"index": 序号}。只返回 JSON 数组，不要输出任何其他内容。
+"""
+    # 每张图片的回答需要的最大 token 数，合并请求时按张数放大
+    MAX_TOKENS_EACH = 512
+
+    # 分级识别：先用快速的小视觉模型和精简的提示语只读出截图上的文字字段，类别按商户从 MerchantMemo 查表，
+    # 查不到时再用纯文本的小模型判断；精简识别超时、出错或结果校验不通过时，才升级到大模型用完整提示语重新识别
+    RECOGNIZE_TIERED = (os.environ.get('RECOGNIZE_TIERED') or '1') == '1'
+    # 精简识别使用的快速视觉模型
+    LIGHT_MODEL = os.environ.get('QWEN_LIGHT_MODEL') or 'qwen3-vl-flash'
+    # 精简识别的读取超时（秒），不重试，超时后直接升级到大模型，限制慢请求拖长的尾部耗时
+    LIGHT_TIMEOUT = float(os.environ.get('QWEN_LIGHT_TIMEOUT') or 8)
+    # 对冲：精简识别超过该秒数还没有返回时，同时向大模型发出完整识别，先得到可用结果的一方胜出；0 表示不对冲
+    # 对冲多花一次大模型调用的费用，换取更低的 p99，应设为快速模型耗时的 p90 左右
+    RECOGNIZE_HEDGE_SECONDS = float(os.environ.get('RECOGNIZE_HEDGE_SECONDS') or 0)
+    # 判断类别使用的文本模型
+    TEXT_MODEL = os.environ.get('QWEN_TEXT_MODEL') or 'qwen-turbo'
+    LIGHT_MAX_TOKENS = 300
+    CATEGORY_MAX_TOKENS = 16
+    # 没有历史记录时提示给模型的类别
+    CATEGORIES = ['餐饮', '交通', '购物', '医疗', '生活缴费', '娱乐', '住房', '转账', '工资']
+
+    LIGHT_PROMPT = """
+识别交易截图，按图片原文返回 JSON，不要输出其他内容，没有的字段为空：
+{"transaction_time": "2025-02-15 12:30:00", "income_amount": "", "expense_amount": 99.99, "transaction_app": "交易场所或商户", "payment_platform": "微信/支付宝等", "financial_terminal": "银行卡/信用卡/零钱等", "memo": "备注、商品名称或交易号"}
+"""
+
+    CATEGORY_PROMPT = """
+根据交易信息判断消费类别，只返回类别名称，不要输出其他内容。水、电、燃气属于生活缴费。常用类别：{categories}
+消费的应用：{merchant}
+说明：{memo}
+"""
+
+    def __init__(self):
+        super().__init__('accounting', debug=True)
+
+    # 按ID编辑1条记录
+    def editReceipt(self, id: str, receipt: dict) -> int:
+        # 先读出旧值（不走查询缓存），更新成功后按新旧值的差额调整月度统计
+        old = self.getReceipt(id, fresh=True)
+        # 更新数据表
+        res = self.where('id', '=', id).update(receipt)
+        if res and old:
+            Summary().applyDelta(old, {**old, **receipt})
+            MerchantMemo.instance().learn(old, {**old, **receipt})
+            Analytics.instance().update({**old, **receipt})
+        return res
+
+    # 按记录ID读取1条记录
+    # fresh 为 True 时跳过查询缓存，直接读数据库
+    def getReceipt(self, id, fresh: bool = False) -> dict:
+        self.select('*').where('id', '=', id)
+        if fresh:
+            self.no_cache()
+        res = self.get()
+        return res[0] if res else {}
+
+    # 列表排序字段，id 保证同一时间的多条记录顺序稳定
+    LIST_ORDER = ['transaction_time', 'id']
+    # 列表页只显示说明的开头，完整内容在编辑页查看
+    LIST_MEMO_LENGTH = 100
+    # 列表页读取的字段，不读整段说明文本，减少传输的数据量和每行的内存
+    LIST_FIELDS = ['id', 'transaction_time', 'income_amount', 'expense_amount', 'transaction_app',
+                   'payment_platform', 'financial_terminal', f'LEFT(memo, {LIST_MEMO_LENGTH}) AS memo',
+                   'category', 'source_image']
+
+    # 按时间倒序读取多条记录
+    # 传 after 游标时按 (transaction_time, id) 从上一页最后一条之后接着读，深翻页和第一页开销相同；
+    # 不传时沿用 page 页码的 LIMIT offset 方式，兼容旧链接
+    # 返回的每行是只读的 namedtuple，用 record.字段名 访问
+    def listReceipts(self, page: int = 1, page_size: int = None, after: str = None) -> list:
+        pe = page_size or Model.PAGE_EACH
+        self.select(*self.LIST_FIELDS)
+        if after:
+            self.seek(self.LIST_ORDER, Model.decodeCursor(after, len(self.LIST_ORDER)), Table.ORDER_DESC)
+            self.limit(pe)
+        else:
+            self.limit((page - 1) * pe, pe)
+        res = self.order_by('transaction_time', 'DESC', 'id', 'DESC').get(Table.ROW_TUPLE)
+        return res
+
+    # 下一页的游标，本页不满一页时说明已经没有下一页，返回空字符串
+    def nextCursor(self, records: list, page_size: int = None) -> str:
+        if not records or len(records) < (page_size or Model.PAGE_EACH):
+            return ''
+        last = records[-1]
+        # 兼容 listReceipts() 返回的 namedtuple 和 get() 默认返回的字典
+        if isinstance(last, dict):
+            return Model.encodeCursor([last[field] for field in self.LIST_ORDER])
+        return Model.encodeCursor([getattr(last, field) for field in self.LIST_ORDER])
+
+    # 全文检索的字段和索引。ngram 分词器支持中文，按 ngram_token_size（默认 2）个字切分
+    SEARCH_FIELDS = ['transaction_app', 'memo']
+    SEARCH_INDEX = 'ft_search'
+    SEARCH_INDEX_SQL = f"ALTER TABLE accounting ADD FULLTEXT INDEX {SEARCH_INDEX} (transaction_app, memo) WITH PARSER ngram"
+    # 比 ngram_token_size 短的关键词没有对应的索引项，改用 LIKE 在其它条件筛出的记录中查找
+    SEARCH_TOKEN_SIZE = 2
+    # 一次搜索最多使用的关键词个数
+    SEARCH_MAX_TERMS = 10
+    # 没有全文索引时，隔这么多秒再检查一次，用命令行建好索引后不用重启
+    SEARCH_INDEX_RECHECK_SECONDS = 300
+    _search_index_ready = False
+    _search_index_checked = None
+    _search_index_lock = threading.Lock()
+
+    # 检查全文索引是否存在。存在时每个进程只检查一次；不存在时记住结果，SEARCH_INDEX_RECHECK_SECONDS 秒后再查
+    # 请求中不创建索引：在大表上加 FULLTEXT 索引要重建整张表，远超工作进程的超时，用 python -m models.Receipt search-index 创建
+    # return: 索引是否可用，不可用时关键词改用 LIKE 查找
+    def hasSearchIndex(self) -> bool:
+        if Receipt._search_index_ready:
+            return True
+        with Receipt._search_index_lock:
+            checked = Receipt._search_index_checked
+            if Receipt._search_index_ready or (checked is not None and
+                                               time.monotonic() - checked < self.SEARCH_INDEX_RECHECK_SECONDS):
+                return Receipt._search_index_ready
+            Receipt._search_index_checked = time.monotonic()
+            try:
+                rows = Table('information_schema.STATISTICS').select('INDEX_NAME') \
+                    .where('TABLE_SCHEMA', '=', os.environ.get("MYSQL_DATABASE") or 'test') \
+                    .and_where('TABLE_NAME', '=', self.m_table) \
+                    .and_where('INDEX_NAME', '=', self.SEARCH_INDEX).no_cache().get()
+            except Exception as e:
+                print(f"Failed to check full-text index: {e}")
+                rows = []
+            if not rows:
+                print(f"Full-text index {self.SEARCH_INDEX} is missing, keyword search falls back to LIKE. "
+                      f"Create it with: python -m models.Receipt search-index")
+            Receipt._search_index_ready = bool(rows)
+        return Receipt._search_index_ready
+
+    # 创建全文索引，只在命令行中调用
+    # return: 索引是否可用
+    def createSearchIndex(self) -> bool:
+        Receipt._search_index_checked = None
+        if self.hasSearchIndex():
+            return True
+        print(f"Creating full-text index {self.SEARCH_INDEX} on {self.m_table}")
+        table = Table(self.m_table)
+        table.query(self.SEARCH_INDEX_SQL)
+        if table.m_errorstr:
+            return False
+        Receipt._search_index_ready = True
+        return True
+
+    # 建表语句之后新增的字段及其定义，部署新版本时用 python -m models.Receipt migrate 补上
+    MIGRATE_COLUMNS = {
+        'source_image': 'char(64) DEFAULT NULL',
+        'image_hash': 'char(64) DEFAULT NULL',
+    }
+
+    # 给表补上 MIGRATE_COLUMNS 中还没有的字段，已有的跳过，可以重复执行；只在命令行中调用
+    # return: 新加的字段名列表，失败时返回 None
+    def migrate(self):
+        rows = Table('information_schema.COLUMNS').select('COLUMN_NAME') \
+            .where('TABLE_SCHEMA', '=', os.environ.get("MYSQL_DATABASE") or 'test') \
+            .and_where('TABLE_NAME', '=', self.m_table).no_cache().get()
+        existing = {row['COLUMN_NAME'] for row in rows}
+        missing = [name for name in self.MIGRATE_COLUMNS if name not in existing]
+        if not missing:
+            return []
+        table = Table(self.m_table, debug=True)
+        table.query(f"ALTER TABLE {self.m_table} "
+                    + ', '.join(f"ADD COLUMN {name} {self.MIGRATE_COLUMNS[name]}" for name in missing))
+        return None if table.m_errorstr else missing
+
+    # 把用户输入的搜索词拆成关键词，去掉全文检索布尔模式的运算符
+    def searchTerms(self, keyword: str) -> list:
+        return re.sub(r'[+\-<>()~*"@]', ' ', keyword or '').split()[:self.SEARCH_MAX_TERMS]
+
+    # 按关键词、金额范围和日期范围搜索记录，按时间倒序，和 listReceipts() 一样用 after 游标分页
+    # 关键词在消费应用和说明中查找，多个关键词都要出现；长度够的关键词走 FULLTEXT 索引，不会全表扫描
+    # 金额按支出金额（没有时按收入金额）比较；日期为 YYYY-MM-DD，包含 date_to 当天
+    # 参数格式不对时抛出 ValueError
+    # return: 与 listReceipts() 相同的 namedtuple 列表
+    def searchReceipts(self, keyword: str = '', min_amount: str = None, max_amount: str = None,
+                       date_from: str = None, date_to: str = None, page_size: int = None, after: str = None) -> list:
+        pe = page_size or Model.PAGE_EACH
+        terms = self.searchTerms(keyword)
+        indexed = [term for term in terms if len(term) >= self.SEARCH_TOKEN_SIZE]
+        if indexed and not self.hasSearchIndex():
+            indexed = []
+        conditions = []
+        for term in terms:
+            if term not in indexed:
+                pattern = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                conditions.append(("CONCAT_WS(' ', transaction_app, memo)", 'LIKE', f'%{pattern}%'))
+        for value, operator in ((min_amount, '>='), (max_amount, '<=')):
+            if value:
+                try:
+                    amount = Decimal(str(value).strip())
+                except InvalidOperation:
+                    raise ValueError(f"金额格式错误: {value}")
+                conditions.append(('COALESCE(expense_amount, income_amount)', operator, str(amount)))
+        for value, operator, days in ((date_from, '>=', 0), (date_to, '<', 1)):
+            if value:
+                date = datetime.datetime.strptime(value, '%Y-%m-%d') + datetime.timedelta(days=days)
+                conditions.append(('transaction_time', operator, date.strftime('%Y-%m-%d %H:%M:%S')))
+
+        self.select(*self.LIST_FIELDS)
+        if indexed:
+            self.where_match(self.SEARCH_FIELDS, ' '.join(f'+"{term}"' for term in indexed))
+        for key, operator, value in conditions:
+            self.where(key, operator, value, 'AND' if self.m_sqlwhere else 'WHERE')
+        if after:
+            self.seek(self.LIST_ORDER, Model.decodeCursor(after, len(self.LIST_ORDER)), Table.ORDER_DESC)
+        return self.order_by('transaction_time', 'DESC', 'id', 'DESC').limit(pe).get(Table.ROW_TUPLE)
+
+    # 导出的字段，顺序即 CSV 的列顺序
+    EXPORT_FIELDS = ['id', 'transaction_time', 'income_amount', 'expense_amount', 'transaction_app',
+                     'payment_platform', 'financial_terminal', 'memo', 'category']
+    EXPORT_CSV = 'csv'
+    EXPORT_NDJSON = 'ndjson'
+
+    # 按 id 顺序导出全部记录，返回逐块输出文本的生成器，用于流式下载
+    # 数据来自 Table.iter() 的服务端游标，每读出一批行就输出一块，内存占用与总行数无关
+    def exportReceipts(self, fmt: str = EXPORT_CSV, fetch_size: int = Table.ITER_FETCH_SIZE):
+        rows = self.select(*self.EXPORT_FIELDS).order_by('id', 'ASC').iter(fetch_size)
+        return self._exportChunks(rows, fmt, fetch_size)
+
+    def _exportChunks(self, rows, fmt, fetch_size):
+        buffer = io.StringIO()
+        if fmt == self.EXPORT_CSV:
+            writer = csv.writer(buffer)
+            # 带 BOM 的 UTF-8，Excel 打开时中文不乱码
+            buffer.write('\ufeff')
+            writer.writerow(self.EXPORT_FIELDS)
+            # 表头立即输出，客户端马上就能收到第一批字节
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        count = 0
+        for row in rows:
+            if fmt == self.EXPORT_CSV:
+                writer.writerow([row[field] for field in self.EXPORT_FIELDS])
+            else:
+                buffer.write(json.dumps(row, ensure_ascii=False, default=str))
+                buffer.write('\n')
+            count += 1
+            if count % fetch_size == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+
+    # 导入的字段，不含 id，重复记录靠 time_amount 唯一键去重
+    IMPORT_FIELDS = EXPORT_FIELDS[1:]
+    # CSV 表头除了字段名，也可以用编辑页上的中文名称
+    IMPORT_ALIASES = {
+        '交易时间': 'transaction_time',
+        '收入金额': 'income_amount',
+        '支出金额': 'expense_amount',
+        '消费应用': 'transaction_app',
+        '支付平台': 'payment_platform',
+        '金融终端': 'financial_terminal',
+        '备注': 'memo',
+        '类别': 'category',
+    }
+    # 报告中最多列出的出错批次和无效行
+    IMPORT_MAX_ERRORS = 50
+
+    # 从 CSV 批量导入记录，lines 为逐行读取的文本流，整个文件不会一次读入内存
+    # 按 Table.insert_batches() 分批 INSERT IGNORE，已有的记录（time_amount 唯一键相同）自动跳过
+    # 某一批出错只记录在报告里，不影响其它批次
+    # return: 导入报告，包括总行数、新增、重复、无效行数、出错批次和每秒处理行数
+    def importReceipts(self, lines, batch_rows: int = Table.INSERT_BATCH_ROWS) -> dict:
+        report = {'rows': 0, 'inserted': 0, 'duplicates': 0, 'invalid': 0, 'batches': 0,
+                  'failed_rows': 0, 'errors': [], 'seconds': 0.0, 'rows_per_second': 0.0}
+        # 还没处理完的批次中，行序号对应的 CSV 行号，用来在报告中指出出错的行
+        line_numbers = {}
+        # 导入数据涉及的月份，导入后重建这些月份的统计
+        months = set()
         time_start = time.time()
-        
+
+        def records():
+            index = 0
+            reader = csv.DictReader(lines)
+            for row in reader:
+                report['rows'] += 1
+                record = {}
+                for key, value in row.items():
+                    field = self.IMPORT_ALIASES.get((key or '').strip(), (key or '').strip())
+                    if field in self.IMPORT_FIELDS:
+                        record[field] = (value or '').strip() or None
+                error = self._importError(record)
+                if error:
+                    report['invalid'] += 1
+                    if len(report['errors']) < self.IMPORT_MAX_ERRORS:
+                        report['errors'].append(f"第 {reader.line_num} 行: {error}")
+                    continue
+                line_numbers[index] = reader.line_num
+                index += 1
+                contribution = Summary.contribution(record)
+                if contribution:
+                    months.add(contribution[0][0])
+                # 每行都带上全部字段，保证同一批的列相同
+                yield {field: record.get(field) for field in self.IMPORT_FIELDS}
+
+        for batch in self.insert_batches(records(), Table.INSERT_IGNORE, batch_rows):
+            report['batches'] += 1
+            first_line = line_numbers[batch['first']]
+            last_line = line_numbers[batch['first'] + batch['rows'] - 1]
+            for i in range(batch['first'], batch['first'] + batch['rows']):
+                del line_numbers[i]
+            if batch['error']:
+                report['failed_rows'] += batch['rows']
+                if len(report['errors']) < self.IMPORT_MAX_ERRORS:
+                    report['errors'].append(f"第 {first_line}-{last_line} 行: {batch['error']}")
+            else:
+                report['inserted'] += batch['affected']
+                report['duplicates'] += batch['rows'] - batch['affected']
+
+        # 批量导入按月重新统计，比逐行累加差额少很多次写入
+        if report['inserted'] and months:
+            try:
+                Summary().rebuild(sorted(months))
+            except Exception as e:
+                report['errors'].append(f"更新月度统计失败，请运行 python -m models.Summary rebuild: {e}")
+
+        report['seconds'] = round(time.time() - time_start, 3)
+        if report['seconds'] > 0:
+            report['rows_per_second'] = round(report['rows'] / report['seconds'], 1)
+        return report
+
+    # 检查导入的一行数据，有问题时返回错误说明，金额去掉千分位和货币符号
+    def _importError(self, record: dict) -> str:
+        if not record.get('transaction_time'):
+            return '缺少交易时间'
+        for field in ('income_amount', 'expense_amount'):
+            value = record.get(field)
+            if value:
+                value = value.replace(',', '').replace('¥', '').replace('￥', '').strip()
+                try:
+                    float(value)
+                except ValueError:
+                    return f"金额格式错误 {field}={record[field]}"
+                record[field] = value
+        return ''
+
+    # 重置图片大小
+    # 手机截图尺寸比较大，经 ImagePipeline 旋转、裁白边、缩放，并按目标体积选择 PNG 或 JPEG 编码
+    # 参数由环境变量 IMAGE_MAX_WIDTH、IMAGE_TARGET_BYTES、IMAGE_GRAYSCALE、IMAGE_AUTOCROP、IMAGE_MAX_PIXELS 配置
+    # param image: 图片的字节，或上传时暂存的文件对象（直接从文件解码，不先读入内存）
+    # param max_width: 图片的最大宽度，默认为 IMAGE_MAX_WIDTH
+    # return: 处理后的图片的字节流
+    def resize(self, image, max_width: int = None) -> bytes:
+        return self.processImage(image, max_width)['bytes']
+
+    # 与 resize() 相同，但返回 ImagePipeline 的完整结果，包括感知哈希 hash
+    # 像素数超过 IMAGE_MAX_PIXELS 时抛出 ImageTooLargeError
+    def processImage(self, image, max_width: int = None) -> dict:
+        return ImagePipeline.from_env(debug=self.debug).process(image, max_width)
+
+    # 在调用模型之前，按感知哈希查找是否已经保存过同一张截图（重新截图、裁剪、压缩过的也算）
+    # return: 总是包含 image_hash；找到时还有 duplicate_of（已有记录的 ID）和 duplicate_distance（不同的位数）
+    def findDuplicate(self, image_hash: str) -> dict:
+        result = {'image_hash': image_hash}
+        found = DuplicateIndex.instance().nearest(image_hash)
+        if found:
+            result['duplicate_of'], result['duplicate_distance'] = found
+            print(f"Duplicate screenshot: record {found[0]}, distance {found[1]}")
+        return result
+
+    # 图片格式，用于拼 data URI 和调用模型时的图片类型
+    def imageFormat(self, image_bytes: bytes) -> str:
+        return ImagePipeline.sniff(image_bytes) or self.IMAGE_FORMAT
+
+    # 注意传图片体积太大时API会报错 {'error': {'code': '429', 'message': 'Rate limit is exceeded. Try again in 86400 seconds.'}}
+    # 虽说文档说文体体积最大512MB，实际200多KB的图片都会报错。换成小点的图片。
+    # 识别图片内容
+    # 同一张图片（缩放后的字节相同）再次上传时直接返回缓存的识别结果，不再调用模型
+    def recognize(self, image_bytes: bytes) -> dict:
+        cache_key, jsonContent = self.cachedRecognition(image_bytes)
+        if jsonContent is None:
+            jsonContent = self._recognize(base64.b64encode(image_bytes).decode("utf-8"), self.imageFormat(image_bytes))
+            # 识别失败的结果不缓存，用户重新上传时可以再试
+            if jsonContent:
+                RecognitionCache.instance().set(cache_key, jsonContent)
+        jsonContent.update(self.storeImage(image_bytes))
+        return jsonContent
+
+    # 查找识别结果缓存
+    # return: (缓存键, 缓存的识别结果)，未命中时结果为 None
+    def cachedRecognition(self, image_bytes: bytes):
+        cache = RecognitionCache.instance()
+        cache_key = cache.key(image_bytes, self.promptVersion())
+        jsonContent = cache.get(cache_key)
+        Metrics.inc('aifun_recognition_cache_total', result='miss' if jsonContent is None else 'hit')
+        if jsonContent is not None:
+            print(f"Recognition cache hit: {cache_key}")
+        return cache_key, jsonContent
+
+    # 把图片存入按内容哈希寻址的 BlobStore，页面通过 /img/<哈希> 引用，不再把 base64 内嵌到 HTML 中
+    # return: preview_image 为预览图地址，source_image 为图片哈希，保存记录时一起存入数据库
+    def storeImage(self, image_bytes: bytes) -> dict:
+        blob_hash = BlobStore.instance().put(image_bytes)
+        return {'preview_image': f'/img/{blob_hash}', 'source_image': blob_hash}
+
+    # 流式识别图片内容，模型每输出完整一个字段就返回一个，编辑页可以边识别边填写
+    # 分级、升级规则与 _recognize() 相同，但不对冲：精简识别的字段已经在页面上显示，不能再与并行的完整识别合并
+    # return: 产生 (字段名, 值) 的生成器；命中缓存时一次产生全部字段
+    def recognizeStream(self, image_bytes: bytes):
+        cache_key, jsonContent = self.cachedRecognition(image_bytes)
+        if jsonContent is not None:
+            yield from jsonContent.items()
+            return
+
+        b64_image = base64.b64encode(image_bytes).decode("utf-8")
+        image_format = self.imageFormat(image_bytes)
+        time_begin = time.perf_counter()
+        if self.RECOGNIZE_TIERED:
+            llm = LlmQwen(self.LIGHT_MODEL, read_timeout=self.LIGHT_TIMEOUT, max_retries=0)
+            jsonContent = yield from self._streamFields(llm, self.LIGHT_PROMPT, b64_image, image_format,
+                                                        self.LIGHT_MAX_TOKENS)
+            if self.lightResult(jsonContent) is not None:
+                fields = self.completeFields(jsonContent)
+                yield from fields.items()
+                jsonContent.update(fields)
+                RecognitionCache.instance().set(cache_key, jsonContent)
+                Metrics.observe('aifun_recognition_route_seconds', time.perf_counter() - time_begin, route='light')
+                return
+            # 已经输出的字段会被完整识别的结果覆盖
+
+        jsonContent = yield from self._streamFields(LlmQwen(), self.PROMPT, b64_image, image_format)
+        if jsonContent:
+            RecognitionCache.instance().set(cache_key, jsonContent)
+        if self.RECOGNIZE_TIERED:
+            Metrics.observe('aifun_recognition_route_seconds', time.perf_counter() - time_begin, route='escalated')
+
+    # 流式识别，逐个产生 (字段名, 值)，结束后返回解析出的全部字段；调用模型出错时返回 None，精简识别按 'error' 统计
+    def _streamFields(self, llm, prompt, b64_image, image_format, max_tokens=1024):
+        parser = JsonFieldParser()
+        chunks = []
+        try:
+            for delta in llm.chat_stream(prompt, b64_image, image_format, max_tokens=max_tokens):
+                chunks.append(delta)
+                yield from parser.feed(delta)
+        except Exception as e:
+            # 响应已经开始输出，不能再返回错误页，只记录日志，由用户手工填写
+            print(f"Recognize stream failed: {e}")
+            return None
+
+        # 流结束后按完整文本再解析一次，补上增量解析时漏掉的字段（如最后一个数字后面没有右括号）
+        jsonContent = self.parseContent(''.join(chunks))
+        for key, value in jsonContent.items():
+            if key not in parser.result or parser.result[key] != value:
+                yield key, value
+        return jsonContent
+
+    # 精简识别的结果是否可用：交易时间是 2000 年以后、不晚于明天的有效时间，至少有一个大于 0 的金额
+    def lightComplete(self, jsonContent: dict) -> bool:
+        try:
+            transaction_time = datetime.datetime.fromisoformat(str(jsonContent.get('transaction_time') or '').strip())
+        except ValueError:
+            return False
+        transaction_time = transaction_time.replace(tzinfo=None)
+        if not datetime.datetime(2000, 1, 1) <= transaction_time <= datetime.datetime.now() + datetime.timedelta(days=1):
+            return False
+        for field in ('income_amount', 'expense_amount'):
+            try:
+                if Decimal(str(jsonContent.get(field) or 0).replace(',', '')) > 0:
+                    return True
+            except InvalidOperation:
+                pass
+        return False
+
+    # 补全精简识别没有的字段：先按商户查 MerchantMemo，查不到类别时用文本模型判断
+    # return: 补全的字段
+    def completeFields(self, jsonContent: dict) -> dict:
+        fields, categories = self.learnedFields(jsonContent)
+        tier = 'memo'
+        if categories:
+            tier = 'classify'
+            fields['category'] = self.classify({**jsonContent, **fields}, categories)
+        Metrics.inc('aifun_recognition_tier_total', tier=tier)
+        return fields
+
+    # 按商户查 MerchantMemo 得到的、识别结果中没有的字段
+    # return: (字段, 候选类别)，查到了类别、不需要模型判断时候选类别为空列表
+    def learnedFields(self, jsonContent: dict) -> tuple:
+        memo = MerchantMemo.instance()
+        learned = memo.lookup(jsonContent.get('transaction_app'))
+        fields = {field: value for field, value in learned.items() if not jsonContent.get(field)}
+        if jsonContent.get('category') or 'category' in fields:
+            return fields, []
+        return fields, memo.categories() or self.CATEGORIES
+
+    # 用文本模型判断类别，出错时返回空字符串，由用户填写
+    def classify(self, jsonContent: dict, categories: list) -> str:
+        try:
+            category = LlmQwen(self.TEXT_MODEL).chat(self.categoryPrompt(jsonContent, categories),
+                                                     max_tokens=self.CATEGORY_MAX_TOKENS)
+        except Exception as e:
+            print(f"Classify failed: {e}")
+            return ''
+        return self.cleanCategory(category)
+
+    def categoryPrompt(self, jsonContent: dict, categories: list) -> str:
+        return self.CATEGORY_PROMPT.format(categories='、'.join(categories),
+                                           merchant=jsonContent.get('transaction_app') or '',
+                                           memo=jsonContent.get('memo') or '')
+
+    # 去掉模型回答中多余的引号和空白，长度不超过 category 字段
+    def cleanCategory(self, category: str) -> str:
+        return category.strip().strip('"').strip()[:16]
+
+    # 提示语和模型的版本标识，任何一个改变后旧的缓存结果自然失效
+    # 分级识别时结果可能来自精简识别和类别判断，它们的模型和提示语也计入版本
+    def promptVersion(self) -> str:
+        parts = [LlmQwen.MODEL, self.PROMPT, self.BATCH_PROMPT]
+        if self.RECOGNIZE_TIERED:
+            parts += ['tiered', self.LIGHT_MODEL, self.LIGHT_PROMPT, self.TEXT_MODEL, self.CATEGORY_PROMPT]
+        return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+    # 调用模型识别图片，每个模型的耗时和 token 用量由 LlmQwen 记录到 Metrics
+    # 分级识别时按最终采用的路径（light、escalated、hedged）记录整张图片的识别耗时
+    def _recognize(self, b64_image: str, image_format: str) -> dict:
+        if not self.RECOGNIZE_TIERED:
+            return self._recognizeFull(b64_image, image_format)
+        time_begin = time.perf_counter()
+        if self.RECOGNIZE_HEDGE_SECONDS > 0:
+            route, jsonContent = self._recognizeHedged(b64_image, image_format)
+        else:
+            jsonContent = self._recognizeLight(b64_image, image_format)
+            route = 'light'
+            if jsonContent is None:
+                route = 'escalated'
+                jsonContent = self._recognizeFull(b64_image, image_format)
+        if route == 'light':
+            jsonContent.update(self.completeFields(jsonContent))
+        Metrics.observe('aifun_recognition_route_seconds', time.perf_counter() - time_begin, route=route)
+        return jsonContent
+
+    # 用快速模型做精简识别
+    # return: 校验通过的结果；超时、出错或校验不通过时为 None，由调用方升级到大模型
+    def _recognizeLight(self, b64_image: str, image_format: str):
+        llm = LlmQwen(self.LIGHT_MODEL, read_timeout=self.LIGHT_TIMEOUT, max_retries=0)
+        try:
+            jsonContent = self.parseContent(llm.chat(self.LIGHT_PROMPT, b64_image, image_format,
+                                                     max_tokens=self.LIGHT_MAX_TOKENS))
+        except Exception as e:
+            print(f"Light recognition failed: {e}")
+            return self.lightResult(None)
+        return self.lightResult(jsonContent)
+
+    # 记录精简识别的结果是否被采用，按 outcome 统计升级到大模型的比例
+    def lightResult(self, jsonContent):
+        if jsonContent is None:
+            outcome = 'error'
+        elif self.lightComplete(jsonContent):
+            outcome = 'accepted'
+        else:
+            outcome = 'invalid'
+            jsonContent = None
+        Metrics.inc('aifun_recognition_light_total', model=self.LIGHT_MODEL, outcome=outcome)
+        if jsonContent is None:
+            Metrics.inc('aifun_recognition_tier_total', tier='full')
+            print("Light recognition unusable, escalate to full prompt")
+        return jsonContent
+
+    # 用大模型和完整提示语识别
+    def _recognizeFull(self, b64_image: str, image_format: str) -> dict:
         # 创建LlmQwen实例并调用图像识别功能
         llm = LlmQwen()
-        strContent = llm.chat(prompt, b64_image, self.IMAGE_FORMAT)
-        
-        time_end = time.time()
-        print(f"Qwen model: {llm.model}, Time taken for completion: {time_end - time_start} seconds")
-        
+        strContent = llm.chat(self.PROMPT, b64_image, image_format)
+        return self.parseContent(strContent)
+
+    # 对冲的精简识别：快速模型超过 RECOGNIZE_HEDGE_SECONDS 秒没有返回时，同时发出完整识别
+    # 快速模型先返回可用结果时采用它；完整识别先返回时采用完整识别，快速模型的请求在后台结束后丢弃
+    # return: (路径, 识别结果)
+    def _recognizeHedged(self, b64_image: str, image_format: str) -> tuple:
+        executor = self.hedgeExecutor()
+        started = threading.Event()
+
+        def recognizeLight():
+            started.set()
+            return self._recognizeLight(b64_image, image_format)
+
+        light = executor.submit(recognizeLight)
+        # 从快速模型的请求真正开始时计时，线程池繁忙时在队列中等待的时间不算，避免负载高时每个请求都对冲、进一步加重负载
+        started.wait()
+        try:
+            jsonContent = light.result(timeout=self.RECOGNIZE_HEDGE_SECONDS)
+        except FutureTimeoutError:
+            Metrics.inc('aifun_recognition_hedged_total', model=self.LIGHT_MODEL)
+            full = executor.submit(self._recognizeFull, b64_image, image_format)
+            done, _ = wait((light, full), return_when=FIRST_COMPLETED)
+            if light in done and light.result() is not None:
+                return 'light', light.result()
+            return 'hedged', full.result()
+        if jsonContent is not None:
+            return 'light', jsonContent
+        return 'escalated', self._recognizeFull(b64_image, image_format)
+
+    # 解析模型返回的文本
+    def parseContent(self, strContent: str) -> dict:
         # 即使在提示语中加上"仅返回JSON"，还是有可能返回形如  ```json {  "transaction_time": "2025-02-17 08:30:11",}``` 带markdown的字符串，需要去掉。
         strContent = strContent.strip().replace("```json", "").replace("```", "").strip()
         # 尝试使用 json.loads() 解析，它比 eval 更安全
@@ -97,19 +667,183 @@ class Receipt(Table):
             print(f"JSON解析错误: {e}")
             print(f"尝试解析的内容: {strContent}")
             jsonContent = {}
-        # 读取到的图片文件内容输出成可以显示在 HTML 中的图片格式
-        jsonContent['preview_image'] = 'data:image/'+self.IMAGE_FORMAT+';base64,' + b64_image
+        # 返回空或者不是 JSON 对象时按识别失败处理
+        if not isinstance(jsonContent, dict):
+            jsonContent = {}
         return jsonContent
 
+    # 解析合并请求返回的 JSON 数组，按元素的 index 字段（没有时按位置）对应到每张图片
+    # return: 长度为 count 的列表，某张图片在回答中缺失或格式不对时为 None
+    def parseContents(self, strContent: str, count: int) -> list:
+        strContent = strContent.strip().replace("```json", "").replace("```", "").strip()
+        try:
+            items = json.loads(strContent)
+        except json.JSONDecodeError as e:
+            print(f"JSON解析错误: {e}")
+            print(f"尝试解析的内容: {strContent}")
+            items = []
+        if not isinstance(items, list):
+            items = []
+        results = [None] * count
+        for position, item in enumerate(items):
+            if not isinstance(item, dict):
+                continue
+            index = item.pop('index', None)
+            index = index - 1 if isinstance(index, int) and 1 <= index <= count else position
+            if index < count and results[index] is None:
+                results[index] = item
+        return results
+
+    # 并发识别多张图片的线程池，每个进程共享一个，线程数即同时调用模型的上限
+    RECOGNIZE_WORKERS = int(os.environ.get('RECOGNIZE_WORKERS') or 4)
+    _executor = None
+    _executor_pid = None
+    _executor_lock = threading.Lock()
+
+    @classmethod
+    def executor(cls) -> ThreadPoolExecutor:
+        with cls._executor_lock:
+            if cls._executor is None or cls._executor_pid != os.getpid():
+                cls._executor = ThreadPoolExecutor(max_workers=cls.RECOGNIZE_WORKERS, thread_name_prefix='recognize')
+                cls._executor_pid = os.getpid()
+            return cls._executor
+
+    # 对冲识别的线程池，与 executor() 分开，识别线程等待对冲结果时不会占满同一个线程池
+    _hedge_executor = None
+    _hedge_executor_pid = None
+
+    @classmethod
+    def hedgeExecutor(cls) -> ThreadPoolExecutor:
+        with cls._executor_lock:
+            if cls._hedge_executor is None or cls._hedge_executor_pid != os.getpid():
+                cls._hedge_executor = ThreadPoolExecutor(max_workers=cls.RECOGNIZE_WORKERS * 2,
+                                                         thread_name_prefix='hedge')
+                cls._hedge_executor_pid = os.getpid()
+            return cls._hedge_executor
+
+    # 合并成一次请求的最多图片张数，1 表示不合并，每张图片单独请求
+    RECOGNIZE_BATCH_SIZE = int(os.environ.get('RECOGNIZE_BATCH_SIZE') or 4)
+
+    # 批量识别多张图片
+    # 先在线程池中并发缩放、查重和查缓存；没有命中的图片每 RECOGNIZE_BATCH_SIZE 张合并成一次请求，提示语只发送一次，
+    # 各组请求也并发执行。合并请求中没有解析出结果的图片，再逐张单独识别
+    # param images: 每张图片的字节或上传时暂存的文件对象
+    # return: 与 images 顺序一致的识别结果，某张图片出错时对应结果中有 error 字段
+    def recognizeBatch(self, images: list) -> list:
+        results = [None] * len(images)
+        pending = {}
+        futures = [self.executor().submit(self.prepareImage, image) for image in images]
+        for i, future in enumerate(futures):
+            try:
+                item = future.result()
+            except Exception as e:
+                print(f"Recognize failed: {e}")
+                results[i] = {'error': str(e)}
+                continue
+            if 'result' in item:
+                results[i] = item['result']
+            else:
+                pending[i] = item
+
+        size = max(1, self.RECOGNIZE_BATCH_SIZE)
+        indexes = list(pending)
+        groups = [indexes[start:start + size] for start in range(0, len(indexes), size)]
+        futures = [(group, self.executor().submit(self._recognizeGroup, [pending[i] for i in group])) for group in groups]
+        retry = []
+        for group, future in futures:
+            try:
+                contents = future.result()
+            except Exception as e:
+                print(f"Recognize failed: {e}")
+                contents = [e] * len(group)
+            for i, content in zip(group, contents):
+                if isinstance(content, dict):
+                    results[i] = self.finishRecognition(pending[i], content)
+                elif len(group) > 1:
+                    retry.append(i)
+                else:
+                    results[i] = {'error': str(content)}
+
+        if retry:
+            print(f"Recognize {len(retry)} images one by one after batch request")
+        futures = [(i, self.executor().submit(self._recognizeGroup, [pending[i]])) for i in retry]
+        for i, future in futures:
+            try:
+                content = future.result()[0]
+            except Exception as e:
+                content = e
+            if isinstance(content, dict):
+                results[i] = self.finishRecognition(pending[i], content)
+            else:
+                print(f"Recognize failed: {content}")
+                results[i] = {'error': str(content)}
+        return results
+
+    # 缩放并识别一张上传的原始图片（字节或文件对象）
+    # 与已保存的截图重复时不调用模型，只返回图片和 duplicate_of，由确认页提示用户
+    def recognizeImage(self, image) -> dict:
+        item = self.prepareImage(image)
+        if 'result' in item:
+            return item['result']
+        return self.finishRecognition(item, self._recognizeGroup([item])[0])
+
+    # 调用模型之前的准备：缩放、查找重复截图、查找识别结果缓存
+    # return: bytes、hash、cache_key；重复或命中缓存时不需要再调用模型，result 为最终结果
+    def prepareImage(self, image) -> dict:
+        processed = self.processImage(image)
+        item = {'bytes': processed['bytes'], 'hash': processed['hash']}
+        duplicate = self.findDuplicate(processed['hash'])
+        if 'duplicate_of' in duplicate:
+            item['result'] = {**self.storeImage(processed['bytes']), **duplicate}
+            return item
+        item['cache_key'], jsonContent = self.cachedRecognition(processed['bytes'])
+        if jsonContent is not None:
+            item['result'] = self.finishRecognition(item, jsonContent, cache=False)
+        return item
+
+    # 识别结果加上图片地址和感知哈希，识别成功时写入缓存
+    def finishRecognition(self, item: dict, jsonContent: dict, cache: bool = True) -> dict:
+        if jsonContent and cache:
+            RecognitionCache.instance().set(item['cache_key'], jsonContent)
+        jsonContent.update(self.storeImage(item['bytes']))
+        jsonContent['image_hash'] = item['hash']
+        return jsonContent
+
+    # 识别一组 prepareImage() 准备好的图片，只有一张时使用单张的提示语
+    # return: 与 items 顺序一致的识别结果，合并请求的回答中缺失的图片为 None
+    def _recognizeGroup(self, items: list) -> list:
+        images = [(base64.b64encode(item['bytes']).decode("utf-8"), self.imageFormat(item['bytes'])) for item in items]
+        if len(images) == 1:
+            return [self._recognize(*images[0])]
+        llm = LlmQwen()
+        prompt = self.BATCH_PROMPT.replace('{count}', str(len(images)))
+        strContent = llm.chat_images(prompt, images, max_tokens=self.MAX_TOKENS_EACH * len(images))
+        return self.parseContents(strContent, len(images))
+
     # 保存识别结果
     def save(self, receipt: dict) -> int:
-        # 保存到数据库
-        tableAccount = Table('accounting', debug=True)
-        res = tableAccount.add(receipt)
+        # 保存到数据库，连接来自共享连接池，不必再单独建一个 Table 实例
+        res = self.add(receipt)
+        # 真正新增了记录（不是被唯一键忽略的重复记录）时才累加到月度统计
+        if res == 1:
+            Summary().applyDelta(None, receipt)
+            MerchantMemo.instance().learn(None, receipt)
+            # 把新记录的截图哈希加入本进程的重复截图索引
+            if receipt.get('image_hash'):
+                DuplicateIndex.instance().refresh()
         return res
 
 if __name__ == '__main__':
     receipt = Receipt()
+    # python -m models.Receipt search-index  创建 /search 使用的全文索引，没有索引时关键词用 LIKE 查找
+    if sys.argv[1:] == ['search-index']:
+        print("Full-text index ready" if receipt.createSearchIndex() else "Failed to create full-text index")
+        sys.exit()
+    # python -m models.Receipt migrate  给 accounting 表补上新版本用到的字段（source_image、image_hash），已有的字段跳过
+    if sys.argv[1:] == ['migrate']:
+        added = receipt.migrate()
+        print("Migration failed" if added is None else f"Added columns: {', '.join(added) or 'none'}")
+        sys.exit()
     # 读取测试图片
     with open('j.jpg', 'rb') as f:
         image_bytes = f.read()
@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+
+class RecognitionCache:
+    """
+    图片识别结果缓存，按图片内容和提示语版本的哈希值查找。
+    内存中是有容量上限的 LRU，可选的磁盘层保存为 JSON 文件，服务重启后仍然有效。
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, max_entries: int = 256, directory: str = None):
+        """
+        :param max_entries: 内存中最多缓存的条数，0 表示不使用内存层
+        :param directory: 磁盘缓存目录，为空时不使用磁盘层
+        """
+        self.max_entries = max_entries
+        self.directory = directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._hits_memory = 0
+        self._hits_disk = 0
+        self._misses = 0
+
+    @classmethod
+    def instance(cls) -> 'RecognitionCache':
+        """
+        获取进程内共享的缓存，参数来自环境变量 RECOGNITION_CACHE_SIZE 和 RECOGNITION_CACHE_DIR
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls(
+                    max_entries=int(os.environ.get("RECOGNITION_CACHE_SIZE") or 256),
+                    directory=os.environ.get("RECOGNITION_CACHE_DIR") or None,
+                )
+            return cls._instance
+
+    @staticmethod
+    def key(image_bytes: bytes, version: str) -> str:
+        """
+        缓存键：提示语版本和图片字节的 SHA-256
+        """
+        digest = hashlib.sha256(version.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(image_bytes)
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        """
+        查找缓存，未命中返回 None。返回的是副本，调用方修改不会影响缓存
+        """
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self._hits_memory += 1
+                return dict(value)
+
+        value = self._read_disk(key)
+        with self._lock:
+            if value is None:
+                self._misses += 1
+                return None
+            self._hits_disk += 1
+            self._remember(key, value)
+        return dict(value)
+
+    def set(self, key: str, value: dict):
+        value = dict(value)
+        with self._lock:
+            self._remember(key, value)
+        self._write_disk(key, value)
+
+    def _remember(self, key, value):
+        if self.max_entries <= 0:
+            return
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _path(self, key):
+        # 按哈希前两位分子目录，避免单个目录下文件过多
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def _read_disk(self, key):
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Failed to read recognition cache {key}: {e}")
+            return None
+
+    def _write_disk(self, key, value):
+        if not self.directory:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 先写临时文件再改名，其它进程不会读到写了一半的文件
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(value, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Failed to write recognition cache {key}: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self._hits_memory + self._hits_disk
+            total = hits + self._misses
+            return {
+                'entries': len(self._memory),
+                'max_entries': self.max_entries,
+                'hits_memory': self._hits_memory,
+                'hits_disk': self._hits_disk,
+                'misses': self._misses,
+                'hit_rate': round(hits / total, 4) if total else 0.0,
+            }
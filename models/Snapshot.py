@@ -0,0 +1,371 @@
+import array
+import csv
+import datetime
+import hashlib
+import json
+import os
+import struct
+import sys
+import time
+import zlib
+from decimal import Decimal
+
+from .Table import Table
+
+
+class Snapshot:
+    """
+    accounting 表的增量快照，用于备份和离线分析。
+    每次导出只读取上次导出之后新增或修改过的记录（按 updated_at 和 id 的水位线），
+    追加成一个按列存储、zlib 压缩的段文件；manifest.json 记录字段、水位线和全部段文件。
+    同一条记录修改后会出现在多个段中，读取时以最后一个段为准；段文件超过 max_segments 个时合并。
+    表上没有删除记录的操作，直接在数据库中删除的记录不会从快照中消失。
+    """
+    MAGIC = b'ACSNAP1\n'
+    MANIFEST = 'manifest.json'
+    FORMAT_VERSION = 1
+
+    # 列类型：整数、金额（按分存成整数）、时间（秒数）、字符串，都可以为空
+    TYPE_INT = 'i'
+    TYPE_DECIMAL = 'd'
+    TYPE_DATETIME = 't'
+    TYPE_STRING = 's'
+
+    COLUMNS = [
+        ('id', TYPE_INT),
+        ('transaction_time', TYPE_DATETIME),
+        ('income_amount', TYPE_DECIMAL),
+        ('expense_amount', TYPE_DECIMAL),
+        ('transaction_app', TYPE_STRING),
+        ('payment_platform', TYPE_STRING),
+        ('financial_terminal', TYPE_STRING),
+        ('memo', TYPE_STRING),
+        ('category', TYPE_STRING),
+        ('source_image', TYPE_STRING),
+        ('image_hash', TYPE_STRING),
+        ('updated_at', TYPE_DATETIME),
+    ]
+
+    # 水位线用到的修改时间字段：插入时为当前时间，任何字段被修改时由 MySQL 自动更新
+    # InnoDB 的二级索引按 (updated_at, 主键 id) 排序，按水位线读取不用扫描全表
+    MIGRATE_SQL = ("ALTER TABLE accounting ADD COLUMN updated_at TIMESTAMP NOT NULL "
+                   "DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP, ADD INDEX updated_at (updated_at)")
+
+    EPOCH = datetime.datetime(1970, 1, 1)
+
+    def __init__(self, directory: str, segment_rows: int = 100000, max_segments: int = 8, overlap: float = 300,
+                 fetch_size: int = Table.ITER_FETCH_SIZE):
+        """
+        :param directory: 快照目录，存放 manifest.json 和段文件
+        :param segment_rows: 每个段文件最多的行数，导出时内存中最多缓存这么多行
+        :param max_segments: 段文件超过这个数量时，导出后合并成一个
+        :param overlap: 每次导出从水位线往前多读的秒数。updated_at 只精确到秒，而且事务提交的顺序与时间戳的顺序不一定相同，
+                        多读一段重叠的时间，避免漏掉水位线附近晚提交的修改；重叠窗口内已经导出过的版本按内容摘要记在 manifest 的
+                        recent 中，再次读到内容相同的行时跳过
+        :param fetch_size: 每次从服务端游标读取的行数
+        """
+        self.directory = directory
+        self.segment_rows = segment_rows
+        self.max_segments = max_segments
+        self.overlap = overlap
+        self.fetch_size = fetch_size
+
+    @classmethod
+    def from_env(cls) -> 'Snapshot':
+        default = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'snapshot')
+        return cls(
+            os.environ.get('SNAPSHOT_DIR') or default,
+            segment_rows=int(os.environ.get('SNAPSHOT_SEGMENT_ROWS') or 100000),
+            max_segments=int(os.environ.get('SNAPSHOT_MAX_SEGMENTS') or 8),
+            overlap=float(os.environ.get('SNAPSHOT_OVERLAP_SECONDS') or 300),
+        )
+
+    def manifest(self) -> dict:
+        """
+        读取 manifest.json，还没有导出过时返回空快照
+        """
+        path = os.path.join(self.directory, self.MANIFEST)
+        if not os.path.exists(path):
+            return {'format': self.FORMAT_VERSION, 'table': 'accounting', 'columns': self.COLUMNS,
+                    'watermark': None, 'next_segment': 1, 'segments': []}
+        with open(path, encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('format') != self.FORMAT_VERSION:
+            raise ValueError(f"不支持的快照格式版本: {manifest.get('format')}")
+        return manifest
+
+    def _save_manifest(self, manifest: dict):
+        # 先写临时文件再替换，中途退出时 manifest.json 仍是上一个完整的版本，多写出的段文件在合并时清理
+        path = os.path.join(self.directory, self.MANIFEST)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def export(self) -> dict:
+        """
+        导出上次水位线之后新增和修改的记录，每满 segment_rows 行写一个段文件并推进水位线
+        :return: {'rows': 导出行数, 'segments': 新写的段文件数, 'watermark': 新水位线, 'merged': 是否合并了段文件}
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        manifest = self.manifest()
+        watermark = manifest['watermark']
+        table = Table('accounting')
+        table.select(*[name for name, _ in self.COLUMNS])
+        if watermark:
+            if self.overlap > 0:
+                since = datetime.datetime.strptime(watermark['updated_at'], '%Y-%m-%d %H:%M:%S') \
+                        - datetime.timedelta(seconds=self.overlap)
+                table.where('updated_at', '>=', since.strftime('%Y-%m-%d %H:%M:%S'))
+            else:
+                table.seek(['updated_at', 'id'], [watermark['updated_at'], watermark['id']], Table.ORDER_ASC)
+        rows = table.order_by('updated_at', 'ASC', 'id', 'ASC').iter(self.fetch_size, Table.ROW_TUPLE)
+
+        # 重叠窗口内上次已经导出过的版本 (id, 内容摘要)，再次读到内容相同的行时跳过，没有变化时不会写出重复的段文件。
+        # 不能只比较 updated_at：它只精确到秒，同一秒内导出后又修改的记录 updated_at 不变，内容却不同
+        exported_before = {(key[0], key[2]) for key in manifest.get('recent', []) if len(key) > 2}
+        exported = 0
+        segments = 0
+        batch = []
+        for row in rows:
+            if (int(row.id), self._digest(row)) in exported_before:
+                continue
+            batch.append(row)
+            if len(batch) >= self.segment_rows:
+                self._append(manifest, batch)
+                exported += len(batch)
+                segments += 1
+                batch = []
+        if batch:
+            self._append(manifest, batch)
+            exported += len(batch)
+            segments += 1
+        merged = len(manifest['segments']) > self.max_segments
+        if merged:
+            self.merge()
+        print(f"Snapshot export: {exported} rows, {segments} segments, watermark {manifest['watermark']}")
+        return {'rows': exported, 'segments': segments, 'watermark': manifest['watermark'], 'merged': merged}
+
+    def _append(self, manifest: dict, rows: list):
+        # 写段文件，再把它和新的水位线一起写入 manifest
+        name = f"segment-{manifest['next_segment']:06d}.acs"
+        size = self._write_segment(os.path.join(self.directory, name), rows)
+        manifest['segments'].append({'file': name, 'rows': len(rows), 'bytes': size,
+                                     'created': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
+        manifest['next_segment'] += 1
+        # 水位线只前进：重叠窗口中晚提交的修改 updated_at 可能比当前水位线还早
+        last = max(((self._format_time(row.updated_at), int(row.id)) for row in rows))
+        watermark = manifest['watermark']
+        if not watermark or last > (watermark['updated_at'], watermark['id']):
+            manifest['watermark'] = {'updated_at': last[0], 'id': last[1]}
+        if self.overlap > 0:
+            # 只保留下次导出的重叠窗口内还会再读到的版本
+            since = (datetime.datetime.strptime(manifest['watermark']['updated_at'], '%Y-%m-%d %H:%M:%S')
+                     - datetime.timedelta(seconds=self.overlap)).strftime('%Y-%m-%d %H:%M:%S')
+            recent = manifest.get('recent', []) + [[int(row.id), self._format_time(row.updated_at), self._digest(row)]
+                                                   for row in rows]
+            manifest['recent'] = [key for key in recent if key[1] >= since]
+        self._save_manifest(manifest)
+
+    @staticmethod
+    def _digest(row) -> str:
+        # 导出的全部字段的摘要，字段值相同的两个版本摘要相同
+        text = '\x1f'.join('' if value is None else str(value) for value in row)
+        return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _format_time(value) -> str:
+        if isinstance(value, datetime.datetime):
+            return value.strftime('%Y-%m-%d %H:%M:%S')
+        return str(value)[:19]
+
+    def _write_segment(self, path: str, rows: list) -> int:
+        """
+        段文件格式（小端）：MAGIC、行数 uint32、列数 uint16，然后每列依次是
+        名称长度 uint16、名称、类型 1 字节、数据长度 uint32、zlib 压缩的数据。
+        每列数据是每行一个字节的空值标记，加上 int64 数组（整数、按分计的金额、1970 年起的秒数），
+        或者 uint32 的 UTF-8 字节长度数组加上依次拼接的字符串
+        """
+        chunks = [self.MAGIC, struct.pack('<IH', len(rows), len(self.COLUMNS))]
+        for index, (name, kind) in enumerate(self.COLUMNS):
+            values = [row[index] for row in rows]
+            payload = zlib.compress(self._encode_column(kind, values), 6)
+            name_bytes = name.encode('utf-8')
+            chunks.append(struct.pack('<H', len(name_bytes)) + name_bytes + kind.encode('ascii')
+                          + struct.pack('<I', len(payload)))
+            chunks.append(payload)
+        data = b''.join(chunks)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        return len(data)
+
+    def _encode_column(self, kind: str, values: list) -> bytes:
+        # Table 把 NULL 转换成了空字符串，这里统一按空值保存
+        nulls = bytes(1 if value is None or value == '' else 0 for value in values)
+        if kind == self.TYPE_STRING:
+            encoded = [b'' if value is None else str(value).encode('utf-8') for value in values]
+            lengths = array.array('I', [len(value) for value in encoded])
+            return nulls + self._little_endian(lengths) + b''.join(encoded)
+        if kind == self.TYPE_DECIMAL:
+            numbers = [0 if null else int(Decimal(str(value)).scaleb(2)) for value, null in zip(values, nulls)]
+        elif kind == self.TYPE_DATETIME:
+            numbers = [0 if null else int((self._datetime(value) - self.EPOCH).total_seconds())
+                       for value, null in zip(values, nulls)]
+        else:
+            numbers = [0 if null else int(value) for value, null in zip(values, nulls)]
+        return nulls + self._little_endian(array.array('q', numbers))
+
+    @staticmethod
+    def _datetime(value) -> datetime.datetime:
+        if isinstance(value, datetime.datetime):
+            return value
+        return datetime.datetime.strptime(str(value)[:19], '%Y-%m-%d %H:%M:%S')
+
+    @staticmethod
+    def _little_endian(values: array.array) -> bytes:
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values.tobytes()
+
+    def read_segment(self, path: str) -> dict:
+        """
+        读取一个段文件
+        :return: {字段名: 值列表}，金额为 Decimal，时间为 datetime，空值为 None
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+        if data[:len(self.MAGIC)] != self.MAGIC:
+            raise ValueError(f"不是快照段文件: {path}")
+        offset = len(self.MAGIC)
+        count, column_count = struct.unpack_from('<IH', data, offset)
+        offset += 6
+        columns = {}
+        for _ in range(column_count):
+            (name_length,) = struct.unpack_from('<H', data, offset)
+            offset += 2
+            name = data[offset:offset + name_length].decode('utf-8')
+            offset += name_length
+            kind = chr(data[offset])
+            (payload_length,) = struct.unpack_from('<I', data, offset + 1)
+            offset += 5
+            columns[name] = self._decode_column(kind, zlib.decompress(data[offset:offset + payload_length]), count)
+            offset += payload_length
+        return columns
+
+    def _decode_column(self, kind: str, payload: bytes, count: int) -> list:
+        nulls = payload[:count]
+        if kind == self.TYPE_STRING:
+            lengths = self._from_little_endian('I', payload[count:count * 5])
+            values = []
+            offset = count * 5
+            for null, length in zip(nulls, lengths):
+                values.append(None if null else payload[offset:offset + length].decode('utf-8'))
+                offset += length
+            return values
+        numbers = self._from_little_endian('q', payload[count:])
+        if kind == self.TYPE_DECIMAL:
+            return [None if null else Decimal(number).scaleb(-2) for null, number in zip(nulls, numbers)]
+        if kind == self.TYPE_DATETIME:
+            return [None if null else self.EPOCH + datetime.timedelta(seconds=number) for null, number in zip(nulls, numbers)]
+        return [None if null else number for null, number in zip(nulls, numbers)]
+
+    @staticmethod
+    def _from_little_endian(typecode: str, data: bytes) -> array.array:
+        values = array.array(typecode)
+        values.frombytes(data)
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+
+    def latest(self) -> dict:
+        """
+        按 manifest 中的顺序读取全部段文件，同一条记录取最后一次导出的版本
+        :return: {id: 行字典}
+        """
+        records = {}
+        for segment in self.manifest()['segments']:
+            columns = self.read_segment(os.path.join(self.directory, segment['file']))
+            names = list(columns)
+            for values in zip(*columns.values()):
+                row = dict(zip(names, values))
+                records[row['id']] = row
+        return records
+
+    def rows(self):
+        """
+        按 id 顺序逐行产生快照中每条记录的最新版本，用于离线分析
+        """
+        records = self.latest()
+        for record_id in sorted(records):
+            yield records[record_id]
+
+    def merge(self) -> dict:
+        """
+        把全部段文件合并成按 id 排序、每条记录只有一个版本的新段文件，再删除旧段文件和 manifest 中没有的残留文件
+        :return: {'rows': 合并后的行数, 'segments': 合并后的段文件数}
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        manifest = self.manifest()
+        records = self.latest()
+        names = [name for name, _ in self.COLUMNS]
+        ordered = [tuple(records[record_id].get(name) for name in names) for record_id in sorted(records)]
+        segments = []
+        for start in range(0, len(ordered), self.segment_rows):
+            rows = ordered[start:start + self.segment_rows]
+            name = f"segment-{manifest['next_segment']:06d}.acs"
+            size = self._write_segment(os.path.join(self.directory, name), rows)
+            segments.append({'file': name, 'rows': len(rows), 'bytes': size,
+                             'created': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
+            manifest['next_segment'] += 1
+        manifest['segments'] = segments
+        self._save_manifest(manifest)
+        keep = {segment['file'] for segment in segments} | {self.MANIFEST}
+        for name in os.listdir(self.directory):
+            if name not in keep and (name.startswith('segment-') or name.endswith('.tmp')):
+                os.remove(os.path.join(self.directory, name))
+        print(f"Snapshot merged: {len(ordered)} rows in {len(segments)} segments")
+        return {'rows': len(ordered), 'segments': len(segments)}
+
+    def info(self) -> dict:
+        manifest = self.manifest()
+        return {
+            'directory': self.directory,
+            'watermark': manifest['watermark'],
+            'segments': len(manifest['segments']),
+            'rows': sum(segment['rows'] for segment in manifest['segments']),
+            'bytes': sum(segment['bytes'] for segment in manifest['segments']),
+        }
+
+
+if __name__ == '__main__':
+    # python -m models.Snapshot migrate  给 accounting 表加上 updated_at 字段和索引（只需执行一次）
+    # python -m models.Snapshot export   增量导出，适合每晚定时执行
+    # python -m models.Snapshot merge    合并段文件
+    # python -m models.Snapshot info     查看水位线、段文件数和体积
+    # python -m models.Snapshot csv      把快照中每条记录的最新版本以 CSV 输出到标准输出
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+    snapshot = Snapshot.from_env()
+    if command == 'migrate':
+        table = Table('accounting', debug=True)
+        table.query(Snapshot.MIGRATE_SQL)
+        print(table.m_errorstr or "updated_at added")
+    elif command == 'export':
+        time_begin = time.perf_counter()
+        result = snapshot.export()
+        print(f"{result} in {time.perf_counter() - time_begin:.1f} seconds")
+    elif command == 'merge':
+        print(snapshot.merge())
+    elif command == 'info':
+        print(json.dumps(snapshot.info(), ensure_ascii=False, indent=1))
+    elif command == 'csv':
+        names = [name for name, _ in Snapshot.COLUMNS]
+        writer = csv.writer(sys.stdout)
+        writer.writerow(names)
+        for record in snapshot.rows():
+            writer.writerow(['' if record.get(name) is None else record.get(name) for name in names])
+    else:
+        print("Usage: python -m models.Snapshot migrate|export|merge|info|csv")
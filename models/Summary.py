@@ -0,0 +1,146 @@
+import datetime
+import sys
+from decimal import Decimal, InvalidOperation
+
+from .Table import Table
+
+
+class Summary(Table):
+    """
+    按月份和类别汇总收支的统计表 accounting_summary。
+    每次保存、编辑记录时按新旧值的差额增量更新，/summary 页面直接读这张表，不用扫描全部记录。
+    增量更新出现偏差时（如直接改了数据库）用 python -m models.Summary rebuild 重建。
+    """
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS `accounting_summary` (
+  `month` char(7) NOT NULL,
+  `category` varchar(16) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL DEFAULT '',
+  `income_total` decimal(14,2) NOT NULL DEFAULT 0,
+  `expense_total` decimal(14,2) NOT NULL DEFAULT 0,
+  `record_count` int NOT NULL DEFAULT 0,
+  PRIMARY KEY (`month`,`category`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin
+"""
+
+    def __init__(self):
+        super().__init__('accounting_summary', debug=True)
+
+    # 一条记录对统计表的贡献：(月份, 类别) 和 (收入, 支出, 条数)，没有有效交易时间时返回 None
+    @staticmethod
+    def contribution(record: dict):
+        if not record:
+            return None
+        transaction_time = record.get('transaction_time')
+        if isinstance(transaction_time, (datetime.datetime, datetime.date)):
+            month = transaction_time.strftime('%Y-%m')
+        else:
+            month = str(transaction_time or '')[:7]
+            try:
+                datetime.datetime.strptime(month, '%Y-%m')
+            except ValueError:
+                return None
+        category = record.get('category') or ''
+        return (month, category), (Summary.amount(record.get('income_amount')), Summary.amount(record.get('expense_amount')), 1)
+
+    @staticmethod
+    def amount(value) -> Decimal:
+        if value is None or value == '':
+            return Decimal('0')
+        try:
+            return Decimal(str(value))
+        except InvalidOperation:
+            return Decimal('0')
+
+    # 按一条记录的旧值和新值增量更新统计表
+    # 新增记录时 old 为 None，删除记录时 new 为 None
+    def applyDelta(self, old: dict = None, new: dict = None) -> int:
+        sql = self.deltaSql(old, new)
+        if not sql:
+            return 0
+        self.query(sql)
+        return self.m_rowcount
+
+    # 增量更新统计表的 SQL，没有需要更新的行时返回空字符串
+    def deltaSql(self, old: dict = None, new: dict = None) -> str:
+        deltas = {}
+        for record, sign in ((old, -1), (new, 1)):
+            contribution = self.contribution(record)
+            if contribution is None:
+                continue
+            key, (income, expense, count) = contribution
+            total = deltas.get(key, (Decimal('0'), Decimal('0'), 0))
+            deltas[key] = (total[0] + sign * income, total[1] + sign * expense, total[2] + sign * count)
+        values = [
+            # 没有类别的记录归到空字符串，不能用 sql_value() 转成 NULL，因为 category 是主键的一部分
+            f"('{month}', '{self.sql_escape(category)}', {income}, {expense}, {count})"
+            for (month, category), (income, expense, count) in deltas.items()
+            if income or expense or count
+        ]
+        if not values:
+            return ''
+        # 已有的行在原值上累加差额，没有的行直接插入
+        return (f"INSERT INTO {self.m_table} (month, category, income_total, expense_total, record_count) "
+               f"VALUES {', '.join(values)} ON DUPLICATE KEY UPDATE "
+               "income_total = income_total + VALUES(income_total), "
+               "expense_total = expense_total + VALUES(expense_total), "
+               "record_count = record_count + VALUES(record_count)")
+
+    # 从 accounting 表重新统计，months 为空时重建全部月份，否则只重建指定的月份（如 ['2025-01', '2025-02']）
+    # 删除和重新统计在同一个事务中完成，重建过程中 /summary 不会读到空表
+    def rebuild(self, months: list = None) -> int:
+        delete_sql = f"DELETE FROM {self.m_table}"
+        select_where = ""
+        if months:
+            months = sorted(set(months))
+            # 按时间范围过滤，可以用上 transaction_time 开头的索引
+            ranges = []
+            for month in months:
+                # 月份格式不对时 strptime 抛出 ValueError，同时防止拼进 SQL 的内容不合法
+                begin = datetime.datetime.strptime(month, '%Y-%m')
+                end = (begin + datetime.timedelta(days=32)).replace(day=1)
+                ranges.append(f"(transaction_time >= '{begin:%Y-%m-%d}' AND transaction_time < '{end:%Y-%m-%d}')")
+            select_where = f" WHERE {' OR '.join(ranges)}"
+            delete_sql += f" WHERE month IN ({', '.join(self.sql_value(month) for month in months)})"
+        insert_sql = (f"INSERT INTO {self.m_table} (month, category, income_total, expense_total, record_count) "
+                      "SELECT DATE_FORMAT(transaction_time, '%Y-%m'), IFNULL(category, ''), "
+                      "IFNULL(SUM(income_amount), 0), IFNULL(SUM(expense_amount), 0), COUNT(*) "
+                      f"FROM accounting{select_where} GROUP BY 1, 2")
+        if self.debug:
+            print(f"SQL: {delete_sql}")
+            print(f"SQL: {insert_sql}")
+        with self.timer(insert_sql), self.pool.connection() as connection:
+            connection.begin()
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(delete_sql)
+                    cursor.execute(insert_sql)
+                    rowcount = cursor.rowcount
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+            finally:
+                self.invalidate_cache()
+        return rowcount
+
+    # 读取最近 months 个月的统计，按月份倒序、类别正序
+    def listSummary(self, months: int = 12) -> list:
+        today = datetime.date.today()
+        # 往前推 months - 1 个月的月份
+        index = today.year * 12 + today.month - 1 - (months - 1)
+        start = f"{index // 12:04d}-{index % 12 + 1:02d}"
+        return self.select('*').where('month', '>=', start).order_by('month', 'DESC', 'category', 'ASC').get()
+
+
+if __name__ == '__main__':
+    # python -m models.Summary create          创建统计表
+    # python -m models.Summary rebuild [月份...]  重建全部或指定月份（如 2025-01）的统计
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+    summary = Summary()
+    if command == 'create':
+        summary.query(Summary.SCHEMA)
+        print(summary.m_errorstr or "accounting_summary created")
+    elif command == 'rebuild':
+        print(f"Rebuilt {summary.rebuild(sys.argv[2:])} rows")
+    else:
+        print("Usage: python -m models.Summary create|rebuild [YYYY-MM ...]")
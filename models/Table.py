@@ -1,8 +1,16 @@
+import contextlib
 import datetime
-import pymysql
+import functools
 import os
+import pymysql
+import pymysql.cursors
+import time
 
+from collections import namedtuple
 from pymysql.converters import escape_string
+from .ConnectionPool import ConnectionPool
+from .Metrics import Metrics
+from .QueryCache import QueryCache
 
 class Table:
     JOIN_INNER = 'INNER'
@@ -18,6 +26,22 @@ class Table:
     ORDER_ASC = 'ASC'
     ORDER_DESC = 'DESC'
 
+    # get() 和 iter() 返回的行类型：字典，或按字段名访问的只读元组（namedtuple，占用内存更少、创建更快）
+    ROW_DICT = 'dict'
+    ROW_TUPLE = 'tuple'
+
+    # insert_batches() 每批最多的行数和最大的 SQL 语句字节数
+    INSERT_BATCH_ROWS = 500
+    INSERT_BATCH_BYTES = 1024 * 1024
+
+    # debug 模式下打印的 SQL 最大长度
+    DEBUG_SQL_LENGTH = 1000
+
+    # iter() 每次从服务端游标读取的行数
+    ITER_FETCH_SIZE = int(os.environ.get("MYSQL_FETCH_SIZE") or 500)
+
+    _max_allowed_packet = None
+
     def __init__(self, table, debug=False):
         self.debug = debug
         self.m_table = table
@@ -26,25 +50,15 @@ class Table:
         self.m_sqlorder = ""
         self.m_sqlgroup = ""
         self.m_sqllimit = ""
+        self.m_jointable = ""
+        self.m_nocache = False
 
-        mysqlHost = os.environ.get("MYSQL_HOST") or 'localhost'
-        mysqlUser = os.environ.get("MYSQL_USER") or 'root'
-        mysqlPassword = os.environ.get("MYSQL_PASSWORD") or ''
-        mysqlDatabase = os.environ.get("MYSQL_DATABASE") or 'test'
-        env = os.environ.get("FLASK_ENV")
-        
-        jsonSsl = {'ca': 'models/DigiCertGlobalRootCA.crt.pem'} if env != 'development' else None
-        print(f"Connecting to MySQL database at {mysqlHost} as user {mysqlUser} in {env} environment.")
-        connection = pymysql.connect(
-                host=mysqlHost,
-                user=mysqlUser,
-                password=mysqlPassword,
-                database=mysqlDatabase,
-                autocommit=True,
-                ssl=jsonSsl
-            )
-        self.cursor = connection.cursor()
+        # 连接从进程内共享的连接池借用，每次执行 SQL 时借出、执行完归还
+        self.pool = ConnectionPool.instance()
+        self.m_rowcount = 0
         self.m_errorstr = ""
+        # get() 的查询结果缓存，环境变量 QUERY_CACHE_TTL 大于 0 时启用
+        self.query_cache = QueryCache.instance()
 
     def clear_error(self):
         self.m_errorstr = ""
@@ -59,6 +73,16 @@ class Table:
     def get_table(self):
         return self.m_table
 
+    # 连接池状态：借出、空闲连接数和等待时间
+    @staticmethod
+    def pool_stats():
+        return ConnectionPool.instance().stats()
+
+    # 查询缓存状态：命中率、条数和作废次数
+    @staticmethod
+    def cache_stats():
+        return QueryCache.instance().stats()
+
     def select(self, *fields):
         if not fields:
             fields = '*'
@@ -69,8 +93,18 @@ class Table:
 
     def join(self, table, on_left_table, on_right_table, join_type=JOIN_INNER):
         self.m_sqljoin = f" {join_type} JOIN {table} ON {on_left_table} = {on_right_table}"
+        self.m_jointable = table
         return self
 
+    # 本次 get() 不读也不写查询缓存，用于写入前必须读到最新数据的场景
+    def no_cache(self):
+        self.m_nocache = True
+        return self
+
+    # 写入后使这张表的缓存查询结果作废
+    def invalidate_cache(self):
+        self.query_cache.invalidate(self.m_table)
+
     def where(self, key, operator, value, conjunction='WHERE'):
         self.clear_error()
         # operator统一转换成大写
@@ -87,12 +121,41 @@ class Table:
         self.m_sqlwhere += f" {conjunction} {condition}"
         return self
 
+    # 全文检索条件 MATCH (fields) AGAINST (keyword IN BOOLEAN MODE)，fields 上需要有 FULLTEXT 索引
+    # keyword 使用布尔模式语法，如 +"关键词"；前面已有条件时自动用 AND 连接
+    def where_match(self, fields, keyword):
+        self.clear_error()
+        condition = f" (MATCH ({', '.join(fields)}) AGAINST ('{self.sql_escape(keyword)}' IN BOOLEAN MODE)) "
+        conjunction = 'AND' if self.m_sqlwhere else 'WHERE'
+        self.m_sqlwhere += f" {conjunction} {condition}"
+        return self
+
     def and_where(self, key, operator, value):
         return self.where(key, operator, value, 'AND')
 
     def or_where(self, key, operator, value):
         return self.where(key, operator, value, 'OR')
 
+    # 游标（keyset）分页条件：只取排序上位于 values 这一行之后的记录
+    # 例如 seek(['transaction_time', 'id'], ['2025-02-15 12:30:00', 123]) 生成
+    # (transaction_time <= '...') AND ((transaction_time < '...') OR (transaction_time = '...' AND id < '123'))
+    # 前一个条件让 MySQL 直接在索引上做范围扫描，不用像 LIMIT offset 那样先读出再丢弃前面的行
+    def seek(self, fields, values, direction=ORDER_DESC):
+        self.clear_error()
+        if len(fields) != len(values) or not fields:
+            self.set_error(f"(SQL error: seek() needs one value for each of {fields}.")
+            return self
+        operator = '<' if direction == self.ORDER_DESC else '>'
+        values = [f"'{self.sql_escape(str(v))}'" for v in values]
+        branches = []
+        for i in range(len(fields)):
+            equals = [f"{fields[j]} = {values[j]}" for j in range(i)]
+            branches.append("(" + " AND ".join(equals + [f"{fields[i]} {operator} {values[i]}"]) + ")")
+        condition = f" ({fields[0]} {operator}= {values[0]}) AND ({' OR '.join(branches)}) "
+        conjunction = 'AND' if self.m_sqlwhere else 'WHERE'
+        self.m_sqlwhere += f" {conjunction} {condition}"
+        return self
+
     def order_by(self, *fields):
         self.m_sqlorder = " ORDER BY "
         if len(fields) == 1:
@@ -121,80 +184,147 @@ class Table:
 
     def query(self, sql):
         self.m_sql = sql
+        self.m_rowcount = 0
         self.clear_error()
         # print(sql)
 
         try:
             if self.debug:
-                print(f"SQL: {sql}")
-                time_begin = datetime.datetime.now().timestamp()
-            self.cursor.execute(sql)
-            if self.debug:
-                elapsed_time = (datetime.datetime.now().timestamp() - time_begin) * 1000
-                formatted_time = f"{elapsed_time:.4f} ms"
-                print(f"SQL run time: {formatted_time}")
+                # 批量插入的 SQL 可能有几百 KB，日志里只打印开头部分
+                print(f"SQL: {sql if len(sql) <= self.DEBUG_SQL_LENGTH else sql[:self.DEBUG_SQL_LENGTH] + '...'}")
+            # 执行耗时按语句形状记录到 Metrics，由 /metrics 输出
+            with self.timer(sql):
+                with self.pool.connection() as connection:
+                    with connection.cursor() as cursor:
+                        try:
+                            cursor.execute(sql)
+                            self.m_rowcount = cursor.rowcount
+                        finally:
+                            # 除 SELECT 外的语句都可能改了这张表，不论成功与否都让缓存作废
+                            if sql.lstrip()[:6].upper() != 'SELECT':
+                                self.invalidate_cache()
         except pymysql.err.InterfaceError as e:
             print(f"SQL execution error: {e}")
+            self.set_error(f"SQL execution error: {e}")
         except pymysql.err.ProgrammingError as e:
             print(f"SQL syntax error: {e}")
+            self.set_error(f"SQL syntax error: {e}")
         except Exception as e:
             print(f"Unexpected error: {e}")
+            self.set_error(f"Unexpected error: {e}")
 
         self.m_sqlwhere = ""
         self.m_sql = ""
         self.m_sqlfields = ""
         return self
 
-    def get(self):
+    # 按 select()、join()、where() 等设置的条件生成 SELECT 语句
+    def select_sql(self):
+        return f"SELECT {self.m_sqlfields} FROM {self.m_table}{self.m_sqljoin}{self.m_sqlwhere}{self.m_sqlgroup}{self.m_sqlorder}{self.m_sqllimit}"
+
+    # row_type 为 ROW_DICT 时每行是字典，为 ROW_TUPLE 时是可以用 row.字段名 访问的 namedtuple
+    # 字段值为 None 时都转换成空字符串
+    def get(self, row_type=ROW_DICT):
         self.clear_error()
         if self.m_sqlfields:
-            sql = f"SELECT {self.m_sqlfields} FROM {self.m_table}{self.m_sqljoin}{self.m_sqlwhere}{self.m_sqlorder}{self.m_sqllimit}"
-            # 执行查询
-            self.cursor.execute(sql)
-            result = self.cursor.fetchall()
-            # fetchall() 返回的一个是元组的列表，转换为字典的列表
-            field_names = [desc[0] for desc in self.cursor.description]
-            result = [dict(zip(field_names, row)) for row in result]
-            # 数据库表中某字段值为空时，to_dict()会将其转换为None，把它改成空字符串
-            for record in result:
-                for key, value in record.items():
-                    if value is None:
-                        record[key] = ''
+            sql = self.select_sql()
+            tables = [self.m_table, self.m_jointable] if self.m_jointable else [self.m_table]
+            use_cache = self.query_cache.enabled and not self.m_nocache
+            cache_key = (row_type, sql)
+            if use_cache:
+                result = self.query_cache.get(cache_key)
+                if result is not None:
+                    self.reset_query()
+                    return result
+                versions = self.query_cache.versions(tables)
+            # 执行查询，pymysql 解析每一行时由 RowCursor 直接生成结果行，不用再遍历一遍
+            with self.timer(sql):
+                with self.pool.connection() as connection:
+                    with connection.cursor(RowCursor) as cursor:
+                        cursor.row_type = row_type
+                        cursor.execute(sql)
+                        result = cursor.fetchall()
+            # fetchall() 可能返回元组，统一成列表
+            result = list(result)
+            Metrics.inc('aifun_sql_rows_total', len(result), table=self.m_table)
+            if use_cache:
+                self.query_cache.set(cache_key, tables, result, versions)
         else:
             result = []
             
-        # 清除查询条件
+        self.reset_query()
+        return result
+
+    # 逐行读取查询结果的生成器，用于导出等需要遍历整张表的场景
+    # 使用无缓冲的服务端游标（SSCursor），每次只从网络读取 fetch_size 行，内存占用与总行数无关
+    def iter(self, fetch_size=ITER_FETCH_SIZE, row_type=ROW_DICT):
+        self.clear_error()
+        sql = self.select_sql() if self.m_sqlfields else ""
+        # 先生成 SQL 并清除查询条件，生成器开始迭代前实例就可以用于下一次查询
+        self.reset_query()
+        return self._iter_rows(sql, fetch_size, row_type)
+
+    def _iter_rows(self, sql, fetch_size, row_type):
+        if not sql:
+            return
+        if self.debug:
+            print(f"SQL: {sql}")
+        connection = self.pool.acquire()
+        finished = False
+        time_begin = time.perf_counter()
+        try:
+            cursor = connection.cursor(SSRowCursor)
+            cursor.row_type = row_type
+            cursor.execute(sql)
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                yield from rows
+            cursor.close()
+            finished = True
+            Metrics.observe('aifun_sql_seconds', time.perf_counter() - time_begin, shape=Metrics.sql_shape(sql))
+        finally:
+            # 中途停止迭代（如下载的客户端断开）时，无缓冲游标还有没读完的结果，这个连接不能再复用，直接丢弃
+            self.pool.release(connection, discard=not finished)
+
+    # 记录一条 SQL 的耗时，出错时同时计数；未启用 Metrics 时不做任何事
+    def timer(self, sql):
+        return _SqlTimer(Metrics.sql_shape(sql)) if Metrics.enabled else contextlib.nullcontext()
+
+    # 清除查询条件，同一个实例接着做下一次查询时不会带上这次的排序和分页
+    def reset_query(self):
         self.m_sqlwhere = ""
+        self.m_sqljoin = ""
+        self.m_sqlorder = ""
+        self.m_sqlgroup = ""
+        self.m_sqllimit = ""
         self.m_sql = ""
         self.m_sqlfields = ""
-        return result
+        self.m_jointable = ""
+        self.m_nocache = False
 
-    def insert(self, data, on_duplicate=INSERT_IGNORE):
-        self.clear_error()
-        fields = list(data[0].keys())
-        values = []
-        for row in data:
-            # 对于每一行数据，转换成 SQL 语句的格式
-            # 如果值为 None 或者空字符串，则转换成 NULL
-            # 如果值为日期，则转换成字符串格式
-            # 如果值为字符串，则转换成 SQL 语句的格式
-            # 如果值为数字，则直接使用
-            value = []
-            for key in fields:
-                val = row[key]
-                if val is None or val == '':
-                    value.append('NULL')
-                elif isinstance(val, str):
-                    value.append(f"'{self.sql_escape(val)}'")
-                elif isinstance(val, (int, float)):
-                    value.append(str(val))
-                elif isinstance(val, (datetime.date)):
-                    value.append("'"+ val.strftime('%Y-%m-%d')+"'")
-                elif isinstance(val, (datetime.datetime)):
-                    value.append("'"+ val.strftime('%Y-%m-%d %H:%M:%S')+"'")
-                else:
-                    value.append(f"'{self.sql_escape(str(val))}'")
-            values.append(f"({', '.join(value)})")
+    # 把一个值转换成 SQL 语句中的字面量
+    # 如果值为 None 或者空字符串，则转换成 NULL
+    # 如果值为日期，则转换成字符串格式
+    # 如果值为字符串，则转换成 SQL 语句的格式
+    # 如果值为数字，则直接使用
+    def sql_value(self, val):
+        if val is None or val == '':
+            return 'NULL'
+        elif isinstance(val, str):
+            return f"'{self.sql_escape(val)}'"
+        elif isinstance(val, (int, float)):
+            return str(val)
+        # datetime 是 date 的子类，要先判断，否则时间部分会丢失
+        elif isinstance(val, (datetime.datetime)):
+            return "'"+ val.strftime('%Y-%m-%d %H:%M:%S')+"'"
+        elif isinstance(val, (datetime.date)):
+            return "'"+ val.strftime('%Y-%m-%d')+"'"
+        else:
+            return f"'{self.sql_escape(str(val))}'"
+
+    def insert_sql(self, fields, values, on_duplicate=INSERT_IGNORE):
         sql = f"INSERT INTO {self.m_table} ({', '.join(fields)}) VALUES {', '.join(values)}"
         if on_duplicate == self.INSERT_REPLACE:
             sql = f"REPLACE INTO {self.m_table} ({', '.join(fields)}) VALUES {', '.join(values)}"
@@ -203,8 +333,67 @@ class Table:
         elif on_duplicate == self.INSERT_UPDATE:
             update_fields = [f"{field}=VALUES({field})" for field in fields]
             sql += f" ON DUPLICATE KEY UPDATE {', '.join(update_fields)}"
-        self.query(sql)
-        return self.cursor.rowcount
+        return sql
+
+    def insert(self, data, on_duplicate=INSERT_IGNORE):
+        self.clear_error()
+        rowcount = 0
+        errors = []
+        for batch in self.insert_batches(data, on_duplicate):
+            rowcount += batch['affected']
+            if batch['error']:
+                errors.append(batch['error'])
+        self.m_rowcount = rowcount
+        if errors:
+            self.set_error('; '.join(errors))
+        return rowcount
+
+    # 分批插入多行，rows 可以是列表，也可以是逐行产生数据的迭代器（如逐行解析的 CSV）
+    # 每批最多 max_rows 行，SQL 语句长度不超过 INSERT_BATCH_BYTES 和服务端 max_allowed_packet 中较小的一个
+    # 每执行完一批返回一个结果字典：{'first': 本批第一行的序号, 'rows': 行数, 'affected': 影响行数, 'error': 错误信息}
+    # 某一批出错不影响后面的批次，由调用方决定如何处理
+    def insert_batches(self, rows, on_duplicate=INSERT_IGNORE, max_rows=INSERT_BATCH_ROWS):
+        max_bytes = min(self.INSERT_BATCH_BYTES, self.max_allowed_packet() - 1024)
+        fields = None
+        values = []
+        size = 0
+        first = 0
+        index = 0
+        for row in rows:
+            if fields is None:
+                fields = list(row.keys())
+                size = len(self.insert_sql(fields, [], on_duplicate).encode('utf-8'))
+                base_size = size
+            value = f"({', '.join(self.sql_value(row.get(key)) for key in fields)})"
+            value_size = len(value.encode('utf-8')) + 2
+            if values and (len(values) >= max_rows or size + value_size > max_bytes):
+                yield self._insert_batch(fields, values, on_duplicate, first)
+                values = []
+                size = base_size
+                first = index
+            values.append(value)
+            size += value_size
+            index += 1
+        if values:
+            yield self._insert_batch(fields, values, on_duplicate, first)
+
+    def _insert_batch(self, fields, values, on_duplicate, first):
+        self.query(self.insert_sql(fields, values, on_duplicate))
+        return {'first': first, 'rows': len(values), 'affected': self.m_rowcount, 'error': self.m_errorstr}
+
+    # 服务端允许的最大 SQL 包大小，每个进程只查询一次
+    def max_allowed_packet(self):
+        if Table._max_allowed_packet is None:
+            try:
+                with self.pool.connection() as connection:
+                    with connection.cursor() as cursor:
+                        cursor.execute("SELECT @@max_allowed_packet")
+                        Table._max_allowed_packet = int(cursor.fetchone()[0])
+            except Exception as e:
+                print(f"Failed to read max_allowed_packet: {e}")
+                # MySQL 5.7 之前的默认值，查询失败时按最保守的大小分批
+                return 4 * 1024 * 1024
+        return Table._max_allowed_packet
 
     def add(self, data, on_duplicate=INSERT_IGNORE):
         return self.insert([data], on_duplicate)
@@ -219,4 +408,63 @@ class Table:
             print(err)
             return False
         self.query(sql)
-        return self.cursor.rowcount
\ No newline at end of file
+        return self.m_rowcount
+
+
+class _SqlTimer:
+    __slots__ = ('shape', 'begin')
+
+    def __init__(self, shape):
+        self.shape = shape
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        Metrics.observe('aifun_sql_seconds', time.perf_counter() - self.begin, shape=self.shape)
+        if exc_type is not None:
+            Metrics.inc('aifun_sql_errors_total', shape=self.shape)
+
+
+@functools.lru_cache(maxsize=64)
+def _row_class(fields):
+    # 同样的字段列表共用一个 namedtuple 类；字段名不是合法标识符（如没有别名的表达式）时自动改名为 _序号
+    return namedtuple('Row', fields, rename=True)
+
+
+class _RowCursorMixin:
+    """
+    pymysql 游标，在解析每一行时直接生成字典或 namedtuple，并把 None 转换成空字符串
+    """
+    row_type = Table.ROW_DICT
+
+    @staticmethod
+    def row_maker(fields, row_type):
+        """
+        :return: 把一行元组转换成结果行的函数
+        """
+        if row_type == Table.ROW_TUPLE:
+            make = _row_class(fields)._make
+            return lambda row: make(['' if value is None else value for value in row])
+        return lambda row: {field: ('' if value is None else value) for field, value in zip(fields, row)}
+
+    def _do_get_result(self):
+        super()._do_get_result()
+        self._make_row = self.row_maker(tuple(desc[0] for desc in self.description or ()), self.row_type)
+        # 普通游标已经读取了全部行，在这里一次转换；无缓冲游标在 read_next() 中逐行调用 _conv_row()
+        if self.description and self._rows:
+            self._rows = [self._make_row(row) for row in self._rows]
+
+    def _conv_row(self, row):
+        if row is None:
+            return None
+        return self._make_row(row)
+
+
+class RowCursor(_RowCursorMixin, pymysql.cursors.Cursor):
+    pass
+
+
+class SSRowCursor(_RowCursorMixin, pymysql.cursors.SSCursor):
+    pass
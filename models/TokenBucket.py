@@ -0,0 +1,44 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    令牌桶限流器，线程安全。
+    每秒补充 rate 个令牌，最多攒 capacity 个；每次请求消耗一个令牌，没有令牌时等待补充。
+    """
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        :param rate: 每秒补充的令牌数，即长期平均的每秒请求数，0 表示不限流
+        :param capacity: 桶容量，即允许的突发请求数，默认与 rate 相同（至少为 1）
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity else max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout: float = None) -> bool:
+        """
+        取一个令牌，需要时阻塞等待
+        :param timeout: 最长等待秒数，None 表示一直等
+        :return: 是否取到令牌，超时返回 False
+        """
+        if self.rate <= 0:
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)